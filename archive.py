@@ -0,0 +1,41 @@
+import os
+
+# Truyền cả thư mục trong một luồng, không tạo tệp tin nén tạm ở bên nào. Mỗi thành viên là
+#   MEMBER <đường dẫn tương đối> <kích thước>, các frame DATA, MEMBER_END <checksum>
+# thư mục rỗng là DIR <đường dẫn tương đối>, cuối luồng là END. Checksum đi sau dữ liệu nên
+# bên gửi chỉ đọc mỗi tệp tin một lần, và tệp tin hỏng chỉ làm hỏng thành viên đó.
+
+def normalize_member(relpath):
+    # Đường dẫn thành viên luôn dùng "/"; trả về None nếu có thể thoát khỏi thư mục gốc
+    if not relpath or '\0' in relpath or '\\' in relpath or relpath.startswith('/'):
+        return None
+    parts = relpath.split('/')
+    if any(part in ('', '.', '..') for part in parts):
+        return None
+    if os.path.splitdrive(relpath)[0]:
+        return None
+    return '/'.join(parts)
+
+def member_path(root, relpath):
+    # Đường dẫn thật của thành viên bên trong root, None nếu relpath không hợp lệ
+    relpath = normalize_member(relpath)
+    if relpath is None:
+        return None
+    return os.path.join(root, *relpath.split('/'))
+
+def walk_tree(root):
+    # Duyệt root theo thứ tự tên, trả về ('DIR', đường dẫn tương đối) cho thư mục rỗng và
+    # ('FILE', đường dẫn tương đối, đường dẫn thật, kích thước) cho tệp tin. Bỏ qua symlink
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames if not os.path.islink(os.path.join(dirpath, name)))
+        relative_dir = os.path.relpath(dirpath, root)
+        prefix = '' if relative_dir == os.curdir else relative_dir.replace(os.sep, '/') + '/'
+        files = []
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if not os.path.islink(path) and os.path.isfile(path):
+                files.append((prefix + name, path, os.path.getsize(path)))
+        if prefix and not dirnames and not files:
+            yield ('DIR', prefix[:-1])
+        for relpath, path, size in files:
+            yield ('FILE', relpath, path, size)
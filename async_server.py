@@ -0,0 +1,522 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from server import FileTransferServer, ACCEPT_QUEUE, LISTEN_BACKLOG
+from tracing import PhaseTimer, format_address
+from archive import member_path
+from bandwidth import UPLOAD, DOWNLOAD, THROTTLE_QUANTUM
+from password_hashing import HashingBusy
+from protocol import (
+    PROTOCOL_V1, SUPPORTED_VERSIONS, DATA_FRAME_SIZE, MAX_MESSAGE_SIZE, FRAME_HEADER,
+    FRAME_MESSAGE, FRAME_DATA, ProtocolError, encode_message, encode_data_header,
+    format_v1, parse_v1, set_nodelay, unpack_fields,
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CHUNK_SIZE = 256 * 1024
+
+class AsyncChannel:
+    # Phiên bản asyncio của protocol.Channel, dùng chung bộ mã hóa message
+    def __init__(self, reader, writer, version=PROTOCOL_V1):
+        self.reader = reader
+        self.writer = writer
+        self.version = version
+        # asyncio bật TCP_NODELAY cho transport TCP từ Python 3.6, đặt lại cho chắc chắn
+        set_nodelay(writer.get_extra_info('socket'))
+        self.data_remaining = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.throttle = None
+
+    async def pace(self, direction, n):
+        # Chờ theo giới hạn băng thông mà không chặn event loop
+        if self.throttle is not None:
+            wait = self.throttle.delay(direction, n)
+            if wait:
+                await asyncio.sleep(wait)
+
+    async def send_message(self, *fields):
+        if self.version == PROTOCOL_V1:
+            data = f"{format_v1(fields)}\n".encode()
+        else:
+            data = encode_message(fields)
+        self.writer.write(data)
+        self.bytes_sent += len(data)
+        await self.writer.drain()
+
+    async def receive_message(self):
+        if self.version == PROTOCOL_V1:
+            try:
+                line = await self.reader.readline()
+            except (asyncio.LimitOverrunError, ValueError):
+                raise ProtocolError("Dòng lệnh quá dài")
+            self.bytes_received += len(line)
+            return parse_v1(line.decode().strip())
+        header = await self.reader.readexactly(FRAME_HEADER.size)
+        frame_type, length = FRAME_HEADER.unpack(header)
+        if frame_type != FRAME_MESSAGE:
+            raise ProtocolError(f"Frame không mong đợi: {frame_type}")
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"Message quá lớn: {length} bytes")
+        self.bytes_received += FRAME_HEADER.size + length
+        return unpack_fields(await self.reader.readexactly(length))
+
+    def write_data_header(self, length):
+        if self.version != PROTOCOL_V1:
+            self.writer.write(encode_data_header(length))
+            self.bytes_sent += FRAME_HEADER.size
+
+    async def receive_data(self, max_size):
+        if self.version == PROTOCOL_V1:
+            data = await self.reader.read(max_size)
+            self.bytes_received += len(data)
+            await self.pace(UPLOAD, len(data))
+            return data
+        while self.data_remaining == 0:
+            try:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+            except asyncio.IncompleteReadError:
+                return b''
+            frame_type, length = FRAME_HEADER.unpack(header)
+            if frame_type != FRAME_DATA:
+                raise ProtocolError(f"Frame không mong đợi: {frame_type}")
+            self.data_remaining = length
+            self.bytes_received += FRAME_HEADER.size
+        data = await self.reader.read(min(max_size, self.data_remaining))
+        self.data_remaining -= len(data)
+        self.bytes_received += len(data)
+        await self.pace(UPLOAD, len(data))
+        return data
+
+    def close(self):
+        self.writer.close()
+
+# Engine dùng một event loop asyncio thay cho một thread mỗi client. Giao thức
+# giống hệt FileTransferServer; các thao tác chặn (SQLite, đọc/ghi đĩa, checksum)
+# được chạy trong ThreadPoolExecutor.
+class AsyncFileTransferServer(FileTransferServer):
+
+    def __init__(self, host='0.0.0.0', port=8386, use_sendfile=True, max_workers=32, admins=(),
+                 metrics_port=None, trace=False, discover_public_ip=True, ready_file=None, bandwidth_limit=0,
+                 max_connections=None, accept_queue=ACCEPT_QUEUE, listen_backlog=LISTEN_BACKLOG, reuse_port=False,
+                 worker_id=None):
+        # Mặc định không giới hạn số kết nối; accept_queue không dùng vì mọi kết nối đều được
+        # event loop phục vụ ngay
+        super().__init__(host, port, use_sendfile, admins, metrics_port, trace, discover_public_ip, ready_file,
+                         bandwidth_limit, max_connections, accept_queue, listen_backlog, reuse_port, worker_id)
+        # Engine asyncio chỉ hỗ trợ các lệnh cơ bản
+        self.capabilities = []
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ft-io')
+        self.loop = None
+        self.stop_event = None
+
+    def start(self):
+        self.raise_file_limit()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logging.info("Keyboard interrupt received")
+        except Exception as e:
+            logging.error(f"Unexpected error: {str(e)}")
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def raise_file_limit(self):
+        # Mỗi kết nối cần một file descriptor, nâng soft limit lên bằng hard limit
+        if resource is None:
+            return
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY or hard > soft:
+                target = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+                resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+                logging.info(f'Raised open file limit from {soft} to {target}')
+        except (ValueError, OSError) as e:
+            logging.warning(f'Could not raise open file limit: {e}')
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(sig, self.stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, backlog=self.listen_backlog,
+            reuse_port=self.reuse_port or None
+        )
+        self.start_metrics_endpoint()
+        logging.info('Using asyncio engine')
+        self.mark_ready(server.sockets[0].getsockname()[1])
+        self.start_background_startup()
+
+        try:
+            async with server:
+                await self.stop_event.wait()
+        except asyncio.CancelledError:
+            logging.info("Keyboard interrupt received")
+        finally:
+            await self.async_shutdown(server)
+
+    async def async_shutdown(self, server):
+        logging.info('Starting server shutdown sequence...')
+        self.clear_ready()
+        self.shutdown_event.set()
+        server.close()
+        self.stop_metrics_endpoint()
+
+        # Thông báo cho tất cả client rồi đóng kết nối
+        for addr, channel in list(self.client_channels.items()):
+            try:
+                await self.send_message_async(channel, "SERVER_SHUTDOWN")
+                if addr in self.active_users:
+                    logging.info(f'Notified client {self.active_users[addr]} at {addr} about shutdown')
+                channel.close()
+            except Exception as e:
+                logging.error(f'Failed to notify client {addr}: {str(e)}')
+        self.active_users.clear()
+
+        logging.info('Server shutdown completed')
+
+    async def run_blocking(self, func, *args):
+        # Chạy trong context của coroutine để span tạo trong luồng I/O nằm dưới span của lệnh
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(self.executor, context.run, func, *args)
+
+    async def send_message_async(self, channel, *fields):
+        try:
+            await channel.send_message(*fields)
+        except Exception as e:
+            logging.warning(f'Error sending message: {e}')
+
+    async def receive_message_async(self, channel):
+        try:
+            return await channel.receive_message()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return []
+        except Exception as e:
+            logging.warning(f'Error receiving message: {e}')
+            return []
+
+    async def version_check_async(self, channel):
+        version_msg = await self.receive_message_async(channel)
+        if len(version_msg) == 2 and version_msg[0] == "VERSION" and version_msg[1] in SUPPORTED_VERSIONS:
+            if version_msg[1] == PROTOCOL_V1:
+                await self.send_message_async(channel, "VERSION_OK")
+            else:
+                await self.send_message_async(channel, "VERSION_OK", *self.capabilities)
+            channel.version = version_msg[1]
+            return True
+        await self.send_message_async(channel, "VERSION_ERROR")
+        return False
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        if self.max_connections is not None and len(self.client_channels) >= self.max_connections:
+            await self.reject_busy_async(writer, address)
+            return
+        channel = AsyncChannel(reader, writer)
+        self.client_channels[address] = channel
+        self.metrics.inc('connections_total')
+        try:
+            logging.info(f'New connection from {address}')
+            with self.tracer.span('handshake', address=format_address(address)) as span:
+                accepted = await self.version_check_async(channel)
+                span.set(version=channel.version, accepted=accepted)
+            if not accepted:
+                logging.warning(f'Version check failed for {address}')
+                return
+
+            if not await self.authenticate_async(channel, address):
+                return
+
+            while not self.shutdown_event.is_set():
+                command = await self.receive_message_async(channel)
+                if not command:
+                    break
+
+                with self.command_scope(command[0], address):
+                    if command[0] == "UPLOAD":
+                        await self.handle_upload_async(channel, address, command)
+                    elif command[0] == "DOWNLOAD":
+                        await self.handle_download_async(channel, address, command)
+                    elif command[0] == "LIST":
+                        await self.handle_list_async(channel, address)
+                    elif command[0] == "STATS":
+                        await self.handle_stats_async(channel, address)
+                    elif command[0] == "TRACE":
+                        await self.send_message_async(channel, *self.trace_command(address, command))
+                    elif command[0] == "PROFILE":
+                        reply = await self.run_blocking(self.profile_command, address, command)
+                        await self.send_message_async(channel, *reply)
+                    elif command[0] == "LIMIT":
+                        reply = await self.run_blocking(self.limit_command, address, command)
+                        await self.send_message_async(channel, *reply)
+                    else:
+                        await self.send_message_async(channel, "ERROR", "Unknown command")
+
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.info(f'Connection from {address} lost: {e}')
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f'Error handling client {address}: {e}')
+        finally:
+            if address in self.active_users:
+                logging.info(f'User {self.active_users[address]} disconnected from {address}')
+                del self.active_users[address]
+            self.retire_channel(address, channel)
+            channel.close()
+            logging.info(f'Connection from {address} closed')
+
+    async def reject_busy_async(self, writer, address):
+        logging.warning(f'Connection limit reached, rejecting {address}')
+        self.metrics.inc('connections_rejected_total')
+        try:
+            await AsyncChannel(reader=None, writer=writer).send_message(
+                "SERVER_BUSY", "Server đang bận, vui lòng thử lại sau")
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def authenticate_async(self, channel, address):
+        login_attempts = 3
+        while self.active_users.get(address) is None and not self.shutdown_event.is_set():
+            command_first = await self.receive_message_async(channel)
+            if not command_first:
+                return False
+            if command_first[0] == "LOGIN":
+                logging.info(f'Login attempt from {address}')
+                if len(command_first) != 3:
+                    await self.send_message_async(channel, "ERROR", "Định dạng đăng nhập không hợp lệ")
+                    continue
+                username, password = command_first[1], command_first[2]
+                if username == '' or password == '':
+                    await self.send_message_async(channel, "ERROR", "Tên đăng nhập hoặc mật khẩu không được để trống")
+                    continue
+                try:
+                    verified = await self.run_blocking(self.user_manager.verify_user, username, password)
+                except HashingBusy:
+                    logging.warning(f'Password hashing queue full, login from {address} rejected')
+                    await self.send_message_async(channel, "ERROR", "Server đang bận, vui lòng thử lại sau")
+                    continue
+                if verified:
+                    channel.throttle = await self.run_blocking(self.open_throttle, username)
+                    await self.send_message_async(channel, "SUCCESS", "Đăng nhập thành công")
+                    self.active_users[address] = username
+                    logging.info(f'Successfully login as {username} from {address}')
+                else:
+                    await self.send_message_async(channel, "ERROR", "Tên đăng nhập hoặc mật khẩu không đúng")
+                    logging.warning(f'Login (attempt {4 - login_attempts}) failed for {username} from {address}')
+                    login_attempts -= 1
+                    if login_attempts == 0:
+                        return False
+            elif command_first[0] == "SIGNUP":
+                if len(command_first) != 3:
+                    await self.send_message_async(channel, "ERROR", "Định dạng đăng ký không hợp lệ")
+                    continue
+                username, password = command_first[1], command_first[2]
+                if await self.run_blocking(self.user_manager.user_exists, username):
+                    await self.send_message_async(channel, "ERROR", "Người dùng đã tồn tại")
+                    continue
+                try:
+                    added = await self.run_blocking(self.user_manager.add_user, username, password)
+                except HashingBusy:
+                    logging.warning(f'Password hashing queue full, signup from {address} rejected')
+                    await self.send_message_async(channel, "ERROR", "Server đang bận, vui lòng thử lại sau")
+                    continue
+                if added:
+                    await self.send_message_async(channel, "SUCCESS", "Đăng ký thành công")
+                    logging.info(f'New user {username} registered from {address}')
+                else:
+                    logging.warning(f'Failed to register new user {username} from {address}')
+                    await self.send_message_async(channel, "ERROR", "Đăng ký thất bại")
+            else:
+                await self.send_message_async(channel, "ERROR", "Unknown command")
+        return self.active_users.get(address) is not None
+
+    async def handle_upload_async(self, channel, address, command):
+        username = self.active_users[address]
+        storage_dir = await self.run_blocking(self.user_manager.get_user_storage, username)
+        if len(command) < 2:
+            await self.send_message_async(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        filename = self.upload_name(command[1])
+        if filename is None:
+            await self.send_message_async(channel, "ERROR", "Tên tệp tin không hợp lệ")
+            return
+
+        original_filename = command[1]
+        filename = await self.run_blocking(self.claim_upload_name, username, storage_dir, filename)
+        filepath = os.path.join(storage_dir, filename)
+        if filename != original_filename:
+            await self.send_message_async(channel, "NEW_FILENAME", filename)
+        else:
+            await self.send_message_async(channel, "FILENAME_OK")
+
+        filesize_msg = await self.receive_message_async(channel)
+        try:
+            filesize = int(filesize_msg[1])
+        except (IndexError, ValueError):
+            await self.run_blocking(os.remove, filepath)
+            await self.send_message_async(channel, "ERROR", "Kích thước tệp tin không hợp lệ")
+            return
+
+        await self.send_message_async(channel, "READY")
+
+        checksum_msg = await self.receive_message_async(channel)
+        checksum = ""
+        if checksum_msg and checksum_msg[0] == "CHECKSUM":
+            checksum = checksum_msg[1]
+            await self.send_message_async(channel, "CHECKSUM_OK")
+
+        bytes_received = 0
+        sha256_hash = hashlib.sha256()
+        start_time = time.perf_counter()
+        f = await self.run_blocking(open, filepath, 'wb')
+        try:
+            with self.tracer.span('transfer', size=filesize) as span:
+                phases = PhaseTimer()
+                while bytes_received < filesize and not self.shutdown_event.is_set():
+                    data = await channel.receive_data(min(CHUNK_SIZE, filesize - bytes_received))
+                    phases.lap('socket')
+                    if not data:
+                        break
+                    # Ghi đĩa và băm cùng chạy trong luồng I/O nên tính chung
+                    await self.run_blocking(self.write_chunk, f, sha256_hash, data)
+                    phases.lap('write_hash')
+                    bytes_received += len(data)
+                span.set(received=bytes_received, **phases.attributes())
+        finally:
+            await self.run_blocking(f.close)
+
+        if bytes_received == filesize:
+            calculated_checksum = sha256_hash.hexdigest()
+            if checksum != calculated_checksum:
+                await self.send_message_async(channel, "ERROR", "Checksum không khớp")
+                await self.run_blocking(os.remove, filepath)
+            else:
+                self.record_transfer('upload', filesize, time.perf_counter() - start_time,
+                                     name=filename, user=username, address=address)
+                await self.run_blocking(self.store_uploaded_file, username, filepath, calculated_checksum)
+                await self.send_message_async(channel, "SUCCESS")
+                logging.info(f'File {filename} uploaded by {address}')
+        else:
+            await self.send_message_async(channel, "ERROR", "Tải lên không hoàn thành")
+
+    def write_chunk(self, f, sha256_hash, data):
+        f.write(data)
+        sha256_hash.update(data)
+
+    async def handle_download_async(self, channel, address, command):
+        username = self.active_users[address]
+        storage_dir = await self.run_blocking(self.user_manager.get_user_storage, username)
+        if len(command) < 2:
+            await self.send_message_async(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        filename = command[1]
+        filepath = member_path(storage_dir, filename)
+        if filepath is None or not await self.run_blocking(os.path.isfile, filepath):
+            await self.send_message_async(channel, "FILE_NOT_FOUND")
+            return
+
+        logging.info(f'File download request from {address}: {filename}')
+        filesize = await self.run_blocking(os.path.getsize, filepath)
+        await self.send_message_async(channel, "SIZE", filesize)
+        response = await self.receive_message_async(channel)
+        if response != ["READY"]:
+            await self.send_message_async(channel, "ERROR", "Không sẵn sàng nhận tệp tin")
+            return
+
+        checksum = await self.run_blocking(self.get_file_checksum, filepath)
+        await self.send_message_async(channel, "CHECKSUM", checksum)
+        response = await self.receive_message_async(channel)
+        if response != ["CHECKSUM_OK"]:
+            await self.send_message_async(channel, "ERROR", "Client không nhận được checksum")
+            return
+
+        start_time = time.perf_counter()
+        f = await self.run_blocking(open, filepath, 'rb')
+        try:
+            with self.tracer.span('transfer', size=filesize) as span:
+                method, sent = await self.send_payload_async(channel, f, filesize)
+                span.set(method=method, sent=sent)
+        finally:
+            await self.run_blocking(f.close)
+        self.record_download(method, sent, time.perf_counter() - start_time, filename, address)
+        await self.send_message_async(channel, "SUCCESS")
+
+    async def send_payload_async(self, channel, f, count):
+        if channel.version == PROTOCOL_V1:
+            return await self.send_file_async(channel, f, 0, count)
+        method, total_sent = 'buffered', 0
+        while total_sent < count:
+            frame_size = min(DATA_FRAME_SIZE, count - total_sent)
+            channel.write_data_header(frame_size)
+            method, sent = await self.send_file_async(channel, f, total_sent, frame_size)
+            total_sent += sent
+            if sent < frame_size:
+                raise IOError('Tệp tin bị thay đổi trong khi gửi')
+        return method, total_sent
+
+    async def send_file_async(self, channel, f, offset, count):
+        if self.use_sendfile:
+            # Khi bị giới hạn băng thông, gửi từng phần THROTTLE_QUANTUM byte và chờ giữa các phần
+            limited = channel.throttle is not None and channel.throttle.limited(DOWNLOAD)
+            step = THROTTLE_QUANTUM if limited else count
+            total_sent = 0
+            try:
+                while total_sent < count:
+                    sent = await self.loop.sendfile(channel.writer.transport, f, offset + total_sent,
+                                                    min(step, count - total_sent), fallback=False)
+                    channel.bytes_sent += sent
+                    total_sent += sent
+                    await channel.pace(DOWNLOAD, sent)
+                    if not sent:
+                        break
+                return 'sendfile', total_sent
+            except (asyncio.SendfileNotAvailableError, NotImplementedError):
+                if total_sent:
+                    raise
+        await self.run_blocking(f.seek, offset)
+        total_sent = 0
+        while total_sent < count:
+            data = await self.run_blocking(f.read, min(CHUNK_SIZE, count - total_sent))
+            if not data:
+                break
+            channel.writer.write(data)
+            channel.bytes_sent += len(data)
+            await channel.writer.drain()
+            total_sent += len(data)
+            await channel.pace(DOWNLOAD, len(data))
+        return 'buffered', total_sent
+
+    async def handle_stats_async(self, channel, address):
+        if self.active_users.get(address) not in self.admins:
+            await self.send_message_async(channel, "ERROR", "Không có quyền xem thống kê")
+            return
+        snapshot = await self.run_blocking(self.metrics.snapshot)
+        await self.send_message_async(channel, "STATS", json.dumps(snapshot))
+
+    async def handle_list_async(self, channel, address):
+        username = self.active_users[address]
+        storage_dir = await self.run_blocking(self.user_manager.get_user_storage, username)
+        file_info = await self.run_blocking(self.list_user_files, username, storage_dir)
+        if not file_info:
+            await self.send_message_async(channel, "ERROR", "Không có tệp tin")
+        else:
+            fields = [field for name, size in file_info for field in (name, size)]
+            await self.send_message_async(channel, "FILES", *fields)
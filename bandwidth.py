@@ -0,0 +1,123 @@
+import threading
+import time
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+# Khi đang bị giới hạn, mỗi lần gửi chỉ đi tối đa chừng này byte rồi mới giữ chỗ tiếp,
+# bằng buffer nhận của server nên các transfer đang chạy nhận các phần bằng nhau
+THROTTLE_QUANTUM = 256 * 1024
+BURST_SECONDS = 0.5
+RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_rate(text):
+    # "0", "512K", "10M", "1.5G" -> byte/giây (0 là không giới hạn); ValueError nếu không hợp lệ
+    text = str(text).strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in RATE_UNITS else ''
+    rate = float(text[:len(text) - len(unit)]) * RATE_UNITS[unit]
+    if not 0 <= rate < float('inf'):
+        raise ValueError(f'invalid rate: {text}')
+    return int(rate)
+
+class TokenBucket:
+    # rate byte/giây, 0 là không giới hạn. reserve(n) lấy n token ngay cả khi không đủ (bucket
+    # mang nợ) và trả về số giây phải chờ cho tới khi trả hết nợ. Người gọi sau phải chờ cả phần
+    # nợ của người gọi trước, nên các transfer dùng chung một bucket được phục vụ lần lượt theo
+    # thứ tự giữ chỗ và chia đều băng thông
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        rate = max(0, int(rate or 0))
+        with self.lock:
+            if rate == self.rate:
+                return
+            self.rate = rate
+            self.capacity = max(rate * BURST_SECONDS, THROTTLE_QUANTUM)
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+
+    def reserve(self, n):
+        with self.lock:
+            rate = self.rate
+            if not rate:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate) - n
+            self.updated = now
+            return -self.tokens / rate if self.tokens < 0 else 0.0
+
+class Throttle:
+    # Giới hạn của một kết nối đã đăng nhập: bucket chung của server và bucket của người dùng
+    # (dùng chung cho mọi kết nối của người đó), mỗi chiều truyền một bucket riêng. Channel gọi
+    # received(n)/sent(n) sau mỗi khối dữ liệu; khi không có giới hạn nào chỉ tốn hai phép so sánh
+    def __init__(self, scheduler, buckets):
+        self.scheduler = scheduler
+        self.buckets = buckets
+
+    def limited(self, direction):
+        return bool(self.scheduler.buckets[direction].rate or self.buckets[direction].rate)
+
+    def delay(self, direction, n):
+        # Giữ chỗ n byte, trả về số giây phải chờ (engine asyncio tự await asyncio.sleep)
+        server_bucket, user_bucket = self.scheduler.buckets[direction], self.buckets[direction]
+        if not (server_bucket.rate or user_bucket.rate):
+            return 0.0
+        wait = max(server_bucket.reserve(n), user_bucket.reserve(n))
+        if wait and self.scheduler.metrics is not None:
+            self.scheduler.metrics.inc('throttle_delay_seconds_total', wait, direction=direction)
+        return wait
+
+    def received(self, n):
+        wait = self.delay(UPLOAD, n)
+        if wait:
+            self.scheduler.sleep(wait)
+
+    def sent(self, n):
+        wait = self.delay(DOWNLOAD, n)
+        if wait:
+            self.scheduler.sleep(wait)
+
+class BandwidthScheduler:
+    # Giới hạn chung của server và giới hạn theo người dùng (byte/giây, áp dụng riêng cho mỗi
+    # chiều), đổi được khi server đang chạy: các kết nối đang mở dùng giá trị mới ngay ở khối
+    # dữ liệu kế tiếp. sleep nhận số giây, server truyền shutdown_event.wait để tắt không bị kẹt
+    def __init__(self, rate=0, sleep=time.sleep, metrics=None):
+        self.buckets = {UPLOAD: TokenBucket(rate), DOWNLOAD: TokenBucket(rate)}
+        self.sleep = sleep
+        self.metrics = metrics
+        self.users = {}  # username -> {chiều: TokenBucket}
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.buckets[UPLOAD].rate
+
+    def set_rate(self, rate):
+        for bucket in self.buckets.values():
+            bucket.set_rate(rate)
+
+    def user_buckets(self, username):
+        with self.lock:
+            buckets = self.users.get(username)
+            if buckets is None:
+                buckets = self.users[username] = {UPLOAD: TokenBucket(), DOWNLOAD: TokenBucket()}
+            return buckets
+
+    def set_user_rate(self, username, rate):
+        for bucket in self.user_buckets(username).values():
+            bucket.set_rate(rate)
+
+    def throttle(self, username, rate):
+        # Gọi khi đăng nhập với giới hạn đọc từ bảng users, nên sửa trực tiếp cơ sở dữ liệu
+        # cũng có hiệu lực từ lần đăng nhập sau
+        self.set_user_rate(username, rate)
+        return Throttle(self, self.user_buckets(username))
+
+    def limits(self):
+        with self.lock:
+            users = {name: buckets[UPLOAD].rate for name, buckets in self.users.items() if buckets[UPLOAD].rate}
+        return {'global': self.rate, 'users': users}
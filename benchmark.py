@@ -0,0 +1,437 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from client.transfer import FileTransferClient
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Đo hiệu năng đầu-cuối: chạy server trong một tiến trình riêng trên loopback (users.db và
+# thư mục lưu trữ nằm trong một thư mục tạm), tạo N client đồng thời thực hiện UPLOAD/DOWNLOAD/LIST
+# theo tỉ lệ cấu hình, rồi ghi kết quả ra JSON để so sánh giữa các phiên bản và tùy chọn engine.
+#
+#   python benchmark.py --clients 16 --duration 30 --mix upload=4,download=5,list=1 \
+#       --sizes 4K=60,256K=30,8M=10 --churn 0.05 --engine threading --output run.json
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+COMMANDS = ('upload', 'download', 'list')
+SAMPLE_INTERVAL = 0.5
+
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+def parse_weights(text, parse_key=str):
+    # "a=3,b=1" -> [(a, 3.0), (b, 1.0)]
+    weights = []
+    for item in text.split(','):
+        key, _, weight = item.partition('=')
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    if not weights or any(weight < 0 for _, weight in weights) or not sum(weight for _, weight in weights):
+        raise argparse.ArgumentTypeError(f'invalid weights: {text}')
+    return weights
+
+def parse_mix(text):
+    mix = parse_weights(text)
+    for command, _ in mix:
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError(f'unknown command: {command}')
+    return mix
+
+def parse_sizes(text):
+    return parse_weights(text, parse_size)
+
+def percentile(values, p):
+    # Nearest-rank trên danh sách đã sắp xếp
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+class ProcessSampler:
+    # Lấy mẫu CPU và RSS của tiến trình server định kỳ: dùng psutil nếu có, nếu không thì đọc /proc.
+    # Trên hệ điều hành không hỗ trợ cả hai thì các số đo là None
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.process = psutil.Process(pid) if psutil is not None else None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.rss_samples = []
+        self.cpu_start = self.cpu_end = None
+        self.wall_start = self.wall_end = None
+
+    def read(self):
+        # Trả về (số giây CPU user+system, RSS theo byte), None nếu không đọc được
+        try:
+            if self.process is not None:
+                cpu = self.process.cpu_times()
+                return cpu.user + cpu.system, self.process.memory_info().rss
+            with open(f'/proc/{self.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{self.pid}/statm') as f:
+                rss_pages = int(f.read().split()[1])
+            ticks = os.sysconf('SC_CLK_TCK')
+            return (int(fields[11]) + int(fields[12])) / ticks, rss_pages * os.sysconf('SC_PAGE_SIZE')
+        except Exception:
+            return None  # Tiến trình đã thoát, không có quyền đọc, hoặc không có /proc
+
+    def start(self):
+        sample = self.read()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = sample[0] if sample else None
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            sample = self.read()
+            if sample:
+                self.rss_samples.append(sample[1])
+
+    def stop(self):
+        sample = self.read()
+        self.wall_end = time.perf_counter()
+        self.stop_event.set()
+        self.thread.join()
+        if sample:
+            self.cpu_end = sample[0]
+            self.rss_samples.append(sample[1])
+
+    def summary(self):
+        cpu_seconds = None
+        if self.cpu_start is not None and self.cpu_end is not None:
+            cpu_seconds = self.cpu_end - self.cpu_start
+        wall = (self.wall_end or 0) - (self.wall_start or 0)
+        return {
+            'pid': self.pid,
+            'cpu_seconds': cpu_seconds,
+            'cpu_percent': cpu_seconds / wall * 100 if cpu_seconds is not None and wall > 0 else None,
+            'rss_peak_bytes': max(self.rss_samples) if self.rss_samples else None,
+            'rss_mean_bytes': sum(self.rss_samples) // len(self.rss_samples) if self.rss_samples else None,
+        }
+
+class LoadClient:
+    # Một client mô phỏng: chọn lệnh theo tỉ lệ trong mix, kích thước tệp tin theo phân bố sizes,
+    # và thỉnh thoảng đăng xuất/đăng nhập lại (login churn). Số đo được giữ riêng trong từng
+    # client rồi gộp lại sau khi chạy xong nên không cần khóa
+    def __init__(self, index, username, password, args, workdir):
+        self.index = index
+        self.username = username
+        self.password = password
+        self.args = args
+        self.workdir = workdir
+        self.rng = random.Random(args.seed + index)
+        self.client = None
+        self.templates = {}
+        self.uploaded = []  # (tên trên server, kích thước) để chọn tệp tin tải xuống
+        self.sequence = 0
+        self.latencies = {command: [] for command in COMMANDS + ('login',)}
+        self.errors = {command: 0 for command in COMMANDS + ('login',)}
+        self.bytes = 0
+
+    def login(self):
+        if self.client is not None:
+            self.client.close()
+        self.client = FileTransferClient(self.args.host, self.args.port)
+        self.client.connect()
+        self.client.login(self.username, self.password)
+
+    def prepare(self):
+        # Tạo tệp tin mẫu cho mỗi kích thước và tải lên một bản để lệnh download luôn có tệp tin
+        os.makedirs(self.workdir, exist_ok=True)
+        self.login()
+        for size, _ in self.args.sizes:
+            path = os.path.join(self.workdir, f'template-{size}.bin')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            self.templates[size] = path
+            self.upload(size)
+
+    def upload(self, size):
+        # Đổi 16 byte đầu để nội dung luôn mới (không bị khử trùng lặp thành tải lên tức thì)
+        # và đặt tên riêng cho mỗi lần tải lên để server không phải đổi tên
+        template = self.templates[size]
+        with open(template, 'r+b') as f:
+            f.write(os.urandom(min(16, size)))
+        self.sequence += 1
+        path = os.path.join(self.workdir, f'c{self.index}-{self.sequence}-{size}.bin')
+        os.replace(template, path)
+        try:
+            name = self.client.upload_file(path, streams=self.args.streams)
+        finally:
+            os.replace(path, template)
+        self.uploaded.append((name, size))
+        return size
+
+    def download(self):
+        name, size = self.rng.choice(self.uploaded)
+        self.client.download_file(name, os.path.join(self.workdir, 'download.bin'), streams=self.args.streams)
+        return size
+
+    def list(self):
+        self.client.list_files()
+        return 0
+
+    def run(self, deadline, operations=None):
+        commands = [command for command, _ in self.args.mix]
+        command_weights = [weight for _, weight in self.args.mix]
+        sizes = [size for size, _ in self.args.sizes]
+        size_weights = [weight for _, weight in self.args.sizes]
+        done = 0
+        while time.perf_counter() < deadline and (operations is None or done < operations):
+            command = self.rng.choices(commands, command_weights)[0]
+            start = time.perf_counter()
+            try:
+                if command == 'upload':
+                    nbytes = self.upload(self.rng.choices(sizes, size_weights)[0])
+                elif command == 'download':
+                    nbytes = self.download()
+                else:
+                    nbytes = self.list()
+                self.latencies[command].append(time.perf_counter() - start)
+                self.bytes += nbytes
+            except Exception:
+                self.errors[command] += 1
+                self.relogin()
+            done += 1
+            if self.args.churn and self.rng.random() < self.args.churn:
+                self.relogin()
+
+    def relogin(self):
+        start = time.perf_counter()
+        try:
+            self.login()
+            self.latencies['login'].append(time.perf_counter() - start)
+        except Exception:
+            self.errors['login'] += 1
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+def start_server(args, root, log_path):
+    # Chạy server trong tiến trình con để đo CPU/RSS của riêng server
+    # Server con ghi tệp tin ready khi đã nhận kết nối, kèm thời gian khởi động
+    ready_path = os.path.join(root, 'ready.json')
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(args.port), '--engine', args.engine,
+               '--ready-file', ready_path]
+    if args.no_sendfile:
+        command.append('--no-sendfile')
+    log = open(log_path, 'wb')
+    process = subprocess.Popen(command, cwd=root, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}, see {log_path}')
+        try:
+            with open(ready_path) as f:
+                args.startup_ms = json.load(f)['startup_ms']
+            return process
+        except (OSError, ValueError):
+            time.sleep(0.01)
+    process.kill()
+    raise RuntimeError(f'Server did not start within {args.startup_timeout}s, see {log_path}')
+
+def stop_server(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT if os.name != 'nt' else signal.SIGTERM)
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def serve(args):
+    # Chế độ nội bộ: tiến trình con chạy server trong thư mục hiện tại (thư mục tạm của benchmark)
+    from server import FileTransferServer
+    from log_pipeline import configure_logging
+    configure_logging()
+    # Benchmark chỉ chạy trên loopback, không tra IP public qua mạng
+    options = dict(use_sendfile=not args.no_sendfile, discover_public_ip=False, ready_file=args.ready_file)
+    if args.engine == 'asyncio':
+        from async_server import AsyncFileTransferServer
+        server = AsyncFileTransferServer(args.host, args.port, **options)
+    else:
+        server = FileTransferServer(args.host, args.port, **options)
+    server.start()
+
+def summarize(clients, wall, sampler, args):
+    operations = {}
+    total_ops = total_errors = 0
+    for command in COMMANDS + ('login',):
+        latencies = sorted(value for client in clients for value in client.latencies[command])
+        errors = sum(client.errors[command] for client in clients)
+        if not latencies and not errors:
+            continue
+        total_ops += len(latencies)
+        total_errors += errors
+        operations[command] = {
+            'count': len(latencies),
+            'errors': errors,
+            'ops_per_second': len(latencies) / wall if wall > 0 else None,
+            'latency_ms': {
+                'mean': sum(latencies) / len(latencies) * 1000 if latencies else None,
+                'p50': percentile(latencies, 50) * 1000 if latencies else None,
+                'p95': percentile(latencies, 95) * 1000 if latencies else None,
+                'p99': percentile(latencies, 99) * 1000 if latencies else None,
+                'max': latencies[-1] * 1000 if latencies else None,
+            },
+        }
+    total_bytes = sum(client.bytes for client in clients)
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'config': {
+            'engine': args.engine,
+            'sendfile': not args.no_sendfile,
+            'clients': args.clients,
+            'users': args.users,
+            'duration': args.duration,
+            'operations_per_client': args.operations,
+            'mix': {command: weight for command, weight in args.mix},
+            'sizes': {size: weight for size, weight in args.sizes},
+            'churn': args.churn,
+            'streams': args.streams,
+            'seed': args.seed,
+        },
+        'wall_seconds': wall,
+        'throughput': {
+            'ops_per_second': total_ops / wall if wall > 0 else None,
+            'bytes': total_bytes,
+            'megabytes_per_second': total_bytes / wall / (1024 * 1024) if wall > 0 else None,
+            'errors': total_errors,
+        },
+        'operations': operations,
+        'server': dict(sampler.summary(), startup_ms=args.startup_ms),
+    }
+
+def print_summary(result):
+    throughput = result['throughput']
+    print(f"{result['config']['engine']}: {throughput['ops_per_second']:.1f} ops/s, "
+          f"{throughput['megabytes_per_second']:.1f} MB/s, {throughput['errors']} errors in {result['wall_seconds']:.1f}s")
+    for command, stats in result['operations'].items():
+        latency = stats['latency_ms']
+        if stats['count']:
+            print(f"  {command:<9} {stats['count']:>7} ops  p50 {latency['p50']:8.2f} ms  "
+                  f"p95 {latency['p95']:8.2f} ms  p99 {latency['p99']:8.2f} ms  errors {stats['errors']}")
+        else:
+            print(f"  {command:<9} {stats['count']:>7} ops  errors {stats['errors']}")
+    server = result['server']
+    print(f"  server    ready after {server['startup_ms']:.1f} ms")
+    if server['cpu_seconds'] is not None:
+        print(f"  server    CPU {server['cpu_seconds']:.2f}s ({server['cpu_percent']:.0f}%), "
+              f"peak RSS {server['rss_peak_bytes'] / (1024 * 1024):.1f} MB")
+
+def run_benchmark(args):
+    output = os.path.abspath(args.output or f"benchmark_{args.engine}_{datetime.datetime.now().strftime('%d%m%Y_%H%M%S')}.json")
+    root = tempfile.mkdtemp(prefix='ftbench-')
+    args.port = args.port or free_port()
+    process = start_server(args, root, os.path.join(root, 'server.out'))
+    clients = []
+    try:
+        setup = FileTransferClient(args.host, args.port)
+        setup.connect()
+        for user in range(args.users):
+            setup.signup(f'bench{user}', 'bench')
+        setup.close()
+
+        clients = [LoadClient(index, f'bench{index % args.users}', 'bench', args, os.path.join(root, f'client{index}'))
+                   for index in range(args.clients)]
+        # Client in thông báo tiến độ ra stdout; tắt đi trong lúc đo để không ảnh hưởng kết quả
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            threads = [threading.Thread(target=client.prepare) for client in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            sampler = ProcessSampler(process.pid)
+            sampler.start()
+            start = time.perf_counter()
+            deadline = start + args.duration if args.duration else float('inf')
+            threads = [threading.Thread(target=client.run, args=(deadline, args.operations)) for client in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - start
+            sampler.stop()
+
+        result = summarize(clients, wall, sampler, args)
+    finally:
+        for client in clients:
+            client.close()
+        stop_server(process)
+        if args.keep:
+            print(f'Benchmark files kept in {root}')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print_summary(result)
+    print(f'Results written to {output}')
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-generation benchmark against a loopback file transfer server')
+    parser.add_argument('--engine', choices=['threading', 'asyncio'], default='threading')
+    parser.add_argument('--no-sendfile', action='store_true')
+    parser.add_argument('--clients', type=int, default=8, help='number of concurrent simulated clients')
+    parser.add_argument('--users', type=int, default=None, help='number of accounts shared by the clients (default: one per client)')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds of load (0: run --operations per client)')
+    parser.add_argument('--operations', type=int, default=None, help='operations per client')
+    parser.add_argument('--mix', type=parse_mix, default='upload=4,download=5,list=1',
+                        help='command weights, e.g. upload=4,download=5,list=1')
+    parser.add_argument('--sizes', type=parse_sizes, default='4K=60,256K=30,4M=10',
+                        help='file size distribution, e.g. 4K=60,256K=30,4M=10')
+    parser.add_argument('--churn', type=float, default=0.0, help='probability of logging out and back in after each operation')
+    parser.add_argument('--streams', type=int, default=1, help='parallel streams per transfer')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='server port (default: a free port)')
+    parser.add_argument('--startup-timeout', type=float, default=30.0)
+    parser.add_argument('--output', help='JSON result file')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary server directory')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--ready-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    if args.duration <= 0 and not args.operations:
+        parser.error('either --duration or --operations is required')
+    args.users = max(1, min(args.users or args.clients, args.clients))
+    run_benchmark(args)
+
+if __name__ == "__main__":
+    main()
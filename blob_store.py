@@ -0,0 +1,92 @@
+import os
+import re
+
+_CHECKSUM_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+class BlobStore:
+    # Kho nội dung đánh địa chỉ theo SHA-256. Tệp tin trong thư mục của người dùng là
+    # hard link tới blob nên nhiều người tải lên cùng một nội dung chỉ tốn một bản trên đĩa.
+    # Chỉ đưa vào kho các tệp tin không còn handler nào đang mở để ghi. Inode dùng chung vẫn
+    # có thể bị ghi tại chỗ ngoài ý muốn nên blob được kiểm tra lại (verify) trước khi một
+    # tệp tin vừa kiểm tra checksum bị thay bằng liên kết tới nó
+    def __init__(self, root='blob_storage'):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, checksum):
+        if not _CHECKSUM_PATTERN.fullmatch(checksum):
+            raise ValueError(f'Invalid checksum: {checksum!r}')
+        return os.path.join(self.root, checksum[:2], checksum[2:])
+
+    def lookup(self, checksum, size, verify=None):
+        # Trả về đường dẫn blob nếu đã có nội dung này với đúng kích thước.
+        # verify(blob, checksum): True nếu blob thật sự có checksum đó
+        try:
+            blob = self.path(checksum)
+            if os.path.getsize(blob) == size and (verify is None or verify(blob, checksum)):
+                return blob
+        except (ValueError, OSError):
+            pass
+        return None
+
+    def add(self, filepath, checksum, verify=None):
+        # Đưa tệp tin vừa nhận vào kho. Nếu nội dung đã có thì thay tệp tin bằng hard link
+        # tới blob cũ; trả về True khi đã loại bỏ được một bản trùng. Blob cũ không còn đúng
+        # nội dung thì tệp tin vừa nhận thay chỗ nó trong kho
+        blob = self.path(checksum)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(filepath, blob)
+            return False
+        except FileExistsError:
+            pass
+        except OSError:
+            return False  # Hệ thống tệp tin không hỗ trợ hard link, giữ nguyên bản sao
+        if os.path.samefile(filepath, blob):
+            return False
+        if self.lookup(checksum, os.path.getsize(filepath), verify) is None:
+            self._replace_blob(filepath, blob)
+            return False
+        temp_path = filepath + '.dedup'
+        try:
+            os.link(blob, temp_path)
+            os.replace(temp_path, filepath)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
+
+    def _replace_blob(self, filepath, blob):
+        temp_path = blob + '.new'
+        try:
+            os.link(filepath, temp_path)
+            os.replace(temp_path, blob)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def link(self, checksum, size, filepath, verify=None):
+        # Tạo filepath từ blob có sẵn mà không cần nhận dữ liệu; False nếu chưa có nội dung này
+        blob = self.lookup(checksum, size, verify)
+        if blob is None:
+            return False
+        try:
+            os.link(blob, filepath)
+        except OSError:
+            return False
+        return True
+
+    def purge_orphans(self):
+        # Blob chỉ còn một liên kết (chính nó) thì không còn tệp tin nào dùng tới
+        removed = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                blob = os.path.join(directory, name)
+                try:
+                    if os.stat(blob).st_nlink == 1:
+                        os.remove(blob)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
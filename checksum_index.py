@@ -0,0 +1,60 @@
+import os
+from database import get_database
+
+class ChecksumIndex:
+    # Lưu checksum SHA-256 của tệp tin theo khóa (path, size, mtime_ns, inode).
+    # Nếu tệp tin bị thay đổi thì stat sẽ khác và bản ghi cũ bị bỏ qua.
+    def __init__(self, db_file='users.db'):
+        self.db_file = db_file
+        self.database = get_database(db_file)
+        self._initialize_database()
+
+    def _initialize_database(self):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS file_checksums (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    checksum TEXT NOT NULL
+                )
+            """)
+            conn.commit()
+
+    def _key(self, file_path):
+        st = os.stat(file_path)
+        return os.path.abspath(file_path), st.st_size, st.st_mtime_ns, st.st_ino
+
+    def store(self, file_path, checksum):
+        path, size, mtime_ns, inode = self._key(file_path)
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO file_checksums (path, size, mtime_ns, inode, checksum)
+                VALUES (?, ?, ?, ?, ?)
+            """, (path, size, mtime_ns, inode, checksum))
+            conn.commit()
+
+    def lookup(self, file_path):
+        try:
+            path, size, mtime_ns, inode = self._key(file_path)
+        except OSError:
+            return None
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT checksum FROM file_checksums
+                WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?
+            """, (path, size, mtime_ns, inode))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    def remove(self, file_path):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM file_checksums WHERE path = ?
+            """, (os.path.abspath(file_path),))
+            conn.commit()
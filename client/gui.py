@@ -106,6 +106,20 @@ class FileTransferGUI:
         download_btn = ttk.Button(btn_frame, text="Tải Xuống", command=self.download_selected)
         download_btn.pack(side=tk.LEFT, padx=5)
 
+        sync_btn = ttk.Button(btn_frame, text="Đồng Bộ", command=self.sync_file)
+        sync_btn.pack(side=tk.LEFT, padx=5)
+
+        upload_dir_btn = ttk.Button(btn_frame, text="Tải Thư Mục Lên", command=self.upload_directory)
+        upload_dir_btn.pack(side=tk.LEFT, padx=5)
+
+        download_dir_btn = ttk.Button(btn_frame, text="Tải Thư Mục Xuống", command=self.download_selected_directory)
+        download_dir_btn.pack(side=tk.LEFT, padx=5)
+
+        # Số kết nối song song khi truyền tệp tin lớn
+        self.streams_var = tk.IntVar(value=1)
+        ttk.Spinbox(btn_frame, from_=1, to=16, width=4, textvariable=self.streams_var).pack(side=tk.RIGHT, padx=5)
+        ttk.Label(btn_frame, text="Số luồng:").pack(side=tk.RIGHT)
+
         # Thanh tiến trình
         self.progress_var = tk.DoubleVar()
         self.progress = ttk.Progressbar(self.main_frame, variable=self.progress_var, maximum=100)
@@ -162,24 +176,32 @@ class FileTransferGUI:
 
     def refresh_files(self):
         try:
-            files = self.client.list_files()
             for item in self.tree.get_children():
                 self.tree.delete(item)
-            for file_info in files:
-                # Giả sử máy chủ gửi "filename|size"
-                if '|' in file_info:
-                    name, size = file_info.split('|', 1)
-                    size = self.format_size(int(size))
-                    date = datetime.now().strftime("%Y-%m-%d %H:%M")
-                    self.tree.insert('', tk.END, values=(name, size, date))
-                else:
-                    name = file_info
-                    size = "-"
-                    date = "-"
-                    self.tree.insert('', tk.END, values=(name, size, date))
+            # LIST chạy trên kết nối riêng nên không chờ các lần truyền đang chạy
+            with self.client.session() as session:
+                if session.supports('list_page'):
+                    # Thêm từng trang vào Treeview ngay khi nhận được
+                    for page in session.iter_file_pages():
+                        for name, size, mtime_ns in page:
+                            date = datetime.fromtimestamp(mtime_ns / 1e9).strftime("%Y-%m-%d %H:%M")
+                            self.tree.insert('', tk.END, values=(name, self.format_size(size), date))
+                        self.tree.update_idletasks()
+                    return
+                files = session.list_files()
+            for name, size in files:
+                size = self.format_size(size)
+                date = datetime.now().strftime("%Y-%m-%d %H:%M")
+                self.tree.insert('', tk.END, values=(name, size, date))
         except Exception as e:
             messagebox.showerror("Lỗi", f"Không thể làm mới danh sách tệp tin: {str(e)}")
 
+    def get_streams(self):
+        try:
+            return max(1, self.streams_var.get())
+        except tk.TclError:
+            return 1
+
     def update_progress(self, value):
         self.progress_var.set(value)
 
@@ -197,7 +219,8 @@ class FileTransferGUI:
                 try:
                     self.status_var.set("Đang tải lên...")
                     original_filename = os.path.basename(filepath)
-                    returned_filename = self.client.upload_file(filepath, self.update_progress)
+                    with self.client.session() as session:
+                        returned_filename = session.upload_file(filepath, self.update_progress, self.get_streams())
                     if returned_filename != original_filename:
                         messagebox.showinfo("Thông báo", f"Tên tệp tin đã được thay đổi thành: {returned_filename}")
                     self.status_var.set("Tải lên thành công")
@@ -209,20 +232,86 @@ class FileTransferGUI:
             
             threading.Thread(target=upload, daemon=True).start()
 
+    def upload_directory(self):
+        dirpath = filedialog.askdirectory()
+        if dirpath:
+            def upload():
+                try:
+                    self.status_var.set("Đang tải lên thư mục...")
+                    with self.client.session() as session:
+                        dirname, failures = session.upload_directory(dirpath, self.update_progress)
+                    if failures:
+                        details = "\n".join(f"{relpath}: {error}" for relpath, error in failures[:20])
+                        messagebox.showwarning("Thông báo", f"{len(failures)} tệp tin trong {dirname} bị lỗi:\n{details}")
+                    self.status_var.set(f"Tải lên thư mục {dirname} thành công")
+                    self.refresh_files()
+                except Exception as e:
+                    messagebox.showerror("Lỗi Tải Lên", str(e))
+                finally:
+                    self.progress_var.set(0)
+
+            threading.Thread(target=upload, daemon=True).start()
+
+    def download_selected_directory(self):
+        # Tải thư mục cấp cao nhất chứa tệp tin đang chọn (tên dạng "thư mục/.../tệp tin")
+        selection = self.tree.selection()
+        name = str(self.tree.item(selection[0])['values'][0]) if selection else ''
+        if '/' not in name:
+            messagebox.showwarning("Cần Chọn Thư Mục", "Vui lòng chọn một tệp tin nằm trong thư mục để tải cả thư mục")
+            return
+
+        dirname = name.split('/')[0]
+        parent = filedialog.askdirectory()
+        if parent:
+            def download():
+                try:
+                    self.status_var.set("Đang tải xuống thư mục...")
+                    with self.client.session() as session:
+                        failures = session.download_directory(dirname, os.path.join(parent, dirname), self.update_progress)
+                    if failures:
+                        details = "\n".join(f"{relpath}: {error}" for relpath, error in failures[:20])
+                        messagebox.showwarning("Thông báo", f"{len(failures)} tệp tin bị lỗi:\n{details}")
+                    self.status_var.set("Tải xuống thư mục thành công")
+                except Exception as e:
+                    messagebox.showerror("Lỗi Tải Xuống", str(e))
+                finally:
+                    self.progress_var.set(0)
+
+            threading.Thread(target=download, daemon=True).start()
+
+    def sync_file(self):
+        # Cập nhật tệp tin đã có trên server, chỉ gửi phần thay đổi
+        filepath = filedialog.askopenfilename()
+        if filepath:
+            def sync():
+                try:
+                    self.status_var.set("Đang đồng bộ...")
+                    with self.client.session() as session:
+                        session.sync_file(filepath, self.update_progress)
+                    self.status_var.set("Đồng bộ thành công")
+                    self.refresh_files()
+                except Exception as e:
+                    messagebox.showerror("Lỗi Đồng Bộ", str(e))
+                finally:
+                    self.progress_var.set(0)
+
+            threading.Thread(target=sync, daemon=True).start()
+
     def download_selected(self):
         selection = self.tree.selection()
         if not selection:
             messagebox.showwarning("Cần Chọn Tệp Tin", "Vui lòng chọn một tệp tin để tải xuống")
             return
 
-        filename = self.tree.item(selection[0])['values'][0]
-        save_path = filedialog.asksaveasfilename(defaultextension="", initialfile=filename)
+        filename = str(self.tree.item(selection[0])['values'][0])
+        save_path = filedialog.asksaveasfilename(defaultextension="", initialfile=os.path.basename(filename))
         
         if save_path:
             def download():
                 try:
                     self.status_var.set("Đang tải xuống...")
-                    self.client.download_file(filename, save_path, self.update_progress)
+                    with self.client.session() as session:
+                        session.download_file(filename, save_path, self.update_progress, self.get_streams())
                     self.status_var.set("Tải xuống thành công")
                 except Exception as e:
                     messagebox.showerror("Lỗi Tải Xuống", str(e))
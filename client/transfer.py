@@ -1,14 +1,112 @@
 import os
 import socket
+import select
 import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from protocol import Channel, SUPPORTED_VERSIONS, PROTOCOL_V1, DATA_FRAME_SIZE, parse_v1_file_list, write_at
+from compression import SAMPLE_SIZE, available_codecs, choose_codec, compress, decompress, describe_ratio
+from delta import SIGNATURE_ENTRY, generate_delta, parse_signature
+from archive import member_path, walk_tree
+
+class ConnectionLost(Exception):
+    # Kết nối bị đứt giữa chừng, có thể kết nối lại và tải tiếp
+    pass
+
+class TransferProgress:
+    # Cộng dồn tiến độ từ nhiều luồng truyền song song
+    def __init__(self, total, callback=None):
+        self.total = total
+        self.callback = callback
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.done += n
+            percent = (self.done / self.total) * 100 if self.total else 100
+        if self.callback:
+            self.callback(percent)
+
+class SessionPool:
+    # Giữ các kết nối đã đăng nhập để dùng lại giữa các thao tác. Mỗi thao tác mượn riêng một
+    # kết nối nên byte của các lần truyền chạy song song không bị trộn trên cùng một socket.
+    # Tối đa max_size kết nối được mượn cùng lúc; kết nối rảnh quá idle_timeout giây bị đóng
+    def __init__(self, factory, max_size=8, idle_timeout=60.0):
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.idle = []  # (thời điểm trả lại, kết nối), kết nối mới trả nằm cuối danh sách
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if self.closed:
+                        raise Exception("Pool kết nối đã đóng")
+                    self.evict_expired()
+                    session = self.idle.pop()[1] if self.idle else None
+                if session is None:
+                    return self.factory()
+                if session.is_alive():
+                    return session
+                session.close()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, session, reusable=True):
+        try:
+            with self.lock:
+                if reusable and not self.closed and session.is_connected:
+                    self.idle.append((time.monotonic(), session))
+                    session = None
+                self.evict_expired()
+            if session is not None:
+                session.close()
+        finally:
+            self.slots.release()
+
+    def evict_expired(self):
+        # Gọi khi đang giữ lock
+        deadline = time.monotonic() - self.idle_timeout
+        while self.idle and self.idle[0][0] < deadline:
+            self.idle.pop(0)[1].close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for _, session in idle:
+            session.close()
 
 class FileTransferClient:
     def __init__(self, host='localhost', port=8386):
         self.host = host
         self.port = port
         self.socket = None
-        self.BUFFER_SIZE = 4096  # Kích thước buffer để nhận dữ liệu
-        self.PROTOCOL_VERSION = "1.0"
+        self.channel = None
+        self.BUFFER_SIZE = 64 * 1024  # Kích thước buffer để nhận dữ liệu
+        self.PROTOCOL_VERSIONS = SUPPORTED_VERSIONS  # Thử lần lượt, ưu tiên phiên bản mới nhất
+        self.protocol_version = None
+        self.capabilities = set()
+        self.MIN_STREAM_SIZE = 4 * 1024 * 1024  # Mỗi luồng song song nhận ít nhất 4 MB
+        self.MAX_RESUME_ATTEMPTS = 3  # Số lần tự kết nối lại khi truyền bị đứt
+        self.COMPRESSION_CODECS = available_codecs()  # Đặt [] để tắt nén khi truyền
+        self.SMALL_FILE_SIZE = 1024 * 1024  # Tệp tin nhỏ hơn được gửi kèm header trong một lần
+        self.BATCH_SIZE = 500  # Số tệp tin tối đa trong một UPLOAD_BATCH
+        self.MAX_SESSIONS = 8  # Số kết nối phụ tối đa được mượn cùng lúc từ pool
+        self.SESSION_IDLE_TIMEOUT = 60.0  # Kết nối phụ rảnh quá số giây này thì bị đóng
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.username = None
+        self.password = None
         self.is_connected = False
         self.shutdown_callback = None
 
@@ -24,26 +122,46 @@ class FileTransferClient:
         
     def connect(self):
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.host, self.port))
-            # Gửi phiên bản giao thức
-            self.send_message(f"VERSION {self.PROTOCOL_VERSION}")
-            response = self.receive_message()
-            if response != "VERSION_OK":
-                raise Exception("Phiên bản giao thức không khớp")
-            self.is_connected = True
-            return True
+            for version in self.PROTOCOL_VERSIONS:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket.connect((self.host, self.port))
+                self.channel = Channel(self.socket)
+                # Gửi phiên bản giao thức, server cũ sẽ trả VERSION_ERROR và đóng kết nối
+                self.send_message("VERSION", version)
+                response = self.receive_message()
+                if response and response[0] == "VERSION_OK":
+                    self.channel.version = version
+                    self.protocol_version = version
+                    self.capabilities = set(response[1:])
+                    self.is_connected = True
+                    return True
+                self.socket.close()
+                if response and response[0] == "SERVER_BUSY":
+                    raise Exception(self.error_text(response))
+            raise Exception("Phiên bản giao thức không khớp")
         except Exception as e:
             self.is_connected = False
             raise Exception(f"Lỗi kết nối: {str(e)}")
 
-    def send_message(self, message):
+    def reconnect(self):
+        self.close()
+        self.connect()
+        if self.username is not None:
+            self.login(self.username, self.password)
+
+    def send_message(self, *fields):
         try:
-            message = f"{message}\n"
-            self.socket.sendall(message.encode())
+            self.channel.send_message(*fields)
+        except OSError as e:
+            raise ConnectionLost(f"Lỗi gửi tin nhắn: {str(e)}")
         except Exception as e:
             raise Exception(f"Lỗi gửi tin nhắn: {str(e)}")
 
+    def error_text(self, response):
+        if len(response) > 1:
+            return response[1]
+        return response[0] if response else "Mất kết nối tới server"
+
     def handle_server_shutdown(self):
         print('\nServer đã ngắt kết nối')
         self.is_connected = False
@@ -53,43 +171,98 @@ class FileTransferClient:
 
     def receive_message(self):
         try:
-            data = ''
-            while not data.endswith('\n'):
-                packet = self.socket.recv(self.BUFFER_SIZE).decode()
-                if not packet:
-                    break
-                data += packet
-            message =  data.strip()
+            message = self.channel.receive_message()
 
-            if message == "SERVER_SHUTDOWN":
+            if message == ["SERVER_SHUTDOWN"]:
                 self.handle_server_shutdown()
                 raise Exception("Server đã ngắt kết nối")
+            if not message:
+                raise ConnectionLost("Lỗi nhận tin nhắn: Mất kết nối tới server")
             return message
+        except ConnectionLost:
+            raise
+        except OSError as e:
+            raise ConnectionLost(f"Lỗi nhận tin nhắn: {str(e)}")
         except Exception as e:
             raise Exception(f"Lỗi nhận tin nhắn: {str(e)}")
     def signup(self, username, password):
         try:
-            self.send_message(f"SIGNUP|{username}|{password}")
+            self.send_message("SIGNUP", username, password)
             response = self.receive_message()
-            if response.startswith("SUCCESS"):
+            if response and response[0] == "SUCCESS":
                 return True
             else:
-                raise Exception(response.split('|', 1)[1] if '|' in response else response)
+                raise Exception(self.error_text(response))
         except Exception as e:
             raise Exception(f"Lỗi đăng ký: {str(e)}")
     def login(self, username, password):
         try:
             # Gửi thông tin đăng nhập
-            self.send_message(f"LOGIN|{username}|{password}")
+            self.send_message("LOGIN", username, password)
             response = self.receive_message()
-            if response.startswith("SUCCESS"):
+            if response and response[0] == "SUCCESS":
+                # Giữ thông tin đăng nhập để mở thêm kết nối khi truyền song song
+                self.username, self.password = username, password
                 return True
             else:
-                raise Exception(response.split('|', 1)[1] if '|' in response else response)
+                raise Exception(self.error_text(response))
         except Exception as e:
             raise Exception(f"Lỗi đăng nhập: {str(e)}")
 
-    def upload_file(self, filepath, progress_callback=None):
+    def supports(self, capability):
+        return capability in self.capabilities
+
+    def accepted_codecs(self):
+        # Các kiểu nén mà cả client và server đều hỗ trợ, theo thứ tự ưu tiên của client
+        return [codec for codec in self.COMPRESSION_CODECS if self.supports(f'compress:{codec}')]
+
+    def open_session(self):
+        # Mở một kết nối mới tới cùng server và đăng nhập bằng tài khoản hiện tại
+        session = FileTransferClient(self.host, self.port)
+        session.PROTOCOL_VERSIONS = (self.protocol_version,)
+        session.BUFFER_SIZE = self.BUFFER_SIZE
+        session.COMPRESSION_CODECS = self.COMPRESSION_CODECS
+        session.connect()
+        try:
+            session.login(self.username, self.password)
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    @contextmanager
+    def session(self):
+        # Mượn một kết nối đã đăng nhập riêng cho một thao tác (tải lên, tải xuống, LIST...) để
+        # nhiều thao tác chạy song song từ các luồng khác nhau. Kết nối gặp lỗi giữa chừng có
+        # thể còn dữ liệu dở trên socket nên bị đóng thay vì trả lại pool
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = SessionPool(self.open_session, self.MAX_SESSIONS, self.SESSION_IDLE_TIMEOUT)
+            pool = self.pool
+        session = pool.acquire()
+        try:
+            yield session
+        except BaseException:
+            pool.release(session, reusable=False)
+            raise
+        pool.release(session)
+
+    def is_alive(self):
+        # Kết nối đang rảnh mà có dữ liệu để đọc nghĩa là server đã đóng hoặc gửi SERVER_SHUTDOWN
+        if not self.is_connected or self.socket is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable and not self.channel.reader.buffered()
+
+    def split_ranges(self, size, streams):
+        streams = max(1, min(streams, size // self.MIN_STREAM_SIZE))
+        step = -(-size // streams)
+        return [(offset, min(step, size - offset)) for offset in range(0, size, step)]
+
+    def upload_file(self, filepath, progress_callback=None, streams=1):
         try:
             if not os.path.exists(filepath):
                 raise Exception("Không tìm thấy tệp tin")
@@ -97,27 +270,34 @@ class FileTransferClient:
             filename = os.path.basename(filepath)
             filesize = os.path.getsize(filepath)
 
+            if streams > 1 and self.supports('parallel') and len(self.split_ranges(filesize, streams)) > 1:
+                return self.upload_file_parallel(filepath, filename, filesize, progress_callback, streams)
+            if self.supports('batch') and filesize <= self.SMALL_FILE_SIZE:
+                return self.upload_file_single(filepath, filename, progress_callback)
+            if self.supports('resume'):
+                return self.upload_file_resumable(filepath, filename, filesize, progress_callback)
+
             # Gửi lệnh tải lên
-            self.send_message(f"UPLOAD {filename}")
+            self.send_message("UPLOAD", filename)
             response = self.receive_message()
 
-            if response.startswith('NEW_FILENAME|'):
-                new_filename = response.split('|', 1)[1]
+            if response and response[0] == 'NEW_FILENAME':
+                new_filename = response[1]
                 print(f"\nTên tệp tin đã được thay đổi thành: {new_filename}")
                 filename = new_filename
-            elif response != "FILENAME_OK":
-                raise Exception(f"Không hợp lệ tên tệp tin: {response}")
+            elif response != ["FILENAME_OK"]:
+                raise Exception(f"Không hợp lệ tên tệp tin: {self.error_text(response)}")
 
             # Gửi kích thước tệp tin
-            self.send_message(str(filesize))
+            self.send_message("SIZE", filesize)
             response = self.receive_message()
-            if response != "READY":
-                raise Exception(f"Máy chủ không sẵn sàng: {response}")
+            if response != ["READY"]:
+                raise Exception(f"Máy chủ không sẵn sàng: {self.error_text(response)}")
             
-            self.send_message("CHECKSUM:" + self.generate_file_checksum(filepath))
+            self.send_message("CHECKSUM", self.generate_file_checksum(filepath))
             response = self.receive_message()
-            if response != "CHECKSUM_OK":
-                raise Exception(f"Gửi checksum thất bại: {response}")
+            if response != ["CHECKSUM_OK"]:
+                raise Exception(f"Gửi checksum thất bại: {self.error_text(response)}")
 
             # Gửi dữ liệu tệp tin
             sent = 0
@@ -126,7 +306,7 @@ class FileTransferClient:
                     data = f.read(self.BUFFER_SIZE)
                     if not data:
                         break
-                    self.socket.sendall(data)
+                    self.channel.send_data(data)
                     sent += len(data)
                     if progress_callback:
                         progress_callback((sent / filesize) * 100)
@@ -135,47 +315,320 @@ class FileTransferClient:
             response = self.receive_message()
 
             return filename
-            if response != "SUCCESS":
-                raise Exception(f"Tải lên thất bại: {response}")
+            if response != ["SUCCESS"]:
+                raise Exception(f"Tải lên thất bại: {self.error_text(response)}")
 
         except Exception as e:
             raise Exception(f"Lỗi tải lên: {str(e)}")
 
-    def download_file(self, filename, save_path, progress_callback=None):
+    def upload_file_single(self, filepath, filename, progress_callback):
+        # Tên, kích thước và checksum đi chung một message, dữ liệu gửi ngay sau đó
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        progress = TransferProgress(len(data), progress_callback)
+        self.send_upload(filename, data, progress, "UPLOAD_FILE")
+        response = self.receive_message()
+        if response[0] != "SUCCESS":
+            raise Exception(f"Tải lên thất bại: {self.error_text(response)}")
+        new_filename = response[1]
+        if new_filename != filename:
+            print(f"\nTên tệp tin đã được thay đổi thành: {new_filename}")
+        return new_filename
+
+    def send_upload(self, filename, data, progress, command):
+        self.send_message(command, filename, len(data), hashlib.sha256(data).hexdigest())
+        for start in range(0, len(data), DATA_FRAME_SIZE):
+            self.channel.send_data(data[start:start + DATA_FRAME_SIZE])
+        progress.add(len(data))
+
+    def upload_files(self, filepaths, progress_callback=None, streams=1):
+        # Tải lên nhiều tệp tin: tệp tin nhỏ được gửi liền nhau trong UPLOAD_BATCH, tệp tin lớn
+        # tải lên từng cái. Trả về danh sách (đường dẫn, tên đã lưu hoặc None, lỗi hoặc None)
+        results = []
+        small, large = [], []
+        for filepath in filepaths:
+            if self.supports('batch') and os.path.isfile(filepath) and os.path.getsize(filepath) <= self.SMALL_FILE_SIZE:
+                small.append(filepath)
+            else:
+                large.append(filepath)
+        progress = TransferProgress(sum(os.path.getsize(p) for p in small), progress_callback)
+        for start in range(0, len(small), self.BATCH_SIZE):
+            try:
+                results.extend(self.upload_batch(small[start:start + self.BATCH_SIZE], progress))
+            except Exception as e:
+                raise Exception(f"Lỗi tải lên: {str(e)}")
+        for filepath in large:
+            try:
+                results.append((filepath, self.upload_file(filepath, progress_callback, streams), None))
+            except Exception as e:
+                results.append((filepath, None, str(e)))
+        return results
+
+    def upload_batch(self, filepaths, progress):
+        self.send_message("UPLOAD_BATCH", len(filepaths))
+        for filepath in filepaths:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            self.send_upload(os.path.basename(filepath), data, progress, "FILE")
+
+        results = []
+        for filepath in filepaths:
+            response = self.receive_message()
+            if response[0] != "RESULT":
+                raise Exception(f"Tải lên thất bại: {self.error_text(response)}")
+            if response[2] == "SUCCESS":
+                results.append((filepath, response[3], None))
+            else:
+                results.append((filepath, None, response[3] if len(response) > 3 else ''))
+        return results
+
+    def upload_directory(self, dirpath, progress_callback=None):
+        # Tải lên cả thư mục trong một luồng, giữ nguyên cấu trúc thư mục con.
+        # Trả về (tên thư mục trên server, danh sách (đường dẫn tương đối, lỗi) của các tệp tin lỗi)
         try:
-            self.send_message(f"DOWNLOAD {filename}")
+            if not os.path.isdir(dirpath):
+                raise Exception("Không tìm thấy thư mục")
+            if not self.supports('archive'):
+                raise Exception("Server không hỗ trợ tải lên thư mục")
+            entries = list(walk_tree(dirpath))
+            progress = TransferProgress(sum(entry[3] for entry in entries if entry[0] == 'FILE'), progress_callback)
+
+            self.send_message("UPLOAD_DIR", os.path.basename(os.path.abspath(dirpath)))
             response = self.receive_message()
-            file_size = 0
+            if response[0] != "READY":
+                raise Exception(self.error_text(response))
+            dirname = response[1]
 
-            if response == "FILE_NOT_FOUND":
-                raise Exception("Không tìm thấy tệp tin trên máy chủ")
-            
+            failures = []
+            for entry in entries:
+                if entry[0] == 'DIR':
+                    self.send_message("DIR", entry[1])
+                    continue
+                _, relpath, path, _ = entry
+                try:
+                    f = open(path, 'rb')
+                except OSError as e:
+                    failures.append((relpath, str(e)))
+                    continue
+                with f:
+                    self.send_member(relpath, f, progress)
+
+            self.send_message("END")
+            while True:
+                response = self.receive_message()
+                if response[0] == "FAILED":
+                    failures.append((response[1], response[2]))
+                elif response[0] == "SUCCESS":
+                    return dirname, failures
+                else:
+                    raise Exception(self.error_text(response))
+        except Exception as e:
+            raise Exception(f"Lỗi tải lên thư mục: {str(e)}")
+
+    def send_member(self, relpath, f, progress):
+        # Checksum được tính trong lúc gửi và đi sau dữ liệu. Nếu tệp tin bị cắt ngắn giữa chừng
+        # thì bù byte 0 cho đủ kích thước đã báo, server sẽ chỉ từ chối tệp tin này
+        size = os.fstat(f.fileno()).st_size
+        self.send_message("MEMBER", relpath, size)
+        sha256_hash = hashlib.sha256()
+        sent = 0
+        while sent < size:
+            chunk = min(DATA_FRAME_SIZE, size - sent)
+            data = f.read(chunk)
+            sha256_hash.update(data)
+            if len(data) < chunk:
+                data += bytes(chunk - len(data))
+            self.channel.send_data(data)
+            sent += chunk
+            progress.add(chunk)
+        self.send_message("MEMBER_END", sha256_hash.hexdigest())
+
+    def upload_file_resumable(self, filepath, filename, filesize, progress_callback):
+        # Server giữ phần đã nhận theo transfer ID; khi mất kết nối thì kết nối lại,
+        # hỏi server đã có bao nhiêu byte và gửi tiếp từ đó
+        checksum = self.generate_file_checksum(filepath)
+        attempts = 0
+        while True:
             try:
-                file_size = int(response)
-            except ValueError:
-                raise Exception(f"Kích thước tệp tin không hợp lệ: {response}")
+                self.send_message("UPLOAD_RESUME", filename, filesize, checksum)
+                response = self.receive_message()
+                if response[0] == "SUCCESS":
+                    return self.finish_instant_upload(filename, filesize, response, progress_callback)
+                if response[0] != "OFFSET":
+                    raise Exception(f"Máy chủ từ chối tải lên: {self.error_text(response)}")
+                transfer_id, offset = response[1], int(response[2])
+                if offset:
+                    print(f"\nTiếp tục tải lên từ byte {offset}")
 
-            # Gửi READY để nhận tệp tin
-            self.send_message("READY")
-            
-            checksum_msg = self.receive_message()
-            checksum = ""
-            if checksum_msg.startswith("CHECKSUM:"):
-                checksum = checksum_msg.split(':')[1]
-                self.send_message("CHECKSUM_OK")
-            else:
-                raise Exception(f"Checksum không hợp lệ: {checksum_msg}")
-            
+                with open(filepath, 'rb') as f:
+                    f.seek(offset)
+                    codec = choose_codec(filename, f.read(SAMPLE_SIZE), self.accepted_codecs())
+                self.send_message("UPLOAD_APPEND", transfer_id, offset, *([codec] if codec else []))
+                response = self.receive_message()
+                if response != ["READY"]:
+                    raise Exception(f"Máy chủ không sẵn sàng: {self.error_text(response)}")
+                progress = TransferProgress(filesize, progress_callback)
+                progress.add(offset)
+                self.send_file_range(self.channel, filepath, offset, filesize - offset, progress, codec)
+
+                response = self.receive_message()
+                if response[0] != "SUCCESS":
+                    raise Exception(f"Tải lên thất bại: {self.error_text(response)}")
+                new_filename = response[1] if len(response) > 1 else filename
+                if new_filename != filename:
+                    print(f"\nTên tệp tin đã được thay đổi thành: {new_filename}")
+                return new_filename
+            except (ConnectionLost, OSError):
+                attempts += 1
+                if attempts > self.MAX_RESUME_ATTEMPTS:
+                    raise
+                time.sleep(attempts)
+                try:
+                    self.reconnect()
+                except Exception:
+                    pass
+
+    def sync_file(self, filepath, progress_callback=None):
+        # Cập nhật tệp tin cùng tên đã có trên server, chỉ gửi những vùng đã thay đổi.
+        # Nếu server chưa có tệp tin này thì tải lên bình thường
+        try:
+            if not self.supports('delta'):
+                return self.upload_file(filepath, progress_callback)
+            filesize = os.path.getsize(filepath)
+            filename = os.path.basename(filepath)
+            self.send_message("UPLOAD_DELTA", filename, filesize, self.generate_file_checksum(filepath))
+            response = self.receive_message()
+            if response == ["NO_BASE"]:
+                return self.upload_file(filepath, progress_callback)
+            if response[0] == "SUCCESS":
+                return self.finish_instant_upload(filename, filesize, response, progress_callback)
+            if response[0] != "SIGNATURE":
+                raise Exception(f"Máy chủ từ chối đồng bộ: {self.error_text(response)}")
+            block_size, base_size = int(response[1]), int(response[2])
+
+            signature = bytearray(-(-base_size // block_size) * SIGNATURE_ENTRY.size)
+            view = memoryview(signature)
             received = 0
+            while received < len(signature):
+                n = self.channel.receive_data_into(view[received:])
+                if not n:
+                    raise ConnectionLost("Mất kết nối khi nhận chữ ký tệp tin")
+                received += n
+
+            progress = TransferProgress(filesize, progress_callback)
+            literal_bytes = 0
+            with open(filepath, 'rb') as f:
+                for op in generate_delta(f, parse_signature(signature), block_size, base_size):
+                    if op[0] == 'COPY':
+                        self.send_message("COPY", op[1], op[2])
+                        progress.add(min(op[2] * block_size, base_size - op[1] * block_size))
+                    else:
+                        self.send_message("LITERAL", len(op[1]))
+                        self.channel.send_data(op[1])
+                        literal_bytes += len(op[1])
+                        progress.add(len(op[1]))
+            self.send_message("END")
+
+            response = self.receive_message()
+            if response[0] != "SUCCESS":
+                raise Exception(f"Đồng bộ thất bại: {self.error_text(response)}")
+            print(f"\nĐã gửi {literal_bytes}/{filesize} bytes thay đổi")
+            return response[1]
+        except Exception as e:
+            raise Exception(f"Lỗi đồng bộ: {str(e)}")
+
+    def finish_instant_upload(self, filename, filesize, response, progress_callback):
+        # Server đã có nội dung giống hệt nên không cần gửi byte nào
+        TransferProgress(filesize, progress_callback).add(filesize)
+        new_filename = response[1] if len(response) > 1 else filename
+        if new_filename != filename:
+            print(f"\nTên tệp tin đã được thay đổi thành: {new_filename}")
+        return new_filename
+
+    def send_file_range(self, channel, filepath, offset, length, progress, codec=None):
+        # Khi nén, mỗi khối DATA_FRAME_SIZE byte được nén thành một frame riêng
+        chunk_size = DATA_FRAME_SIZE if codec else self.BUFFER_SIZE
+        wire_bytes = 0
+        with open(filepath, 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    raise Exception("Tệp tin bị thay đổi trong khi tải lên")
+                frame = compress(codec, data) if codec else data
+                channel.send_data(frame)
+                wire_bytes += len(frame)
+                remaining -= len(data)
+                progress.add(len(data))
+        if codec:
+            print(f"\nNén {describe_ratio(codec, length, wire_bytes)}")
+
+    def upload_file_parallel(self, filepath, filename, filesize, progress_callback, streams):
+        self.send_message("UPLOAD_PARALLEL", filename, filesize, self.generate_file_checksum(filepath))
+        response = self.receive_message()
+        if response[0] == "SUCCESS":
+            return self.finish_instant_upload(filename, filesize, response, progress_callback)
+        if response[0] != "TRANSFER":
+            raise Exception(f"Máy chủ từ chối tải lên song song: {self.error_text(response)}")
+        transfer_id = response[1]
+
+        ranges = self.split_ranges(filesize, streams)
+        progress = TransferProgress(filesize, progress_callback)
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(self.upload_range, filepath, transfer_id, offset, length, progress)
+                       for offset, length in ranges]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(e)
+
+        # Luôn gửi UPLOAD_COMMIT để server kiểm tra checksum hoặc dọn tệp tin dở dang
+        self.send_message("UPLOAD_COMMIT", transfer_id)
+        response = self.receive_message()
+        if errors:
+            raise errors[0]
+        if not response or response[0] != "SUCCESS":
+            raise Exception(f"Tải lên thất bại: {self.error_text(response)}")
+        # Server chỉ chọn tên trong thư mục lưu trữ khi commit
+        new_filename = response[1] if len(response) > 1 else filename
+        if new_filename != filename:
+            print(f"\nTên tệp tin đã được thay đổi thành: {new_filename}")
+        return new_filename
+
+    def upload_range(self, filepath, transfer_id, offset, length, progress):
+        with self.session() as session:
+            session.send_message("UPLOAD_RANGE", transfer_id, offset, length)
+            response = session.receive_message()
+            if response != ["READY"]:
+                raise Exception(f"Máy chủ không sẵn sàng: {session.error_text(response)}")
+            self.send_file_range(session.channel, filepath, offset, length, progress)
+            response = session.receive_message()
+            if response != ["SUCCESS"]:
+                raise Exception(f"Tải lên đoạn {offset} thất bại: {session.error_text(response)}")
+
+    def download_file(self, filename, save_path, progress_callback=None, streams=1, offset=0, length=None):
+        # offset/length khác mặc định: chỉ tải một đoạn của tệp tin (offset âm tính từ cuối)
+        try:
+            if offset or length is not None:
+                if not self.supports('resume'):
+                    raise Exception("Server không hỗ trợ tải một phần tệp tin")
+                return self.download_part(filename, save_path, offset, length, progress_callback)
+
+            if streams > 1 and self.supports('parallel'):
+                file_size, checksum = self.file_info(filename)
+                if len(self.split_ranges(file_size, streams)) > 1:
+                    return self.download_file_parallel(filename, save_path, progress_callback,
+                                                       streams, file_size, checksum)
+
+            if self.supports('resume'):
+                return self.download_file_resumable(filename, save_path, progress_callback)
+
+            file_size, checksum, codec = self.request_download(filename)
             with open(save_path, 'wb') as f:
-                while received < file_size:
-                    data = self.socket.recv(min(self.BUFFER_SIZE, file_size - received))
-                    if not data:
-                        break
-                    f.write(data)
-                    received += len(data)
-                    if progress_callback:
-                        progress_callback((received / file_size) * 100)
+                self.receive_payload(f, file_size, TransferProgress(file_size, progress_callback), codec)
                 f.flush()
                 os.fsync(f.fileno())
                         
@@ -186,26 +639,388 @@ class FileTransferClient:
                 raise Exception(f'''Checksum không khớp\n checksum: {checksum}\n checksum tính toán: {self.generate_file_checksum(save_path)}''')
             # Đợi phản hồi xác nhận thành công
             response = self.receive_message()
-            if response != "SUCCESS":
-                raise Exception(f"Tải xuống thất bại: {response}")
+            if response != ["SUCCESS"]:
+                raise Exception(f"Tải xuống thất bại: {self.error_text(response)}")
 
         except Exception as e:
             raise Exception(f"Lỗi tải xuống: {str(e)}")
 
+    def request_download(self, filename, offset=0, length=None):
+        # Gửi DOWNLOAD và hoàn tất bắt tay, trả về (số byte sẽ nhận, checksum của cả tệp tin,
+        # kiểu nén server đã chọn hoặc None)
+        fields = ["DOWNLOAD", filename]
+        if offset or length is not None:
+            fields.append(offset)
+        if length is not None:
+            fields.append(length)
+        self.send_message(*fields)
+        response = self.receive_message()
+
+        if response == ["FILE_NOT_FOUND"]:
+            raise Exception("Không tìm thấy tệp tin trên máy chủ")
+        
+        try:
+            file_size = int(response[1])
+        except (IndexError, ValueError):
+            raise Exception(f"Kích thước tệp tin không hợp lệ: {self.error_text(response)}")
+
+        # Gửi READY (kèm các kiểu nén nhận được) để nhận tệp tin
+        self.send_message("READY", *self.accepted_codecs())
+        
+        checksum_msg = self.receive_message()
+        if checksum_msg[0] == "CHECKSUM":
+            checksum = checksum_msg[1]
+            codec = checksum_msg[2] if len(checksum_msg) > 2 else None
+            self.send_message("CHECKSUM_OK")
+        else:
+            raise Exception(f"Checksum không hợp lệ: {self.error_text(checksum_msg)}")
+        return file_size, checksum, codec
+
+    def receive_payload(self, f, size, progress, codec=None):
+        if codec:
+            return self.receive_compressed_payload(f, size, progress, codec)
+        received = 0
+        buffer = memoryview(bytearray(self.BUFFER_SIZE))
+        while received < size:
+            n = self.channel.receive_data_into(buffer[:min(self.BUFFER_SIZE, size - received)])
+            if not n:
+                raise ConnectionLost("Mất kết nối khi đang tải xuống")
+            f.write(buffer[:n])
+            received += n
+            progress.add(n)
+        return received
+
+    def receive_compressed_payload(self, f, size, progress, codec):
+        received = wire_bytes = 0
+        while received < size:
+            frame = self.channel.receive_data_frame()
+            if frame is None:
+                raise ConnectionLost("Mất kết nối khi đang tải xuống")
+            data = decompress(codec, frame, min(DATA_FRAME_SIZE, size - received))
+            f.write(data)
+            received += len(data)
+            wire_bytes += len(frame)
+            progress.add(len(data))
+        print(f"\nNén {describe_ratio(codec, size, wire_bytes)}")
+        return received
+
+    def file_info(self, filename):
+        # Trả về (kích thước, checksum) của tệp tin trên server
+        self.send_message("DOWNLOAD_INFO", filename)
+        response = self.receive_message()
+        if response == ["FILE_NOT_FOUND"]:
+            raise Exception("Không tìm thấy tệp tin trên máy chủ")
+        if not response or response[0] != "FILE_INFO":
+            raise Exception(f"Không lấy được thông tin tệp tin: {self.error_text(response)}")
+        return int(response[1]), response[2]
+
+    def download_file_resumable(self, filename, save_path, progress_callback):
+        # Tải vào "<save_path>.part"; nếu tệp tin này đã có sẵn thì chỉ xin phần còn thiếu.
+        # "<save_path>.part.meta" giữ checksum của tệp tin trên server lúc bắt đầu tải, phần đã
+        # tải của một phiên bản khác bị bỏ trước khi xin offset
+        part_path = save_path + '.part'
+        meta_path = part_path + '.meta'
+        attempts = 0
+        restarted = False
+        while True:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            try:
+                if offset and self.read_part_checksum(meta_path) != self.file_info(filename)[1]:
+                    self.discard_part(part_path)
+                    offset = 0
+                remaining, checksum, codec = self.request_download(filename, offset)
+                if not offset:
+                    with open(meta_path, 'w') as f:
+                        f.write(checksum)
+                progress = TransferProgress(offset + remaining, progress_callback)
+                progress.add(offset)
+                with open(part_path, 'ab') as f:
+                    self.receive_payload(f, remaining, progress, codec)
+                    f.flush()
+                    os.fsync(f.fileno())
+                response = self.receive_message()
+                if response != ["SUCCESS"]:
+                    raise Exception(f"Tải xuống thất bại: {self.error_text(response)}")
+                calculated_checksum = self.generate_file_checksum(part_path)
+                if checksum != calculated_checksum:
+                    self.discard_part(part_path)
+                    raise Exception(f'''Checksum không khớp\n checksum: {checksum}\n checksum tính toán: {calculated_checksum}''')
+                break
+            except (ConnectionLost, OSError):
+                attempts += 1
+                if attempts > self.MAX_RESUME_ATTEMPTS:
+                    raise
+                time.sleep(attempts)
+                try:
+                    self.reconnect()
+                except Exception:
+                    pass
+            except Exception:
+                # Phần đã tải có thể không còn khớp với tệp tin trên server, tải lại từ đầu một lần
+                if offset == 0 or restarted:
+                    raise
+                restarted = True
+                self.discard_part(part_path)
+
+        os.replace(part_path, save_path)
+        self.discard_part(part_path)
+
+    @staticmethod
+    def read_part_checksum(meta_path):
+        try:
+            with open(meta_path) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    @staticmethod
+    def discard_part(part_path):
+        # Xóa phần đã tải cùng tệp tin .meta của nó
+        for path in (part_path, part_path + '.meta'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def download_part(self, filename, save_path, offset, length, progress_callback):
+        # Tải một đoạn của tệp tin (ví dụ phần cuối của log), không kiểm tra checksum
+        size, _, codec = self.request_download(filename, offset, length)
+        with open(save_path, 'wb') as f:
+            self.receive_payload(f, size, TransferProgress(size, progress_callback), codec)
+        response = self.receive_message()
+        if response != ["SUCCESS"]:
+            raise Exception(f"Tải xuống thất bại: {self.error_text(response)}")
+        return size
+
+    def download_file_parallel(self, filename, save_path, progress_callback, streams, file_size, checksum):
+        with open(save_path, 'wb') as f:
+            f.truncate(file_size)
+
+        ranges = self.split_ranges(file_size, streams)
+        progress = TransferProgress(file_size, progress_callback)
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(self.download_range, filename, save_path, offset, length, progress)
+                       for offset, length in ranges]
+            for future in futures:
+                future.result()
+
+        calculated_checksum = self.generate_file_checksum(save_path)
+        if checksum != calculated_checksum:
+            raise Exception(f'''Checksum không khớp\n checksum: {checksum}\n checksum tính toán: {calculated_checksum}''')
+
+    def download_range(self, filename, save_path, offset, length, progress):
+        with self.session() as session:
+            session.send_message("DOWNLOAD_RANGE", filename, offset, length)
+            response = session.receive_message()
+            if not response or response[0] != "SIZE":
+                raise Exception(f"Tải xuống đoạn {offset} thất bại: {session.error_text(response)}")
+            received = 0
+            buffer = memoryview(bytearray(self.BUFFER_SIZE))
+            fd = os.open(save_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                while received < length:
+                    n = session.channel.receive_data_into(buffer[:min(self.BUFFER_SIZE, length - received)])
+                    if not n:
+                        raise Exception("Mất kết nối khi đang tải xuống")
+                    write_at(fd, buffer[:n], offset + received)
+                    received += n
+                    progress.add(n)
+            finally:
+                os.close(fd)
+            response = session.receive_message()
+            if response != ["SUCCESS"]:
+                raise Exception(f"Tải xuống đoạn {offset} thất bại: {session.error_text(response)}")
+
+    def download_directory(self, dirname, save_path, progress_callback=None):
+        # Tải cả thư mục trên server về save_path trong một luồng. Tệp tin sai checksum bị xóa và
+        # báo lỗi riêng, các tệp tin khác vẫn được giữ. Trả về danh sách (đường dẫn tương đối, lỗi)
+        try:
+            if not self.supports('archive'):
+                raise Exception("Server không hỗ trợ tải xuống thư mục")
+            self.send_message("DOWNLOAD_DIR", dirname)
+            response = self.receive_message()
+            if response == ["FILE_NOT_FOUND"]:
+                raise Exception("Không tìm thấy thư mục trên máy chủ")
+            if response[0] != "ARCHIVE":
+                raise Exception(self.error_text(response))
+            progress = TransferProgress(int(response[2]), progress_callback)
+            os.makedirs(save_path, exist_ok=True)
+
+            failures = []
+            while True:
+                fields = self.receive_message()
+                if fields == ["END"]:
+                    return failures
+                if len(fields) == 2 and fields[0] == "DIR":
+                    path = member_path(save_path, fields[1])
+                    if path is None:
+                        failures.append((fields[1], "Đường dẫn không hợp lệ"))
+                    else:
+                        os.makedirs(path, exist_ok=True)
+                elif len(fields) == 3 and fields[0] == "MEMBER":
+                    error = self.receive_member(save_path, fields[1], int(fields[2]), progress)
+                    if error is not None:
+                        failures.append((fields[1], error))
+                else:
+                    raise Exception(f"Luồng thư mục không hợp lệ: {self.error_text(fields)}")
+        except Exception as e:
+            raise Exception(f"Lỗi tải xuống thư mục: {str(e)}")
+
+    def receive_member(self, root, relpath, size, progress):
+        # Nhận một thành viên vào root, luôn đọc hết dữ liệu để luồng không lệch.
+        # Trả về None nếu thành công, hoặc lý do lỗi của riêng tệp tin này
+        path = member_path(root, relpath)
+        f = error = None
+        if path is None:
+            error = "Đường dẫn không hợp lệ"
+        else:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = open(path, 'wb')
+            except OSError as e:
+                error = str(e)
+
+        sha256_hash = hashlib.sha256()
+        buffer = memoryview(bytearray(self.BUFFER_SIZE))
+        received = 0
+        try:
+            while received < size:
+                n = self.channel.receive_data_into(buffer[:min(self.BUFFER_SIZE, size - received)])
+                if not n:
+                    raise ConnectionLost("Mất kết nối khi đang tải xuống")
+                if f is not None:
+                    f.write(buffer[:n])
+                sha256_hash.update(buffer[:n])
+                received += n
+                progress.add(n)
+        finally:
+            if f is not None:
+                f.close()
+
+        response = self.receive_message()
+        if response[0] != "MEMBER_END":
+            raise Exception(f"Luồng thư mục không hợp lệ: {self.error_text(response)}")
+        if error is None and sha256_hash.hexdigest() != response[1]:
+            os.remove(path)
+            error = "Checksum không khớp"
+        return error
+
     def list_files(self):
+        # Trả về danh sách (tên tệp tin, kích thước)
         try:
+            if self.supports('list_page'):
+                return [(name, size) for page in self.iter_file_pages() for name, size, _ in page]
             self.send_message("LIST")
+            if self.protocol_version == PROTOCOL_V1:
+                # Phản hồi 1.0 là nhiều dòng "tên|kích thước", không tách thành trường được
+                response = self.channel.receive_text()
+                if response == "SERVER_SHUTDOWN":
+                    self.handle_server_shutdown()
+                    raise Exception("Server đã ngắt kết nối")
+                if response.startswith("ERROR"):
+                    return []
+                return parse_v1_file_list(response)
+
             response = self.receive_message()
-            
-            if response.startswith("ERROR"):
+            if not response or response[0] != "FILES":
                 return []
-                
-            files = response.split('\n')
-            return [f for f in files if f]
+            return [(name, int(size)) for name, size in zip(response[1::2], response[2::2])]
         except Exception as e:
             raise Exception(f"Lỗi liệt kê tệp tin: {str(e)}")
 
+    def list_files_page(self, limit=500, cursor='', pattern='', sort='name', order='asc'):
+        # Một trang LIST_PAGE: trả về (danh sách (tên, kích thước, mtime_ns), cursor trang sau).
+        # Cursor rỗng nghĩa là không còn trang nào
+        self.send_message("LIST_PAGE", limit, cursor, pattern, sort, order)
+        entries = []
+        while True:
+            response = self.receive_message()
+            if response[0] == "ENTRY":
+                entries.append((response[1], int(response[2]), int(response[3])))
+            elif response[0] == "END":
+                return entries, response[1]
+            else:
+                raise Exception(f"Lỗi liệt kê tệp tin: {self.error_text(response)}")
+
+    def iter_file_pages(self, pattern='', sort='name', order='asc', page_size=500):
+        # Lần lượt trả về từng trang để hiển thị ngay, không phải đợi cả danh sách
+        cursor = ''
+        while True:
+            entries, cursor = self.list_files_page(page_size, cursor, pattern, sort, order)
+            if entries:
+                yield entries
+            if not cursor:
+                return
+
+    def get_stats(self):
+        # Số đo hiện tại của server (chỉ tài khoản quản trị): {tên{nhãn}: giá trị hoặc tóm tắt histogram}
+        try:
+            self.send_message("STATS")
+            response = self.receive_message()
+            if response[0] != "STATS":
+                raise Exception(self.error_text(response))
+            return json.loads(response[1])
+        except Exception as e:
+            raise Exception(f"Lỗi lấy thống kê: {str(e)}")
+
+    def set_tracing(self, enabled):
+        # Bật/tắt ghi span trên server (chỉ tài khoản quản trị)
+        try:
+            self.send_message("TRACE", "ON" if enabled else "OFF")
+            response = self.receive_message()
+            if response[0] != "SUCCESS":
+                raise Exception(self.error_text(response))
+            return response[1]
+        except Exception as e:
+            raise Exception(f"Lỗi thay đổi tracing: {str(e)}")
+
+    def start_profile(self, kind, seconds, target=''):
+        # kind là "cpu" hoặc "memory"; target (người dùng hoặc ip:port) chỉ dùng cho cpu.
+        # Trả về đường dẫn tệp tin kết quả trên máy server
+        return self.profile_request("PROFILE", kind, seconds, *([target] if target else []))
+
+    def stop_profile(self):
+        return self.profile_request("PROFILE", "STOP")
+
+    def profile_request(self, *fields):
+        try:
+            self.send_message(*fields)
+            response = self.receive_message()
+            if response[0] != "PROFILING":
+                raise Exception(self.error_text(response))
+            return response[1]
+        except Exception as e:
+            raise Exception(f"Lỗi profile server: {str(e)}")
+
+    def get_limits(self):
+        # Giới hạn băng thông hiện tại (chỉ tài khoản quản trị): {"global": byte/giây, "users": {...}}
+        try:
+            self.send_message("LIMIT")
+            response = self.receive_message()
+            if response[0] != "LIMITS":
+                raise Exception(self.error_text(response))
+            return json.loads(response[1])
+        except Exception as e:
+            raise Exception(f"Lỗi lấy giới hạn băng thông: {str(e)}")
+
+    def set_limit(self, rate, username=''):
+        # rate là byte/giây, nhận hậu tố K/M/G, 0 là bỏ giới hạn. Không có username thì đổi
+        # giới hạn chung của server
+        try:
+            if username:
+                self.send_message("LIMIT", "USER", username, rate)
+            else:
+                self.send_message("LIMIT", "GLOBAL", rate)
+            response = self.receive_message()
+            if response[0] != "SUCCESS":
+                raise Exception(self.error_text(response))
+            return response[1]
+        except Exception as e:
+            raise Exception(f"Lỗi đặt giới hạn băng thông: {str(e)}")
+
     def close(self):
+        with self.pool_lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.close()
         try:
             self.is_connected = False
             if self.socket:
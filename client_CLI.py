@@ -1,5 +1,6 @@
 import os
 import sys
+import glob
 import getpass
 from client.transfer import FileTransferClient
 from tqdm import tqdm
@@ -9,6 +10,8 @@ class ClientCLI:
         self.client = FileTransferClient()
         self.username = None
         self.is_running = True
+        self.streams = 1
+        self.PAGE_SIZE = 50  # Số file mỗi trang khi liệt kê
 
     def connect(self):
         try:
@@ -62,9 +65,21 @@ class ClientCLI:
 
     def show_help(self):
         print("\nDanh sách lệnh:")
-        print("  upload <đường dẫn file>  - Tải file lên server")
+        print("  upload <đường dẫn file> [...] - Tải một hoặc nhiều file lên server (hỗ trợ *, ?)")
+        print("  upload <thư mục>         - Tải cả thư mục lên server, giữ nguyên thư mục con")
         print("  download <tên file>      - Tải file từ server")
-        print("  list                     - Xem danh sách file")
+        print("  download <tên file> <vị trí> [số byte] - Tải một đoạn của file (vị trí âm tính từ cuối)")
+        print("  download_dir <thư mục>   - Tải cả thư mục từ server")
+        print("  sync <đường dẫn file>    - Cập nhật file đã có trên server, chỉ gửi phần thay đổi")
+        print("  list [mẫu] [name|size|mtime] [asc|desc] - Xem danh sách file theo từng trang")
+        print("  stats                    - Xem số đo của server (tài khoản quản trị)")
+        print("  trace on|off             - Bật/tắt ghi span trên server (tài khoản quản trị)")
+        print("  profile cpu|memory <giây> [người dùng|ip:port] - Profile server (tài khoản quản trị)")
+        print("  profile stop             - Kết thúc sớm phiên profile")
+        print("  limit                    - Xem giới hạn băng thông (tài khoản quản trị)")
+        print("  limit global <tốc độ>    - Giới hạn chung của server, ví dụ 50M (byte/giây), 0 là bỏ giới hạn")
+        print("  limit user <tên> <tốc độ> - Giới hạn của một người dùng")
+        print("  streams <số luồng>       - Số kết nối song song khi truyền file lớn")
         print("  help                     - Hiển thị trợ giúp") 
         print("  exit                     - Thoát chương trình")
 
@@ -83,44 +98,192 @@ class ClientCLI:
             print(f"\nĐang tải lên {filename} ({filesize} bytes)")
             self.progress_bar = tqdm(total=100, desc="Tiến độ")
             
-            self.client.upload_file(filepath, self.progress_callback)
+            self.client.upload_file(filepath, self.progress_callback, self.streams)
             self.progress_bar.close()
             print("Tải lên thành công!")
 
         except Exception as e:
             print(f"Lỗi tải lên: {e}")
 
-    def download_file(self, filename):
+    def upload_files(self, patterns):
         try:
-            save_path = os.path.join(os.getcwd(), filename)
+            filepaths = []
+            for pattern in patterns:
+                matches = sorted(glob.glob(pattern)) or [pattern]
+                filepaths.extend(path for path in matches if not os.path.isdir(path))
+            missing = [path for path in filepaths if not os.path.exists(path)]
+            for path in missing:
+                print(f"Không tìm thấy file: {path}")
+            filepaths = [path for path in filepaths if path not in missing]
+            if not filepaths:
+                return
+
+            print(f"\nĐang tải lên {len(filepaths)} file")
+            self.progress_bar = tqdm(total=100, desc="Tiến độ")
+            results = self.client.upload_files(filepaths, self.progress_callback, self.streams)
+            self.progress_bar.close()
+            failed = [(path, error) for path, _, error in results if error is not None]
+            for path, error in failed:
+                print(f"  Lỗi tải lên {path}: {error}")
+            print(f"Tải lên thành công {len(results) - len(failed)}/{len(results)} file")
+
+        except Exception as e:
+            print(f"Lỗi tải lên: {e}")
+
+    def upload_directory(self, dirpath):
+        try:
+            print(f"\nĐang tải lên thư mục {dirpath}")
+            self.progress_bar = tqdm(total=100, desc="Tiến độ")
+            dirname, failures = self.client.upload_directory(dirpath, self.progress_callback)
+            self.progress_bar.close()
+            for relpath, error in failures:
+                print(f"  Lỗi tải lên {relpath}: {error}")
+            print(f"Đã tải lên thư mục {dirname}" + (f", {len(failures)} file lỗi" if failures else ""))
+
+        except Exception as e:
+            print(f"Lỗi tải lên: {e}")
+
+    def download_directory(self, dirname):
+        try:
+            save_path = os.path.join(os.getcwd(), os.path.basename(dirname.rstrip('/')))
+            print(f"\nĐang tải xuống thư mục {dirname}")
+            self.progress_bar = tqdm(total=100, desc="Tiến độ")
+            failures = self.client.download_directory(dirname, save_path, self.progress_callback)
+            self.progress_bar.close()
+            for relpath, error in failures:
+                print(f"  Lỗi tải xuống {relpath}: {error}")
+            print(f"Đã tải xuống thư mục vào: {save_path}" + (f", {len(failures)} file lỗi" if failures else ""))
+
+        except Exception as e:
+            print(f"Lỗi tải xuống: {e}")
+
+    def sync_file(self, filepath):
+        try:
+            if not os.path.exists(filepath):
+                print(f"Không tìm thấy file: {filepath}")
+                return
+
+            print(f"\nĐang đồng bộ {os.path.basename(filepath)}")
+            self.progress_bar = tqdm(total=100, desc="Tiến độ")
+            self.client.sync_file(filepath, self.progress_callback)
+            self.progress_bar.close()
+            print("Đồng bộ thành công!")
+
+        except Exception as e:
+            print(f"Lỗi đồng bộ: {e}")
+
+    def download_file(self, filename, offset=0, length=None):
+        try:
+            save_path = os.path.join(os.getcwd(), os.path.basename(filename))
             print(f"\nĐang tải xuống {filename}")
             self.progress_bar = tqdm(total=100, desc="Tiến độ")
             
-            self.client.download_file(filename, save_path, self.progress_callback)
+            self.client.download_file(filename, save_path, self.progress_callback, self.streams, offset, length)
             self.progress_bar.close()
             print(f"Đã tải xuống thành công vào: {save_path}")
 
         except Exception as e:
             print(f"Lỗi tải xuống: {e}")
 
-    def list_files(self):
+    def list_files(self, pattern='', sort='name', order='asc'):
         try:
-            files = self.client.list_files()
-            if not files:
-                print("Không có file nào")
+            if not self.client.supports('list_page'):
+                files = self.client.list_files()
+                if not files:
+                    print("Không có file nào")
+                    return
+
+                print("\nDanh sách file:")
+                for name, size in files:
+                    print(f"  {name:<30} {size:>10} bytes")
                 return
 
-            print("\nDanh sách file:")
-            for file_info in files:
-                if "|" in file_info:
-                    name, size = file_info.split("|")
-                    print(f"  {name:<30} {int(size):>10} bytes")
-                else:
-                    print(f"  {file_info}")
+            if sort not in ('name', 'size', 'mtime') or order not in ('asc', 'desc'):
+                print("Sắp xếp theo name, size hoặc mtime; thứ tự asc hoặc desc")
+                return
+            # Hiện từng trang ngay khi nhận được, hỏi trước khi tải trang tiếp theo
+            count = 0
+            cursor = ''
+            while True:
+                entries, cursor = self.client.list_files_page(self.PAGE_SIZE, cursor, pattern, sort, order)
+                if count == 0 and entries:
+                    print("\nDanh sách file:")
+                for name, size, mtime_ns in entries:
+                    print(f"  {name:<30} {size:>10} bytes")
+                count += len(entries)
+                if not cursor:
+                    break
+                if input(f"-- Đã hiện {count} file, Enter để xem tiếp, q để dừng --").strip().lower() == 'q':
+                    break
+            if count == 0:
+                print("Không có file nào")
 
         except Exception as e:
             print(f"Lỗi lấy danh sách file: {e}")
 
+    def set_tracing(self, enabled):
+        try:
+            print(self.client.set_tracing(enabled))
+        except Exception as e:
+            print(e)
+
+    def start_profile(self, kind, seconds, target):
+        try:
+            path = self.client.start_profile(kind, seconds, target)
+            print(f"Đang profile, kết quả sẽ được ghi vào {path} trên server")
+        except Exception as e:
+            print(e)
+
+    def stop_profile(self):
+        try:
+            path = self.client.stop_profile()
+            print(f"Đã dừng profile, kết quả: {path}")
+        except Exception as e:
+            print(e)
+
+    def show_limits(self):
+        try:
+            limits = self.client.get_limits()
+            print(f"\nGiới hạn chung: {limits['global'] or 'không giới hạn'} byte/giây")
+            for username, rate in sorted(limits['users'].items()):
+                print(f"  {username:<30} {rate} byte/giây")
+        except Exception as e:
+            print(e)
+
+    def set_limit(self, rate, username=''):
+        try:
+            print(self.client.set_limit(rate, username))
+        except Exception as e:
+            print(e)
+
+    def show_stats(self):
+        try:
+            stats = self.client.get_stats()
+            print("\nThống kê server:")
+            for name, value in stats.items():
+                if isinstance(value, dict):
+                    if not value['count']:
+                        continue
+                    print(f"  {name:<60} n={value['count']} p50<={value['p50']} p95<={value['p95']} p99<={value['p99']}")
+                else:
+                    print(f"  {name:<60} {value}")
+        except Exception as e:
+            print(e)
+
+    def set_streams(self, value):
+        try:
+            streams = int(value)
+        except ValueError:
+            print("Số luồng phải là số nguyên")
+            return
+        if streams < 1:
+            print("Số luồng phải lớn hơn 0")
+            return
+        self.streams = streams
+        if streams > 1 and not self.client.supports('parallel'):
+            print("Server không hỗ trợ truyền song song, file sẽ được truyền qua một kết nối")
+        print(f"Số luồng truyền: {self.streams}")
+
     def handle_server_shutdown(self):
         print("\nServer đã ngắt kết nối!")
         self.is_running = False
@@ -171,11 +334,44 @@ class ClientCLI:
                 elif cmd == "help":
                     self.show_help()
                 elif cmd == "list":
-                    self.list_files()
+                    self.list_files(*parts[1:4])
                 elif cmd == "upload" and len(parts) > 1:
-                    self.upload_file(parts[1])
+                    if len(parts) == 2 and os.path.isdir(parts[1]):
+                        self.upload_directory(parts[1])
+                    elif len(parts) == 2 and not any(c in parts[1] for c in '*?['):
+                        self.upload_file(parts[1])
+                    else:
+                        self.upload_files(parts[1:])
+                elif cmd == "sync" and len(parts) > 1:
+                    self.sync_file(parts[1])
+                elif cmd == "download" and len(parts) > 2:
+                    try:
+                        offset = int(parts[2])
+                        length = int(parts[3]) if len(parts) > 3 else None
+                    except ValueError:
+                        print("Vị trí và số byte phải là số nguyên")
+                        continue
+                    self.download_file(parts[1], offset, length)
                 elif cmd == "download" and len(parts) > 1:
                     self.download_file(parts[1])
+                elif cmd == "download_dir" and len(parts) > 1:
+                    self.download_directory(parts[1])
+                elif cmd == "stats":
+                    self.show_stats()
+                elif cmd == "trace" and len(parts) == 2 and parts[1].lower() in ("on", "off"):
+                    self.set_tracing(parts[1].lower() == "on")
+                elif cmd == "profile" and len(parts) == 2 and parts[1].lower() == "stop":
+                    self.stop_profile()
+                elif cmd == "profile" and len(parts) in (3, 4):
+                    self.start_profile(parts[1], parts[2], parts[3] if len(parts) == 4 else '')
+                elif cmd == "limit" and len(parts) == 1:
+                    self.show_limits()
+                elif cmd == "limit" and len(parts) == 3 and parts[1].lower() == "global":
+                    self.set_limit(parts[2])
+                elif cmd == "limit" and len(parts) == 4 and parts[1].lower() == "user":
+                    self.set_limit(parts[3], parts[2])
+                elif cmd == "streams" and len(parts) > 1:
+                    self.set_streams(parts[1])
                 else:
                     print("Lệnh không hợp lệ! Gõ 'help' để xem hướng dẫn")
 
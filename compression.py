@@ -0,0 +1,70 @@
+import os
+import zlib
+from protocol import ProtocolError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_DECOMPRESS_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard is not None else (zlib.error,)
+
+# Nén dữ liệu tệp tin trên đường truyền. Mỗi frame DATA là một khối nén độc lập chứa
+# tối đa DATA_FRAME_SIZE byte gốc, nên bên nhận giải nén từng frame và checksum vẫn
+# được tính trên nội dung gốc như khi không nén.
+ZLIB_LEVEL = 6
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVING = 0.1  # Khối mẫu phải nhỏ đi ít nhất 10% thì mới nén cả tệp tin
+
+# Định dạng đã nén sẵn, nén thêm chỉ tốn CPU
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.ogg', '.flac', '.mp4', '.mkv', '.avi', '.mov', '.webm',
+    '.docx', '.xlsx', '.pptx', '.jar', '.apk',
+}
+
+def available_codecs():
+    # Theo thứ tự ưu tiên: zstd nhanh hơn zlib ở cùng tỉ lệ nén
+    codecs = []
+    if zstandard is not None:
+        codecs.append('zstd')
+    codecs.append('zlib')
+    return codecs
+
+def compress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == 'zlib':
+        return zlib.compress(data, ZLIB_LEVEL)
+    raise ValueError(f'Unsupported codec: {codec}')
+
+def decompress(codec, data, max_size):
+    # Giới hạn kích thước sau giải nén để một frame nhỏ không nở ra quá max_size byte
+    if codec not in available_codecs():
+        raise ProtocolError(f'Không hỗ trợ kiểu nén: {codec}')
+    try:
+        if codec == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+    except _DECOMPRESS_ERRORS as e:
+        raise ProtocolError(f'Khối nén không hợp lệ: {e}')
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ProtocolError('Khối nén không hợp lệ hoặc vượt quá kích thước cho phép')
+    return result
+
+def choose_codec(filename, sample, accepted):
+    # Chọn kiểu nén đầu tiên mà cả hai bên hỗ trợ; None nếu tệp tin không đáng nén
+    codecs = [codec for codec in accepted if codec in available_codecs()]
+    if not codecs or not sample:
+        return None
+    if os.path.splitext(filename)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return None
+    if len(compress(codecs[0], sample)) > len(sample) * (1 - MIN_SAVING):
+        return None
+    return codecs[0]
+
+def describe_ratio(codec, original, wire):
+    ratio = original / wire if wire else 0.0
+    return f'{codec}: {original} -> {wire} bytes ({ratio:.2f}x)'
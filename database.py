@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import threading
+import time
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+class Database:
+    # Mỗi luồng giữ một kết nối SQLite riêng thay vì mở kết nối mới cho mỗi truy vấn.
+    # sqlite3 lưu sẵn các câu lệnh đã biên dịch theo từng kết nối nên truy vấn lặp lại
+    # không phải biên dịch lại. WAL cho phép đọc song song trong khi có một luồng ghi.
+    def __init__(self, db_file, timeout=10.0):
+        self.db_file = db_file
+        self.timeout = timeout
+        self.local = threading.local()
+        self.observer = None  # Nếu được đặt: observer(số giây) sau mỗi khối with
+
+    def connection(self):
+        # Dùng như "with database.connection() as conn:", khối with tự commit/rollback
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=self.timeout, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        if self.observer is not None:
+            return TimedConnection(conn, self.observer)
+        return conn
+
+    def close(self):
+        # Chỉ đóng kết nối của luồng hiện tại
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+class TimedConnection:
+    # Đo thời gian cả khối with (truy vấn và commit); bên trong khối vẫn dùng kết nối sqlite3 gốc
+    __slots__ = ('conn', 'observer', 'start')
+
+    def __init__(self, conn, observer):
+        self.conn = conn
+        self.observer = observer
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            return self.conn.__exit__(*exc_info)
+        finally:
+            self.observer(time.perf_counter() - self.start)
+
+def get_database(db_file):
+    # Các bảng cùng nằm trong một tệp tin dùng chung một Database
+    db_file = os.path.abspath(db_file)
+    with _databases_lock:
+        database = _databases.get(db_file)
+        if database is None:
+            database = _databases[db_file] = Database(db_file)
+        return database
@@ -0,0 +1,124 @@
+import hashlib
+import math
+import struct
+import zlib
+
+# Đồng bộ kiểu rsync: bên có bản cũ gửi chữ ký từng khối (checksum yếu cuộn được +
+# hash mạnh), bên có bản mới chỉ gửi dữ liệu của các vùng thay đổi và tham chiếu tới
+# các khối đã có. Checksum yếu là Adler-32 nên tính cả khối bằng zlib, chỉ phần cuộn
+# từng byte chạy trong Python và chỉ ở những vùng không khớp.
+SIGNATURE_ENTRY = struct.Struct('!I16s')
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+LITERAL_LIMIT = 1024 * 1024  # Gửi dữ liệu thay đổi thành từng đoạn tối đa 1 MB
+_ADLER_MOD = 65521
+
+def block_size_for(size):
+    # Khối cỡ căn bậc hai kích thước tệp tin, làm tròn lên bội số của 1 KB
+    block_size = -(-int(math.sqrt(size)) // 1024) * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def make_signature(f, block_size):
+    parts = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        parts.append(SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_checksum(block)))
+    return b''.join(parts)
+
+def parse_signature(data):
+    return [SIGNATURE_ENTRY.unpack_from(data, offset) for offset in range(0, len(data), SIGNATURE_ENTRY.size)]
+
+def generate_delta(f, signature, block_size, base_size):
+    # Sinh ra ('COPY', khối đầu, số khối) hoặc ('LITERAL', dữ liệu) để dựng lại tệp tin f
+    # từ bản cũ có chữ ký signature
+    table = {}
+    full_blocks = base_size // block_size
+    for index, (weak, strong) in enumerate(signature[:full_blocks]):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    tail_block = None
+    if len(signature) > full_blocks:
+        tail_block = (full_blocks, base_size - full_blocks * block_size, signature[full_blocks][1])
+
+    copy_run = None
+    buf = bytearray()
+    pos = start = 0
+    eof = False
+    weak = None
+    while True:
+        if not eof and len(buf) - pos <= block_size:
+            if start:
+                del buf[:start]
+                pos -= start
+                start = 0
+            chunk = f.read(READ_SIZE)
+            if chunk:
+                buf += chunk
+            else:
+                eof = True
+            continue
+        if len(buf) - pos < block_size:
+            break
+
+        if weak is None:
+            weak = zlib.adler32(bytes(buf[pos:pos + block_size]))
+        candidates = table.get(weak)
+        if candidates:
+            index = candidates.get(strong_checksum(bytes(buf[pos:pos + block_size])))
+            if index is not None:
+                if pos > start:
+                    if copy_run:
+                        yield copy_run
+                        copy_run = None
+                    yield ('LITERAL', bytes(buf[start:pos]))
+                if copy_run and copy_run[1] + copy_run[2] == index:
+                    copy_run = ('COPY', copy_run[1], copy_run[2] + 1)
+                else:
+                    if copy_run:
+                        yield copy_run
+                    copy_run = ('COPY', index, 1)
+                pos += block_size
+                start = pos
+                weak = None
+                continue
+
+        if pos - start >= LITERAL_LIMIT:
+            if copy_run:
+                yield copy_run
+                copy_run = None
+            yield ('LITERAL', bytes(buf[start:pos]))
+            start = pos
+        if pos + block_size >= len(buf):
+            if eof:
+                break
+            continue
+        # Cuộn cửa sổ thêm một byte: bỏ byte đầu, thêm byte kế tiếp
+        out_byte, in_byte = buf[pos], buf[pos + block_size]
+        a = ((weak & 0xffff) - out_byte + in_byte) % _ADLER_MOD
+        b = ((weak >> 16) - block_size * out_byte + a - 1) % _ADLER_MOD
+        weak = (b << 16) | a
+        pos += 1
+
+    # Phần còn lại ngắn hơn một khối có thể trùng với khối cuối (ngắn) của bản cũ
+    if tail_block and len(buf) - pos == tail_block[1] and strong_checksum(bytes(buf[pos:])) == tail_block[2]:
+        if pos > start:
+            if copy_run:
+                yield copy_run
+                copy_run = None
+            yield ('LITERAL', bytes(buf[start:pos]))
+        if copy_run and copy_run[1] + copy_run[2] == tail_block[0]:
+            copy_run = ('COPY', copy_run[1], copy_run[2] + 1)
+        else:
+            if copy_run:
+                yield copy_run
+            copy_run = ('COPY', tail_block[0], 1)
+        start = len(buf)
+    if copy_run:
+        yield copy_run
+    if len(buf) > start:
+        yield ('LITERAL', bytes(buf[start:]))
@@ -0,0 +1,144 @@
+import os
+from database import get_database
+
+# Cột dùng để sắp xếp LIST theo từng khóa; name luôn là khóa phụ để thứ tự ổn định
+SORT_COLUMNS = {'name': 'name', 'size': 'size', 'mtime': 'mtime_ns'}
+
+class FileIndex:
+    # Danh mục tệp tin của từng người dùng (tên, kích thước, mtime, checksum) trong SQLite,
+    # để LIST và việc chọn tên khi trùng không phải listdir/stat cả thư mục mỗi lần.
+    # Được cập nhật khi tải lên hoàn tất và đối chiếu với đĩa bằng reconcile().
+    def __init__(self, db_file='users.db'):
+        self.db_file = db_file
+        self.database = get_database(db_file)
+        self._initialize_database()
+
+    def _initialize_database(self):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS user_files (
+                    username TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    checksum TEXT,
+                    PRIMARY KEY (username, name)
+                )
+            """)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS user_files_by_size ON user_files (username, size, name)
+            """)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS user_files_by_mtime ON user_files (username, mtime_ns, name)
+            """)
+            conn.commit()
+
+    def record(self, username, filepath, checksum=None, name=None):
+        # name là đường dẫn tương đối trong thư mục của người dùng ("a/b.txt"), mặc định là tên tệp tin
+        st = os.stat(filepath)
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO user_files (username, name, size, mtime_ns, checksum)
+                VALUES (?, ?, ?, ?, ?)
+            """, (username, name or os.path.basename(filepath), st.st_size, st.st_mtime_ns, checksum))
+            conn.commit()
+
+    def remove(self, username, name):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM user_files WHERE username = ? AND name = ?
+            """, (username, name))
+            conn.commit()
+
+    def find_content(self, username, checksum, size):
+        # Tên một tệp tin của người dùng có đúng nội dung này (theo checksum đã ghi), None nếu không có
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT name FROM user_files WHERE username = ? AND size = ? AND checksum = ? LIMIT 1
+            """, (username, size, checksum))
+            result = cursor.fetchone()
+        return result[0] if result else None
+
+    def list(self, username):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT name, size FROM user_files WHERE username = ? ORDER BY name
+            """, (username,))
+            return cursor.fetchall()
+
+    def page(self, username, sort='name', descending=False, pattern=None, after=None, limit=100):
+        # Phân trang theo khóa: after là (giá trị khóa, tên) của dòng cuối trang trước.
+        # Trả về danh sách (tên, kích thước, mtime_ns)
+        column = SORT_COLUMNS[sort]
+        direction, compare = ('DESC', '<') if descending else ('ASC', '>')
+        conditions, params = ['username = ?'], [username]
+        if pattern:
+            conditions.append('name GLOB ?')
+            params.append(pattern)
+        if after is not None:
+            if column == 'name':
+                conditions.append(f'name {compare} ?')
+                params.append(after[1])
+            else:
+                conditions.append(f'({column}, name) {compare} (?, ?)')
+                params.extend(after)
+        params.append(limit)
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT name, size, mtime_ns FROM user_files
+                WHERE {' AND '.join(conditions)}
+                ORDER BY {column} {direction}, name {direction}
+                LIMIT ?
+            """, params)
+            return cursor.fetchall()
+
+    def taken_names(self, username, filename):
+        # Các tên đã dùng có thể trùng với filename hoặc "filename (n)": một truy vấn theo
+        # khoảng trên khóa chính thay vì thử từng tên
+        base = os.path.splitext(filename)[0]
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT name FROM user_files
+                WHERE username = ? AND (name = ? OR (name >= ? AND name < ?))
+            """, (username, filename, f'{base} (', f'{base} )'))
+            return {row[0] for row in cursor.fetchall()}
+
+    def reconcile(self, username, storage_dir):
+        # Đồng bộ danh mục với nội dung thật trên đĩa; trả về số bản ghi đã thay đổi
+        # Tệp tin trong thư mục con được ghi với đường dẫn tương đối, ngăn cách bằng "/"
+        on_disk = {}
+        pending = ['']
+        while pending:
+            prefix = pending.pop()
+            with os.scandir(os.path.join(storage_dir, prefix)) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(prefix + entry.name + '/')
+                    elif entry.is_file():
+                        st = entry.stat()
+                        on_disk[prefix + entry.name] = (st.st_size, st.st_mtime_ns)
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT name, size, mtime_ns FROM user_files WHERE username = ?
+            """, (username,))
+            indexed = {name: (size, mtime_ns) for name, size, mtime_ns in cursor.fetchall()}
+            stale = [(username, name) for name in indexed if name not in on_disk]
+            changed = [(username, name, size, mtime_ns) for name, (size, mtime_ns) in on_disk.items()
+                       if indexed.get(name) != (size, mtime_ns)]
+            cursor.executemany("""
+                DELETE FROM user_files WHERE username = ? AND name = ?
+            """, stale)
+            cursor.executemany("""
+                INSERT OR REPLACE INTO user_files (username, name, size, mtime_ns, checksum)
+                VALUES (?, ?, ?, ?, NULL)
+            """, changed)
+            conn.commit()
+        return len(stale) + len(changed)
@@ -0,0 +1,83 @@
+from database import get_database
+
+class LimitStore:
+    # Giới hạn băng thông dùng chung cho các worker (--workers). Giới hạn chung nằm trong bảng
+    # settings, giới hạn của người dùng vẫn ở cột bandwidth_limit của bảng users. Mỗi worker ghi
+    # lại những người dùng đang có kết nối với nó (username '' nghĩa là worker có kết nối) để mỗi
+    # giới hạn được chia đều cho các worker đang phục vụ
+    def __init__(self, db_file='users.db'):
+        self.db_file = db_file
+        self.database = get_database(db_file)
+        self._initialize_database()
+
+    def _initialize_database(self):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS bandwidth_shares (
+                    pid INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    PRIMARY KEY (pid, username)
+                )
+            """)
+            conn.commit()
+
+    def get_global(self):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT value FROM settings WHERE name = 'bandwidth_limit'
+            """)
+            result = cursor.fetchone()
+        return result[0] if result else 0
+
+    def set_global(self, rate):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO settings (name, value) VALUES ('bandwidth_limit', ?)
+            """, (rate,))
+            conn.commit()
+
+    def publish(self, pid, usernames):
+        # Thay danh sách người dùng của worker pid; trả về {username: số worker đang phục vụ}
+        # cho các người dùng đó và cho ''
+        usernames = set(usernames)
+        if usernames:
+            usernames.add('')
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM bandwidth_shares WHERE pid = ?
+            """, (pid,))
+            cursor.executemany("""
+                INSERT INTO bandwidth_shares (pid, username) VALUES (?, ?)
+            """, [(pid, username) for username in usernames])
+            cursor.execute("""
+                SELECT username, COUNT(*) FROM bandwidth_shares
+                WHERE username IN (SELECT username FROM bandwidth_shares WHERE pid = ?)
+                GROUP BY username
+            """, (pid,))
+            counts = dict(cursor.fetchall())
+            conn.commit()
+        return counts
+
+    def remove_process(self, pid=None):
+        # Worker đã thoát, hoặc mọi worker (pid None) khi supervisor khởi động
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            if pid is None:
+                cursor.execute("""
+                    DELETE FROM bandwidth_shares
+                """)
+            else:
+                cursor.execute("""
+                    DELETE FROM bandwidth_shares WHERE pid = ?
+                """, (pid,))
+            conn.commit()
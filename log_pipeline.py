@@ -0,0 +1,156 @@
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_DIR = 'logs'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+QUEUE_SIZE = 100000
+MAX_LOG_BYTES = 50 * 1024 * 1024
+ROTATE_SECONDS = 24 * 3600
+BACKUP_COUNT = 10
+DEBUG_RATE = 5.0  # Số bản ghi DEBUG mỗi giây cho mỗi vị trí gọi
+# Logger ghi JSON Lines ra tệp tin riêng, không lẫn vào log thường
+CHANNEL_FILES = {
+    'filetransfer.trace': 'trace.jsonl',
+    'filetransfer.transfer': 'transfers.jsonl',
+}
+
+transfer_logger = logging.getLogger('filetransfer.transfer')
+
+_listener = None
+_queue_handler = None
+
+class SizeTimeRotatingFileHandler(RotatingFileHandler):
+    # Xoay tệp tin log khi vượt max_bytes hoặc khi đã ghi quá interval giây
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+class NonBlockingQueueHandler(QueueHandler):
+    # Luồng gọi chỉ đưa bản ghi vào hàng đợi; hàng đợi đầy thì bỏ bản ghi và đếm lại
+    # thay vì chặn luồng đang truyền dữ liệu
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class DebugRateLimit(logging.Filter):
+    # Token bucket cho bản ghi DEBUG theo từng vị trí gọi (tệp tin, dòng). Số bản ghi bị bỏ
+    # được báo kèm bản ghi tiếp theo của vị trí đó. rate <= 0 là không giới hạn
+    def __init__(self, rate=DEBUG_RATE):
+        super().__init__()
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.buckets = {}  # (tệp tin, dòng) -> [token, thời điểm cập nhật, số bản ghi bị bỏ]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f'{record.getMessage()} ({suppressed} similar messages suppressed)'
+            record.args = None
+        return True
+
+class LoggerNameFilter(logging.Filter):
+    # include=True: chỉ nhận bản ghi của các logger trong names; False: bỏ các logger đó
+    def __init__(self, names, include):
+        super().__init__()
+        self.names = frozenset(names)
+        self.include = include
+
+    def filter(self, record):
+        return (record.name in self.names) == self.include
+
+def configure_logging(log_dir=LOG_DIR, level=logging.INFO, debug_rate=DEBUG_RATE,
+                      max_bytes=MAX_LOG_BYTES, rotate_seconds=ROTATE_SECONDS, backup_count=BACKUP_COUNT):
+    # Mọi logger chỉ đưa bản ghi vào một hàng đợi; một luồng nền ghi ra tệp tin (có xoay vòng)
+    # và terminal, nên khóa của handler và I/O không nằm trên luồng xử lý client
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    os.makedirs(log_dir, exist_ok=True)
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [
+        SizeTimeRotatingFileHandler(os.path.join(log_dir, 'server.log'), max_bytes, rotate_seconds, backup_count),
+        logging.StreamHandler(),
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.addFilter(LoggerNameFilter(CHANNEL_FILES, include=False))
+    for name, filename in CHANNEL_FILES.items():
+        handler = SizeTimeRotatingFileHandler(os.path.join(log_dir, filename), max_bytes, rotate_seconds, backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler.addFilter(LoggerNameFilter((name,), include=True))
+        handlers.append(handler)
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(QUEUE_SIZE))
+    _queue_handler.addFilter(DebugRateLimit(debug_rate))
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_queue_handler)
+    for name in CHANNEL_FILES:
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(_queue_handler)
+
+    _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging():
+    # Ghi nốt các bản ghi còn trong hàng đợi rồi dừng luồng ghi
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    if _queue_handler.dropped:
+        logging.warning(f'{_queue_handler.dropped} log records dropped because the log queue was full')
+    _listener.stop()
+    for logger in [logging.getLogger()] + [logging.getLogger(name) for name in CHANNEL_FILES]:
+        logger.removeHandler(_queue_handler)
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = _queue_handler = None
+
+def log_transfer(**fields):
+    # Một dòng JSON cho mỗi lần truyền tệp tin hoàn tất (logs/transfers.jsonl)
+    if transfer_logger.isEnabledFor(logging.INFO):
+        record = {'time': datetime.datetime.now().isoformat(timespec='milliseconds')}
+        record.update(fields)
+        transfer_logger.info(json.dumps(record, default=str, ensure_ascii=False))
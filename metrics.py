@@ -0,0 +1,190 @@
+import threading
+from bisect import bisect_left
+
+# Đơn vị giây cho thời gian xử lý lệnh, checksum, truy vấn SQLite
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Byte/giây của một lần truyền tệp tin
+THROUGHPUT_BUCKETS = tuple(2 ** 20 * n for n in (1, 4, 16, 64, 256, 1024, 4096))
+
+class Metrics:
+    # Bộ đếm và histogram trong tiến trình. Mỗi luồng ghi vào shard riêng (dict của luồng đó) nên
+    # inc/observe không cần khóa; khóa chỉ dùng khi một luồng ghi lần đầu và khi đọc snapshot.
+    # Shard của luồng đã kết thúc được gộp vào retired để không giữ mãi một dict cho mỗi kết nối
+    def __init__(self, namespace='filetransfer'):
+        self.namespace = namespace
+        self.local = threading.local()
+        self.shards = []  # (luồng, shard)
+        self.retired = {}
+        self.lock = threading.Lock()
+        self.descriptions = {}  # tên -> (loại, mô tả, buckets)
+        self.callbacks = {}  # tên -> hàm trả về giá trị tại thời điểm đọc
+
+    def counter(self, name, description):
+        self.descriptions[name] = ('counter', description, None)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        self.descriptions[name] = ('histogram', description, tuple(buckets))
+
+    def gauge(self, name, description, func, kind='gauge'):
+        # Giá trị được tính khi đọc (số kết nối, số người dùng...); kind='counter' cho tổng tăng dần
+        self.descriptions[name] = (kind, description, None)
+        self.callbacks[name] = func
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        data = shard.get(key)
+        buckets = self.descriptions[name][2]
+        if data is None:
+            # Số lần rơi vào từng bucket (phần tử cuối của buckets là +Inf), tổng, số lần
+            data = shard[key] = [0] * (len(buckets) + 3)
+        data[bisect_left(buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def collect(self):
+        # Gộp mọi shard: {(tên, nhãn): số hoặc danh sách bucket}
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    merge_samples(self.retired, shard.copy())
+            self.shards = alive
+            merged = {}
+            merge_samples(merged, self.retired)
+            for _, shard in alive:
+                merge_samples(merged, shard.copy())
+        for name, func in self.callbacks.items():
+            try:
+                merged[(name, ())] = func()
+            except Exception:
+                pass
+        return merged
+
+    def export(self):
+        # collect() dạng JSON để supervisor (--workers) gộp số đo của các tiến trình worker
+        return {'descriptions': self.descriptions,
+                'samples': [[name, labels, value] for (name, labels), value in self.collect().items()]}
+
+    def load(self, exported):
+        # Ngược lại của export(): nhận mô tả số đo, trả về dict như collect()
+        for name, (kind, description, buckets) in exported['descriptions'].items():
+            self.descriptions[name] = (kind, description, tuple(buckets) if buckets else None)
+        return {(name, tuple(tuple(label) for label in labels)): value
+                for name, labels, value in exported['samples']}
+
+    def snapshot(self, collected=None):
+        # Dạng gọn cho lệnh STATS: histogram được tóm tắt bằng count/sum/p50/p95/p99
+        # (giới hạn trên của bucket chứa phân vị)
+        result = {}
+        for (name, labels), value in sorted((self.collect() if collected is None else collected).items()):
+            key = name + format_labels(labels)
+            if isinstance(value, list):
+                buckets = self.descriptions[name][2]
+                summary = {'count': value[-1], 'sum': value[-2]}
+                for label, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+                    summary[label] = bucket_quantile(buckets, value, q)
+                result[key] = summary
+            else:
+                result[key] = value
+        return result
+
+    def render_prometheus(self, collected=None):
+        samples = {}
+        for (name, labels), value in (self.collect() if collected is None else collected).items():
+            samples.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(samples):
+            kind, description, buckets = self.descriptions.get(name, ('untyped', '', None))
+            metric = f'{self.namespace}_{name}'
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for labels, value in sorted(samples[name]):
+                if kind != 'histogram':
+                    lines.append(f'{metric}{format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{metric}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{metric}_sum{format_labels(labels)} {value[-2]}')
+                lines.append(f'{metric}_count{format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+def merge_samples(target, samples):
+    # Cộng samples ({(tên, nhãn): số hoặc danh sách bucket}) vào target
+    for key, value in samples.items():
+        if isinstance(value, list):
+            current = target.get(key)
+            target[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            target[key] = target.get(key, 0) + value
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+def bucket_quantile(buckets, value, q):
+    count = value[-1]
+    if not count:
+        return None
+    rank = q * count
+    cumulative = 0
+    for bound, n in zip(buckets + (float('inf'),), value):
+        cumulative += n
+        if cumulative >= rank:
+            return bound if bound != float('inf') else buckets[-1]
+    return buckets[-1]
+
+def start_http_server(metrics, host='127.0.0.1', port=9386):
+    # Endpoint /metrics theo định dạng văn bản của Prometheus, /stats (như lệnh STATS) và
+    # /metrics.json (export(), supervisor đọc từ các worker), chạy trên luồng nền.
+    # http.server chỉ được nạp khi bật endpoint để không làm chậm việc khởi động.
+    # metrics là Metrics hoặc đối tượng có cùng các phương thức render_prometheus/snapshot/export
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == '/metrics':
+                body, content_type = metrics.render_prometheus(), 'text/plain; version=0.0.4; charset=utf-8'
+            elif path == '/stats':
+                body, content_type = json.dumps(metrics.snapshot()), 'application/json'
+            elif path == '/metrics.json':
+                body, content_type = json.dumps(metrics.export()), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics-http', daemon=True).start()
+    return httpd
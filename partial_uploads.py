@@ -0,0 +1,264 @@
+import hashlib
+import os
+import time
+from database import get_database
+
+# Một phiên tải lên dở dang chỉ được một kết nối ghi tại một thời điểm. Kết nối giữ quyền (lease)
+# từ UPLOAD_RESUME và gia hạn trong lúc nhận dữ liệu; lease hết hạn thì kết nối khác lấy được,
+# nên kết nối cũ bị treo không giữ phiên mãi. Kết nối đang ghi kiểm tra lại lease sau mỗi
+# LEASE_RENEW giây, trước khi lease có thể hết hạn
+LEASE_SECONDS = 30.0
+LEASE_RENEW = 5.0
+
+class PartialUploadStore:
+    # Giữ các tệp tin tải lên dở dang theo transfer ID để client có thể tải tiếp.
+    # ID được suy ra từ (username, tên tệp tin, kích thước, checksum) nên client
+    # không cần lưu lại gì, chỉ cần gửi lại thông tin tệp tin là tìm được phiên cũ.
+    def __init__(self, db_file='users.db', root='partial_uploads', max_age=7 * 24 * 3600):
+        self.db_file = db_file
+        self.database = get_database(db_file)
+        self.root = root
+        self.max_age = max_age
+        os.makedirs(self.root, exist_ok=True)
+        self._initialize_database()
+
+    def _initialize_database(self):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS partial_uploads (
+                    transfer_id TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    checksum TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    owner TEXT,
+                    lease_until REAL NOT NULL DEFAULT 0
+                )
+            """)
+            # Cơ sở dữ liệu tạo trước khi có lease: owner là "<pid>:<địa chỉ>" của kết nối đang giữ phiên
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(partial_uploads)")]
+            if 'owner' not in columns:
+                cursor.execute("ALTER TABLE partial_uploads ADD COLUMN owner TEXT")
+                cursor.execute("ALTER TABLE partial_uploads ADD COLUMN lease_until REAL NOT NULL DEFAULT 0")
+            conn.commit()
+
+    def make_transfer_id(self, username, filename, size, checksum):
+        key = '\0'.join((username, filename, str(size), checksum))
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def part_path(self, transfer_id):
+        return os.path.join(self.root, f'{transfer_id}.part')
+
+    def open_or_create(self, username, filename, size, checksum):
+        # Trả về (transfer_id, số byte server đã có)
+        transfer_id = self.make_transfer_id(username, filename, size, checksum)
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR IGNORE INTO partial_uploads (transfer_id, username, filename, size, checksum, updated)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (transfer_id, username, filename, size, checksum, time.time()))
+            conn.commit()
+        path = self.part_path(transfer_id)
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        return transfer_id, self.offset(transfer_id)
+
+    def get(self, transfer_id):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT username, filename, size, checksum FROM partial_uploads WHERE transfer_id = ?
+            """, (transfer_id,))
+            result = cursor.fetchone()
+        if result is None:
+            return None
+        username, filename, size, checksum = result
+        return {'username': username, 'filename': filename, 'size': size, 'checksum': checksum}
+
+    def offset(self, transfer_id):
+        try:
+            return os.path.getsize(self.part_path(transfer_id))
+        except OSError:
+            return 0
+
+    def touch(self, transfer_id):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE partial_uploads SET updated = ? WHERE transfer_id = ?
+            """, (time.time(), transfer_id))
+            conn.commit()
+
+    def acquire(self, transfer_id, owner):
+        # Lấy hoặc gia hạn lease; False nếu kết nối khác đang giữ phiên và lease chưa hết hạn
+        now = time.time()
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE partial_uploads SET owner = ?, lease_until = ?
+                WHERE transfer_id = ? AND (owner IS NULL OR owner = ? OR lease_until < ?)
+            """, (owner, now + LEASE_SECONDS, transfer_id, owner, now))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def release(self, transfer_id, owner):
+        self.release_where('transfer_id = ? AND owner = ?', (transfer_id, owner))
+
+    def release_owned(self, owner):
+        # Các phiên của kết nối đã đóng
+        self.release_where('owner = ?', (owner,))
+
+    def release_process(self, pid=None):
+        # Các phiên của một tiến trình worker đã thoát, hoặc mọi phiên (pid None) khi server khởi động
+        if pid is None:
+            self.release_where('owner IS NOT NULL', ())
+        else:
+            self.release_where('owner LIKE ?', (f'{pid}:%',))
+
+    def release_where(self, condition, params):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE partial_uploads SET owner = NULL, lease_until = 0 WHERE {condition}
+            """, params)
+            conn.commit()
+
+    def remove(self, transfer_id, keep_file=False):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM partial_uploads WHERE transfer_id = ?
+            """, (transfer_id,))
+            conn.commit()
+        if not keep_file:
+            try:
+                os.remove(self.part_path(transfer_id))
+            except OSError:
+                pass
+
+    def purge_expired(self):
+        # Xóa các phiên không được tiếp tục trong max_age giây
+        cutoff = time.time() - self.max_age
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT transfer_id FROM partial_uploads WHERE updated < ?
+            """, (cutoff,))
+            expired = [row[0] for row in cursor.fetchall()]
+        for transfer_id in expired:
+            self.remove(transfer_id)
+        return len(expired)
+
+class ParallelUploadStore:
+    # Phiên UPLOAD_PARALLEL. Các kết nối UPLOAD_RANGE của cùng một phiên có thể rơi vào tiến trình
+    # worker khác (--workers) nên trạng thái nằm trong SQLite thay vì trong bộ nhớ của một tiến trình.
+    # owner là "<pid>:<địa chỉ>" của kết nối điều khiển đã mở phiên. filepath là tệp tạm riêng của
+    # server, chỉ được chuyển vào thư mục của người dùng khi UPLOAD_COMMIT. active là số kết nối
+    # UPLOAD_RANGE đang ghi; phiên chỉ được lấy ra để commit khi không còn đoạn nào đang ghi
+    COLUMNS = ('owner', 'username', 'filename', 'filepath', 'size', 'checksum', 'received', 'active')
+
+    def __init__(self, db_file='users.db'):
+        self.db_file = db_file
+        self.database = get_database(db_file)
+        self._initialize_database()
+
+    def _initialize_database(self):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS parallel_uploads (
+                    transfer_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    filepath TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    checksum TEXT NOT NULL,
+                    received INTEGER NOT NULL DEFAULT 0,
+                    active INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(parallel_uploads)")]
+            if 'active' not in columns:
+                cursor.execute("ALTER TABLE parallel_uploads ADD COLUMN active INTEGER NOT NULL DEFAULT 0")
+            conn.commit()
+
+    def create(self, transfer_id, owner, username, filename, filepath, size, checksum):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO parallel_uploads (transfer_id, owner, pid, username, filename, filepath, size, checksum)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (transfer_id, owner, os.getpid(), username, filename, filepath, size, checksum))
+            conn.commit()
+
+    def get(self, transfer_id):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT {', '.join(self.COLUMNS)} FROM parallel_uploads WHERE transfer_id = ?
+            """, (transfer_id,))
+            result = cursor.fetchone()
+        return dict(zip(self.COLUMNS, result)) if result else None
+
+    def begin_range(self, transfer_id):
+        # Đánh dấu một đoạn bắt đầu ghi; False nếu phiên không còn (đã commit hoặc bị hủy)
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE parallel_uploads SET active = active + 1 WHERE transfer_id = ?
+            """, (transfer_id,))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def end_range(self, transfer_id, nbytes):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE parallel_uploads SET received = received + ?, active = active - 1 WHERE transfer_id = ?
+            """, (nbytes, transfer_id))
+            conn.commit()
+
+    def pop(self, transfer_id):
+        # Lấy và xóa phiên nếu không còn đoạn nào đang ghi; None nếu phiên đã bị lấy (ví dụ hai
+        # UPLOAD_COMMIT cùng lúc) hoặc còn đoạn đang ghi. BEGIN IMMEDIATE để không đoạn nào
+        # kết thúc giữa SELECT và DELETE
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(f"""
+                SELECT {', '.join(self.COLUMNS)} FROM parallel_uploads WHERE transfer_id = ?
+            """, (transfer_id,))
+            result = cursor.fetchone()
+            cursor.execute("""
+                DELETE FROM parallel_uploads WHERE transfer_id = ? AND active = 0
+            """, (transfer_id,))
+            conn.commit()
+            return dict(zip(self.COLUMNS, result)) if result and cursor.rowcount else None
+
+    def pop_where(self, condition, params):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT {', '.join(self.COLUMNS)} FROM parallel_uploads WHERE {condition}
+            """, params)
+            results = cursor.fetchall()
+            cursor.execute(f"""
+                DELETE FROM parallel_uploads WHERE {condition}
+            """, params)
+            conn.commit()
+        return [dict(zip(self.COLUMNS, result)) for result in results]
+
+    def pop_owned(self, owner):
+        # Các phiên của kết nối điều khiển đã đóng
+        return self.pop_where('owner = ?', (owner,))
+
+    def pop_process(self, pid=None):
+        # Các phiên của một tiến trình worker đã thoát, hoặc mọi phiên (pid None) khi server khởi động
+        if pid is None:
+            return self.pop_where('1', ())
+        return self.pop_where('pid = ?', (pid,))
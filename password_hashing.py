@@ -0,0 +1,80 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class HashingBusy(Exception):
+    # Hàng đợi băm mật khẩu đã đầy, client nên thử lại sau
+    pass
+
+class PasswordHasher:
+    # Băm mật khẩu bằng scrypt có salt trên một pool luồng giới hạn (hashlib.scrypt nhả GIL).
+    # Số yêu cầu đang chờ bị giới hạn để một đợt đăng nhập dồn dập sau khi khởi động lại
+    # không chiếm hết CPU/bộ nhớ; yêu cầu vượt quá bị từ chối ngay bằng HashingBusy.
+    # Kết quả xác thực thành công được nhớ trong thời gian ngắn để các lần kết nối lại
+    # liên tiếp không phải tính lại KDF.
+    def __init__(self, n=2 ** 14, r=8, p=1, max_workers=4, max_pending=64, cache_ttl=60.0, cache_size=10000):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='kdf')
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.cache_key = os.urandom(32)  # Cache chỉ lưu HMAC của mật khẩu, không lưu mật khẩu
+
+    def _scrypt(self, password, salt, n, r, p):
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=2 * 128 * n * r * p, dklen=32)
+
+    def _run(self, func, *args):
+        if not self.pending.acquire(blocking=False):
+            raise HashingBusy('Password hashing queue is full')
+        try:
+            return self.executor.submit(func, *args).result()
+        finally:
+            self.pending.release()
+
+    def hash(self, password):
+        salt = os.urandom(16)
+        derived = self._run(self._scrypt, password, salt, self.n, self.r, self.p)
+        return f'scrypt${self.n}${self.r}${self.p}${salt.hex()}${derived.hex()}'
+
+    def needs_rehash(self, stored):
+        # Chuỗi SHA-256 kiểu cũ hoặc scrypt với tham số khác cấu hình hiện tại
+        return not stored.startswith(f'scrypt${self.n}${self.r}${self.p}$')
+
+    def verify(self, username, password, stored):
+        # Trả về True nếu mật khẩu khớp với chuỗi đã lưu (scrypt hoặc SHA-256 kiểu cũ)
+        token = hmac.new(self.cache_key, f'{username}\0{password}'.encode(), hashlib.sha256).digest()
+        now = time.monotonic()
+        with self.cache_lock:
+            cached = self.cache.get(username)
+        if cached and cached[1] > now and hmac.compare_digest(cached[0], token):
+            return True
+
+        parts = stored.split('$')
+        if len(parts) == 6 and parts[0] == 'scrypt':
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            derived = self._run(self._scrypt, password, bytes.fromhex(parts[4]), n, r, p)
+            valid = hmac.compare_digest(derived.hex(), parts[5])
+        else:
+            # Định dạng cũ: SHA-256 không salt
+            valid = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+        if valid:
+            with self.cache_lock:
+                if len(self.cache) >= self.cache_size:
+                    self.cache = {user: entry for user, entry in self.cache.items() if entry[1] > now}
+                    if len(self.cache) >= self.cache_size:
+                        self.cache.clear()
+                self.cache[username] = (token, now + self.cache_ttl)
+        return valid
+
+    def forget(self, username):
+        with self.cache_lock:
+            self.cache.pop(username, None)
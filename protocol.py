@@ -0,0 +1,368 @@
+import os
+import selectors
+import socket
+import struct
+
+PROTOCOL_V1 = "1.0"
+PROTOCOL_V2 = "2.0"
+SUPPORTED_VERSIONS = (PROTOCOL_V2, PROTOCOL_V1)
+
+# Giao thức 2.0: mỗi frame gồm 1 byte loại + 4 byte độ dài (big endian) + payload.
+# Frame MESSAGE chứa danh sách trường, mỗi trường có tiền tố độ dài 4 byte, nên
+# tên tệp tin có "|" hay xuống dòng không còn gây nhập nhằng.
+FRAME_HEADER = struct.Struct('!BI')
+FIELD_LENGTH = struct.Struct('!I')
+FRAME_MESSAGE = 1
+FRAME_DATA = 2
+
+DATA_FRAME_SIZE = 1024 * 1024
+READ_BUFFER_SIZE = 64 * 1024
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# Các lệnh giao thức 1.0 dùng dấu cách thay vì "|" để ngăn cách tham số
+_V1_SPACE_COMMANDS = ('VERSION', 'UPLOAD', 'DOWNLOAD')
+# Các phản hồi 1.0 mà phần sau "|" đầu tiên là một chuỗi tự do
+_V1_FREE_TEXT = ('ERROR', 'SUCCESS', 'NEW_FILENAME', 'SERVER_BUSY')
+# poll không giữ file descriptor riêng như epoll, phù hợp với một selector cho mỗi kết nối
+_Selector = getattr(selectors, 'PollSelector', selectors.SelectSelector)
+_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', None)
+# Header frame DATA luôn có payload theo ngay sau (sendall hoặc sendfile): báo kernel gom chung
+# một segment thay vì gửi riêng 5 byte header
+_MORE = getattr(socket, 'MSG_MORE', 0)
+# Frame DATA nhỏ hơn mức này được ghép với header và gửi trong một lần sendall
+COALESCE_LIMIT = 64 * 1024
+
+class ProtocolError(Exception):
+    pass
+
+def pack_fields(fields):
+    parts = []
+    for field in fields:
+        data = field if isinstance(field, bytes) else str(field).encode()
+        parts.append(FIELD_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def unpack_fields(payload):
+    fields = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        if offset + FIELD_LENGTH.size > len(view):
+            raise ProtocolError("Trường bị cắt cụt")
+        (length,) = FIELD_LENGTH.unpack_from(view, offset)
+        offset += FIELD_LENGTH.size
+        if offset + length > len(view):
+            raise ProtocolError("Trường bị cắt cụt")
+        fields.append(bytes(view[offset:offset + length]).decode())
+        offset += length
+    return fields
+
+def encode_message(fields):
+    payload = pack_fields(fields)
+    return FRAME_HEADER.pack(FRAME_MESSAGE, len(payload)) + payload
+
+def encode_data_header(length):
+    return FRAME_HEADER.pack(FRAME_DATA, length)
+
+def set_nodelay(sock):
+    # Giao thức gửi từng message nhỏ rồi chờ phản hồi, Nagle cùng delayed ACK của phía bên kia
+    # làm mỗi lượt chậm khoảng 40 ms. Socket không phải TCP (ví dụ socketpair) thì bỏ qua
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+def format_v1(fields):
+    # Chuyển danh sách trường về đúng dạng văn bản của giao thức 1.0
+    command = fields[0]
+    if command == 'SIZE':
+        return str(fields[1])
+    if command == 'CHECKSUM':
+        return f"CHECKSUM:{fields[1]}"
+    if command == 'FILES':
+        return "\n".join(f"{name}|{size}" for name, size in zip(fields[1::2], fields[2::2]))
+    if command in _V1_SPACE_COMMANDS:
+        return ' '.join(str(field) for field in fields)
+    return '|'.join(str(field) for field in fields)
+
+def parse_v1(line):
+    if not line:
+        return []
+    if line.startswith('CHECKSUM:'):
+        return ['CHECKSUM', line.split(':', 1)[1]]
+    if line.lstrip('-').isdigit():
+        return ['SIZE', line]
+    head = line.split(' ', 1)
+    if head[0] in _V1_SPACE_COMMANDS:
+        return head
+    command = line.split('|', 1)[0]
+    if command in _V1_FREE_TEXT:
+        return line.split('|', 1)
+    return line.split('|')
+
+def parse_v1_file_list(text):
+    files = []
+    for line in text.split('\n'):
+        if '|' in line:
+            name, size = line.rsplit('|', 1)
+            files.append((name, int(size)))
+    return files
+
+def write_at(fd, data, offset):
+    # Ghi toàn bộ data vào fd tại offset; dùng os.pwrite nếu hệ điều hành hỗ trợ
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+class ConnectionReader:
+    # Đọc từ socket vào một bytearray cấp phát sẵn bằng recv_into. Các byte nhận
+    # thừa sau dấu xuống dòng được giữ lại cho lần đọc sau thay vì bị mất.
+    # wakeup là socket/fd trở nên đọc được khi phải dừng (server tắt): socket chặn được đọc
+    # không chờ trước, chỉ khi chưa có dữ liệu mới chờ trên selector gồm socket và wakeup
+    def __init__(self, sock, buffer_size=READ_BUFFER_SIZE, should_stop=None, max_line=MAX_MESSAGE_SIZE,
+                 wakeup=None):
+        self.sock = sock
+        self.should_stop = should_stop
+        self.wakeup = wakeup
+        self.selector = None
+        self.max_line = max_line
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.scanned = 0  # vị trí đã tìm "\n", tránh quét lại từ đầu
+        self.bytes_received = 0
+
+    def buffered(self):
+        return self.end - self.start
+
+    def has_line(self):
+        return self.buffer.find(b'\n', self.start, self.end) >= 0
+
+    def _recv_into(self, view):
+        if self.wakeup is not None:
+            return self._recv_into_or_wake(view)
+        while True:
+            try:
+                n = self.sock.recv_into(view)
+                self.bytes_received += n
+                return n
+            except socket.timeout:
+                if self.should_stop and self.should_stop():
+                    return 0
+
+    def _recv_into_or_wake(self, view):
+        while True:
+            if _DONTWAIT is not None:
+                try:
+                    n = self.sock.recv_into(view, len(view), _DONTWAIT)
+                    self.bytes_received += n
+                    return n
+                except BlockingIOError:
+                    pass
+            if self.selector is None:
+                self.selector = _Selector()
+                self.selector.register(self.sock, selectors.EVENT_READ)
+                self.selector.register(self.wakeup, selectors.EVENT_READ)
+            ready = [key.fileobj for key, _ in self.selector.select()]
+            if self.wakeup in ready:
+                return 0
+            if _DONTWAIT is None:
+                n = self.sock.recv_into(view)
+                self.bytes_received += n
+                return n
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+    def _fill(self):
+        # Dồn dữ liệu còn lại về đầu buffer, nới rộng buffer nếu đã đầy
+        if self.start > 0:
+            remaining = self.end - self.start
+            self.buffer[:remaining] = self.buffer[self.start:self.end]
+            self.scanned -= self.start
+            self.start, self.end = 0, remaining
+        if self.end == len(self.buffer):
+            self.view.release()
+            self.buffer.extend(bytes(len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        n = self._recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def _take(self, size):
+        data = bytes(self.view[self.start:self.start + size])
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        self.scanned = self.start
+        return data
+
+    def read_line(self):
+        # Trả về một dòng (không gồm "\n"), hoặc None khi kết nối đóng trước khi hết dòng
+        self.scanned = max(self.scanned, self.start)
+        while True:
+            index = self.buffer.find(b'\n', self.scanned, self.end)
+            if index >= 0:
+                line = self._take(index - self.start + 1)
+                return line[:-1]
+            self.scanned = self.end
+            if self.end - self.start > self.max_line:
+                raise ProtocolError("Dòng lệnh quá dài")
+            if not self._fill():
+                return None
+
+    def read_exact(self, size):
+        while self.end - self.start < size:
+            if not self._fill():
+                return None
+        return self._take(size)
+
+    def read_into(self, view):
+        # Ưu tiên trả dữ liệu đang có trong buffer, nếu buffer rỗng thì recv thẳng vào view
+        if self.end > self.start:
+            n = min(len(view), self.end - self.start)
+            view[:n] = self.view[self.start:self.start + n]
+            self.start += n
+            if self.start == self.end:
+                self.start = self.end = self.scanned = 0
+            return n
+        return self._recv_into(view)
+
+    def read(self, max_size):
+        buffer = bytearray(max_size)
+        n = self.read_into(memoryview(buffer))
+        del buffer[n:]
+        return bytes(buffer)
+
+class Channel:
+    # Bọc một socket và đọc/ghi message theo phiên bản giao thức đã thỏa thuận.
+    # should_stop được gọi mỗi khi recv hết timeout để thoát khi server tắt; với socket chặn
+    # (không timeout) thì dùng wakeup, xem ConnectionReader.
+    def __init__(self, sock, version=PROTOCOL_V1, should_stop=None, wakeup=None):
+        self.sock = sock
+        self.version = version
+        set_nodelay(sock)
+        self.reader = ConnectionReader(sock, should_stop=should_stop, wakeup=wakeup)
+        self.data_remaining = 0
+        self.bytes_sent = 0  # Chỉ tính các byte gửi qua Channel; ai gửi thẳng vào sock tự cộng thêm
+        # Giới hạn băng thông cho dữ liệu tệp tin (received(n)/sent(n), xem bandwidth.Throttle),
+        # server gắn vào sau khi đăng nhập. Ai gửi thẳng vào sock tự gọi throttle.sent
+        self.throttle = None
+
+    @property
+    def bytes_received(self):
+        return self.reader.bytes_received
+
+    def send_message(self, *fields):
+        if self.version == PROTOCOL_V1:
+            data = f"{format_v1(fields)}\n".encode()
+        else:
+            data = encode_message(fields)
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+    def receive_line(self):
+        line = self.reader.read_line()
+        return line.decode().strip() if line is not None else ''
+
+    def receive_text(self):
+        # Phản hồi nhiều dòng của giao thức 1.0 (LIST): đọc một dòng rồi lấy thêm các
+        # dòng trọn vẹn đã nằm sẵn trong buffer
+        lines = [self.receive_line()]
+        while self.reader.has_line():
+            lines.append(self.receive_line())
+        return '\n'.join(lines)
+
+    def receive_message(self):
+        # Trả về danh sách trường, hoặc [] khi kết nối đã đóng
+        if self.version == PROTOCOL_V1:
+            return parse_v1(self.receive_line())
+        header = self.reader.read_exact(FRAME_HEADER.size)
+        if header is None:
+            return []
+        frame_type, length = FRAME_HEADER.unpack(header)
+        if frame_type != FRAME_MESSAGE:
+            raise ProtocolError(f"Frame không mong đợi: {frame_type}")
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"Message quá lớn: {length} bytes")
+        payload = self.reader.read_exact(length)
+        if payload is None:
+            return []
+        return unpack_fields(payload)
+
+    def send_messages(self, messages):
+        # Gửi nhiều message trong một lần sendall, dùng cho các phản hồi gồm nhiều dòng (2.0)
+        data = b''.join(encode_message(fields) for fields in messages)
+        self.sock.sendall(data)
+        self.bytes_sent += len(data)
+
+    def send_data_header(self, length):
+        if self.version != PROTOCOL_V1:
+            self.sock.sendall(encode_data_header(length), _MORE)
+            self.bytes_sent += FRAME_HEADER.size
+
+    def send_data(self, data):
+        if self.version != PROTOCOL_V1 and len(data) <= COALESCE_LIMIT:
+            self.sock.sendall(encode_data_header(len(data)) + data)
+            self.bytes_sent += FRAME_HEADER.size + len(data)
+        else:
+            self.send_data_header(len(data))
+            self.sock.sendall(data)
+            self.bytes_sent += len(data)
+        if self.throttle is not None:
+            self.throttle.sent(len(data))
+
+    def receive_data(self, max_size):
+        # Đọc tối đa max_size byte dữ liệu tệp tin, b'' khi kết nối đã đóng
+        buffer = bytearray(max_size)
+        n = self.receive_data_into(memoryview(buffer))
+        del buffer[n:]
+        return bytes(buffer)
+
+    def receive_data_into(self, view):
+        # Ghi dữ liệu tệp tin vào view, trả về số byte đã nhận (0 khi kết nối đã đóng)
+        if self.version == PROTOCOL_V1:
+            n = self.reader.read_into(view)
+        else:
+            while self.data_remaining == 0:
+                header = self.reader.read_exact(FRAME_HEADER.size)
+                if header is None:
+                    return 0
+                frame_type, length = FRAME_HEADER.unpack(header)
+                if frame_type != FRAME_DATA:
+                    raise ProtocolError(f"Frame không mong đợi: {frame_type}")
+                self.data_remaining = length
+            n = self.reader.read_into(view[:min(len(view), self.data_remaining)])
+            self.data_remaining -= n
+        if n and self.throttle is not None:
+            self.throttle.received(n)
+        return n
+
+    def receive_data_frame(self):
+        # Đọc trọn một frame DATA (mỗi frame là một khối nén độc lập), None khi kết nối đã đóng
+        header = self.reader.read_exact(FRAME_HEADER.size)
+        if header is None:
+            return None
+        frame_type, length = FRAME_HEADER.unpack(header)
+        if frame_type != FRAME_DATA:
+            raise ProtocolError(f"Frame không mong đợi: {frame_type}")
+        if length > MAX_MESSAGE_SIZE:
+            raise ProtocolError(f"Frame quá lớn: {length} bytes")
+        frame = self.reader.read_exact(length)
+        if frame and self.throttle is not None:
+            self.throttle.received(len(frame))
+        return frame
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
@@ -3,105 +3,521 @@ import threading
 import os
 from pathlib import Path
 from users import UserManager
+from password_hashing import HashingBusy
+from checksum_index import ChecksumIndex
+from file_index import FileIndex, SORT_COLUMNS
+from partial_uploads import PartialUploadStore, ParallelUploadStore, LEASE_RENEW
+from limit_store import LimitStore
+from blob_store import BlobStore
+from delta import block_size_for, make_signature
+from archive import member_path, normalize_member, walk_tree
+from metrics import Metrics, THROUGHPUT_BUCKETS, start_http_server
+from tracing import Tracer, Profiler, PhaseTimer, format_address
+from bandwidth import BandwidthScheduler, THROTTLE_QUANTUM, DOWNLOAD, parse_rate
+from log_pipeline import LOG_DIR, DEBUG_RATE, configure_logging, shutdown_logging, log_transfer
+from compression import SAMPLE_SIZE, available_codecs, choose_codec, compress, decompress, describe_ratio
+from protocol import Channel, SUPPORTED_VERSIONS, PROTOCOL_V1, DATA_FRAME_SIZE, write_at
 import hashlib
-import requests
+import sys
 import logging
-import datetime
-
-LOG_DIR = 'logs'
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
-
-log_file = os.path.join(LOG_DIR, f'server_{datetime.datetime.now().strftime('%d%m%Y_%H%M%S')}.log')
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
+import argparse
+import selectors
+import queue
+import time
+import uuid
+import json
+from contextlib import contextmanager
+
+FALLBACK_BUFFER_SIZE = 1024 * 1024
+RECEIVE_BUFFER_SIZE = 256 * 1024
+MAX_LIST_PAGE = 1000
+MAX_BATCH_FILES = 10000
+MAX_CONNECTIONS = 1000  # Số kết nối được phục vụ cùng lúc, mỗi kết nối một luồng worker
+ACCEPT_QUEUE = 256  # Số kết nối đã accept đang chờ worker rảnh, quá số này thì trả SERVER_BUSY
+LISTEN_BACKLOG = 1024
+SHUTDOWN_GRACE = 2.0
+LIMIT_SYNC_INTERVAL = 1.0  # Chu kỳ worker đọc lại giới hạn băng thông dùng chung
+# Lệnh được ghi nhãn riêng trong metrics; lệnh lạ gộp chung thành UNKNOWN để số nhãn có giới hạn
+METRIC_COMMANDS = frozenset((
+    'LOGIN', 'SIGNUP', 'UPLOAD', 'UPLOAD_FILE', 'UPLOAD_BATCH', 'UPLOAD_DIR', 'DOWNLOAD', 'DOWNLOAD_DIR',
+    'LIST', 'LIST_PAGE', 'UPLOAD_PARALLEL', 'UPLOAD_RANGE', 'UPLOAD_COMMIT', 'UPLOAD_RESUME',
+    'UPLOAD_STATUS', 'UPLOAD_APPEND', 'UPLOAD_ABORT', 'UPLOAD_DELTA', 'DOWNLOAD_INFO', 'DOWNLOAD_RANGE',
+    'STATS', 'TRACE', 'PROFILE', 'LIMIT',
+))
+PROFILE_KINDS = ('cpu', 'memory')
+MAX_PROFILE_SECONDS = 3600
+PUBLIC_IP_URL = 'https://api.ipify.org?format=json'
+PUBLIC_IP_TIMEOUT = 5.0
 
 class FileTransferServer:
-    def __init__(self, host='0.0.0.0', port=8386):
+    def __init__(self, host='0.0.0.0', port=8386, use_sendfile=True, admins=(), metrics_port=None, trace=False,
+                 discover_public_ip=True, ready_file=None, bandwidth_limit=0, max_connections=MAX_CONNECTIONS,
+                 accept_queue=ACCEPT_QUEUE, listen_backlog=LISTEN_BACKLOG, reuse_port=False, worker_id=None):
+        self.startup_began = time.perf_counter()
         self.host = host
         self.port = port
+        self.use_sendfile = use_sendfile and hasattr(os, 'sendfile')
+        self.download_stats = {}
+        self.stats_lock = threading.Lock()
+        self.admins = set(admins)  # Người dùng được phép gọi STATS, TRACE, PROFILE, LIMIT
+        self.metrics = Metrics()
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.closed_channel_bytes = {'bytes_sent': 0, 'bytes_received': 0}
+        self.channel_bytes_lock = threading.Lock()
+        self.tracer = Tracer(trace)
+        self.profiler = Profiler(os.path.join(LOG_DIR, 'profiles'))
         self.user_manager = UserManager()
+        self.checksum_index = ChecksumIndex(self.user_manager.db_file)
+        self.file_index = FileIndex(self.user_manager.db_file)
+        self.indexed_users = set()
+        self.index_lock = threading.Lock()
+        self.partial_uploads = PartialUploadStore(self.user_manager.db_file)
+        expired = self.partial_uploads.purge_expired()
+        if expired:
+            logging.info(f'Removed {expired} expired partial uploads')
+        self.parallel_uploads = ParallelUploadStore(self.user_manager.db_file)
+        # worker_id: số thứ tự tiến trình worker khi chạy dưới supervisor (--workers), nhiều
+        # worker cùng nghe một cổng bằng SO_REUSEPORT. Khi đó supervisor dọn các phiên song song
+        # của worker đã thoát; server đơn lẻ thì mọi phiên còn lại đều của lần chạy trước
+        self.worker_id = worker_id
+        self.reuse_port = reuse_port
+        if worker_id is None:
+            self.discard_parallel_uploads(self.parallel_uploads.pop_process())
+            self.partial_uploads.release_process()
+            self.limit_store = None
+        else:
+            # Giới hạn băng thông đổi bằng LIMIT phải có hiệu lực ở mọi worker
+            self.limit_store = LimitStore(self.user_manager.db_file)
+        self.limit_counts = {}  # Số worker đang phục vụ từng người dùng, theo lần đồng bộ gần nhất
+        self.blob_store = BlobStore()
+        self.discover_public_ip = discover_public_ip
+        self.ready_file = ready_file
         self.active_users = {}
         self.shutdown_event = threading.Event()
-        self.client_threads = []
+        self.bandwidth = BandwidthScheduler(bandwidth_limit, self.shutdown_event.wait, self.metrics)
+        self.max_connections = max_connections
+        self.accept_queue = accept_queue
+        self.listen_backlog = listen_backlog
+        # Pool worker có giới hạn: luồng được tạo dần khi không còn worker rảnh, tối đa
+        # max_connections luồng, và được giữ lại cho các kết nối sau
+        self.pending_connections = queue.Queue()
+        self.workers = 0
+        self.idle_workers = 0
+        self.admitted = 0  # Kết nối đang được phục vụ hoặc đang chờ worker
+        self.admission = threading.Condition()
+        # Ghi một byte vào wakeup_writer khi tắt: selector của vòng accept và của mọi kết nối
+        # đang chờ dữ liệu cùng thức dậy, không cần timeout để định kỳ kiểm tra shutdown_event
+        self.wakeup_reader = self.wakeup_writer = None
+        self.client_channels = {}
+        self.capabilities = ['parallel', 'resume', 'dedup', 'delta', 'list_page', 'batch', 'archive']
+        self.capabilities += [f'compress:{codec}' for codec in available_codecs()]
+        self.transfers_lock = threading.Lock()
         self.server_socket = None
+        self.register_metrics()
         logging.info(f'Server initialized')
+
+    def register_metrics(self):
+        metrics = self.metrics
+        metrics.gauge('connections_active', 'Open client connections', lambda: len(self.client_channels))
+        metrics.gauge('users_logged_in', 'Distinct users with at least one logged-in connection',
+                      lambda: len(set(list(self.active_users.values()))))
+        metrics.counter('connections_total', 'Accepted client connections')
+        metrics.counter('connections_rejected_total', 'Connections refused with SERVER_BUSY')
+        metrics.gauge('connections_queued', 'Accepted connections waiting for a worker thread',
+                      lambda: max(0, self.admitted - len(self.client_channels)))
+        metrics.gauge('received_bytes_total', 'Bytes received from clients',
+                      lambda: self.channel_bytes('bytes_received'), kind='counter')
+        metrics.gauge('sent_bytes_total', 'Bytes sent to clients',
+                      lambda: self.channel_bytes('bytes_sent'), kind='counter')
+        metrics.histogram('command_duration_seconds', 'Time to handle one protocol command')
+        metrics.counter('transfer_bytes_total', 'File payload bytes transferred')
+        metrics.histogram('transfer_throughput_bytes_per_second', 'Throughput of completed file transfers',
+                          THROUGHPUT_BUCKETS)
+        metrics.counter('throttle_delay_seconds_total', 'Time transfers waited for the bandwidth limit')
+        metrics.gauge('bandwidth_limit_bytes_per_second', 'Server-wide bandwidth limit per direction (0 = unlimited)',
+                      lambda: self.bandwidth.rate)
+        metrics.histogram('checksum_duration_seconds', 'Time to compute a full-file SHA-256 checksum')
+        metrics.histogram('sqlite_duration_seconds', 'Time spent in one SQLite transaction block')
+        self.user_manager.database.observer = lambda seconds: metrics.observe('sqlite_duration_seconds', seconds)
+
+    def channel_bytes(self, attribute):
+        # Tổng của các kết nối đã đóng cộng với các kết nối đang mở
+        with self.channel_bytes_lock:
+            return self.closed_channel_bytes[attribute] + sum(
+                getattr(channel, attribute, 0) for channel in list(self.client_channels.values()))
+
+    def retire_channel(self, address, channel):
+        with self.channel_bytes_lock:
+            for attribute in self.closed_channel_bytes:
+                self.closed_channel_bytes[attribute] += getattr(channel, attribute, 0)
+            self.client_channels.pop(address, None)
+
+    def record_transfer(self, direction, nbytes, elapsed, **details):
+        # details (name, user, address, method...) đi vào bản ghi JSON của lần truyền này
+        self.metrics.inc('transfer_bytes_total', nbytes, direction=direction)
+        if elapsed > 0 and nbytes:
+            self.metrics.observe('transfer_throughput_bytes_per_second', nbytes / elapsed, direction=direction)
+        if details.get('address') is not None:
+            details['address'] = format_address(details['address'])
+        log_transfer(direction=direction, bytes=nbytes, seconds=round(elapsed, 6), **details)
+
+    def start_metrics_endpoint(self):
+        if self.metrics_port is None:
+            return
+        try:
+            self.metrics_server = start_http_server(self.metrics, '127.0.0.1', self.metrics_port)
+            # Cổng 0: hệ điều hành chọn cổng (worker dưới supervisor), ghi lại cổng thật
+            self.metrics_port = self.metrics_server.server_address[1]
+            logging.info(f'Metrics endpoint on http://127.0.0.1:{self.metrics_port}/metrics')
+        except OSError as e:
+            logging.error(f'Could not start metrics endpoint on port {self.metrics_port}: {e}')
+
+    def stop_metrics_endpoint(self):
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
         
     def generate_file_checksum(self, file_path):
+        start_time = time.perf_counter()
         sha256_hash = hashlib.sha256()
-        with open(file_path, "rb") as f:
+        with self.tracer.span('checksum', path=file_path), open(file_path, "rb") as f:
             for byte_block in iter(lambda: f.read(4096), b""):
                 sha256_hash.update(byte_block)
+        self.metrics.observe('checksum_duration_seconds', time.perf_counter() - start_time)
         return sha256_hash.hexdigest()
 
+    def get_file_checksum(self, file_path):
+        # Chỉ đọc lại toàn bộ tệp tin khi chưa có checksum hợp lệ trong index
+        with self.tracer.span('checksum_lookup') as span:
+            checksum = self.checksum_index.lookup(file_path)
+            span.set(hit=checksum is not None)
+        if checksum is None:
+            checksum = self.generate_file_checksum(file_path)
+            self.checksum_index.store(file_path, checksum)
+        return checksum
+
+    def store_uploaded_file(self, username, filepath, checksum):
+        # Gộp nội dung trùng vào kho blob trước rồi mới ghi index vì inode có thể đổi
+        with self.tracer.span('dedup') as span:
+            deduplicated = self.blob_store.add(filepath, checksum, self.blob_matches)
+            span.set(deduplicated=deduplicated)
+        if deduplicated:
+            logging.info(f'Deduplicated {filepath} against stored content {checksum}')
+        with self.tracer.span('store_metadata'):
+            self.checksum_index.store(filepath, checksum)
+            # Tệp tin vừa trở thành blob: ghi checksum của blob để lần kiểm tra sau không phải băm lại
+            blob = self.blob_store.lookup(checksum, os.path.getsize(filepath))
+            if blob is not None and os.path.samefile(blob, filepath):
+                self.checksum_index.store(blob, checksum)
+            self.file_index.record(username, filepath, checksum, self.relative_name(username, filepath))
+
+    def blob_matches(self, blob, checksum):
+        # Index theo stat nên chỉ băm lại khi blob đã bị thay đổi kể từ lần kiểm tra trước
+        if self.get_file_checksum(blob) == checksum:
+            return True
+        logging.warning(f'Stored content {checksum} no longer matches its checksum')
+        return False
+
+    def relative_name(self, username, filepath):
+        # Tên trong index/LIST: đường dẫn tương đối với thư mục của người dùng, ngăn cách bằng "/"
+        storage_dir = self.user_manager.get_user_storage(username)
+        return os.path.relpath(filepath, storage_dir).replace(os.sep, '/')
+
+    def link_existing_content(self, username, filename, filesize, checksum):
+        # Tải lên tức thì: nếu người dùng đã lưu nội dung này thì chỉ tạo liên kết, không nhận byte nào.
+        # Chỉ xét tệp tin của chính người dùng: checksum do client tự khai nên không chứng minh được
+        # client có nội dung, biết checksum của tệp tin người khác không được lấy tệp tin đó.
+        # Trả về tên tệp tin đã lưu, hoặc None nếu client phải gửi dữ liệu
+        storage_dir = self.user_manager.get_user_storage(username)
+        self.ensure_file_index(username, storage_dir)
+        owned = self.file_index.find_content(username, checksum, filesize)
+        owned_path = member_path(storage_dir, owned) if owned else None
+        if owned_path is None or not os.path.isfile(owned_path):
+            return None
+        # Kiểm tra blob trước khi giữ khóa vì có thể phải băm lại cả tệp tin
+        if self.blob_store.lookup(checksum, filesize, self.blob_matches) is None:
+            return None
+        with self.transfers_lock:
+            filename = self.resolve_upload_filename(username, storage_dir, filename)
+            filepath = os.path.join(storage_dir, filename)
+            if not self.blob_store.link(checksum, filesize, filepath):
+                return None
+        self.checksum_index.store(filepath, checksum)
+        self.file_index.record(username, filepath, checksum)
+        return filename
+
+    def ensure_file_index(self, username, storage_dir):
+        # Lần đầu dùng tới một người dùng kể từ khi server khởi động thì đối chiếu index với đĩa
+        with self.index_lock:
+            if username in self.indexed_users:
+                return
+            changed = self.file_index.reconcile(username, storage_dir)
+            self.indexed_users.add(username)
+        if changed:
+            logging.info(f'Reconciled file index for {username}: {changed} entries updated')
+
+    def resolve_upload_filename(self, username, storage_dir, filename):
+        # Thêm hậu tố " (n)" nếu tên tệp tin đã tồn tại. Các tên đã dùng lấy từ index trong một
+        # truy vấn; chỉ kiểm tra trên đĩa tên được chọn để tránh trùng tệp tin đang tải lên dở
+        with self.tracer.span('resolve_name'):
+            self.ensure_file_index(username, storage_dir)
+            taken = self.file_index.taken_names(username, filename)
+            file_base, file_ext = os.path.splitext(filename)
+            candidate, counter = filename, 1
+            while candidate in taken or os.path.exists(os.path.join(storage_dir, candidate)):
+                candidate = f'{file_base} ({counter}){file_ext}'
+                counter += 1
+            return candidate
+
+    def claim_upload_name(self, username, storage_dir, filename, directory=False):
+        # Chọn tên như resolve_upload_filename rồi tạo ngay tệp tin rỗng (hoặc thư mục) bằng O_EXCL
+        # để giữ tên. Các worker (--workers) dùng chung thư mục lưu trữ nên khóa trong một tiến trình
+        # không đủ: tiến trình tạo trước được tên, tiến trình còn lại chọn tên kế tiếp
+        while True:
+            candidate = self.resolve_upload_filename(username, storage_dir, filename)
+            path = os.path.join(storage_dir, candidate)
+            try:
+                if directory:
+                    os.mkdir(path)
+                else:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+                return candidate
+            except FileExistsError:
+                continue
+
+    def list_user_files(self, username, storage_dir):
+        with self.tracer.span('list_index'):
+            self.ensure_file_index(username, storage_dir)
+            return self.file_index.list(username)
+
+    def send_file(self, client_socket, f, count, throttle=None):
+        # Trả về (phương thức đã dùng, số byte đã gửi)
+        if self.use_sendfile:
+            try:
+                return 'sendfile', self._send_file_zero_copy(client_socket, f, count, throttle)
+            except NotImplementedError:
+                pass
+        return 'buffered', self._send_file_buffered(client_socket, f, count, throttle)
+
+    def send_payload(self, channel, f, count):
+        # Giao thức 2.0 chia dữ liệu thành các frame DATA, mỗi frame vẫn gửi bằng sendfile
+        if channel.version == PROTOCOL_V1:
+            method, sent = self.send_file(channel.sock, f, count, channel.throttle)
+            channel.bytes_sent += sent
+            return method, sent
+        method, total_sent = 'buffered', 0
+        while total_sent < count and not self.shutdown_event.is_set():
+            frame_size = min(DATA_FRAME_SIZE, count - total_sent)
+            channel.send_data_header(frame_size)
+            method, sent = self.send_file(channel.sock, f, frame_size, channel.throttle)
+            channel.bytes_sent += sent
+            total_sent += sent
+            if sent < frame_size:
+                raise IOError('Tệp tin bị thay đổi trong khi gửi')
+        return method, total_sent
+
+    def send_compressed_payload(self, channel, f, count, codec):
+        # Mỗi khối DATA_FRAME_SIZE byte được nén thành một frame riêng.
+        # Trả về (số byte gốc đã gửi, số byte thực sự đi qua mạng)
+        total_sent = wire_bytes = 0
+        while total_sent < count and not self.shutdown_event.is_set():
+            data = f.read(min(DATA_FRAME_SIZE, count - total_sent))
+            if not data:
+                raise IOError('Tệp tin bị thay đổi trong khi gửi')
+            frame = compress(codec, data)
+            channel.send_data(frame)
+            total_sent += len(data)
+            wire_bytes += len(frame)
+        return total_sent, wire_bytes
+
+    def _send_file_zero_copy(self, client_socket, f, count, throttle=None):
+        # Kernel copy thẳng từ page cache sang socket, không qua user space
+        try:
+            fileno = f.fileno()
+        except (AttributeError, OSError):
+            raise NotImplementedError('file has no file descriptor')
+        offset = f.tell()
+        timeout = client_socket.gettimeout()
+        total_sent = 0
+        with selectors.DefaultSelector() as selector:
+            selector.register(client_socket, selectors.EVENT_WRITE)
+            while total_sent < count:
+                if self.shutdown_event.is_set():
+                    break
+                if timeout is not None and not selector.select(timeout):
+                    continue
+                chunk = count - total_sent
+                if throttle is not None and throttle.limited(DOWNLOAD):
+                    chunk = min(chunk, THROTTLE_QUANTUM)
+                try:
+                    sent = os.sendfile(client_socket.fileno(), fileno, offset, chunk)
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    if total_sent == 0:
+                        # sendfile không dùng được cho cặp fd này, chuyển sang vòng lặp buffer
+                        raise NotImplementedError(str(e))
+                    raise
+                if sent == 0:
+                    break  # EOF
+                offset += sent
+                total_sent += sent
+                if throttle is not None:
+                    throttle.sent(sent)
+        f.seek(offset)
+        return total_sent
+
+    def _send_file_buffered(self, client_socket, f, count, throttle=None):
+        total_sent = 0
+        buffer = bytearray(FALLBACK_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while total_sent < count and not self.shutdown_event.is_set():
+            chunk = FALLBACK_BUFFER_SIZE
+            if throttle is not None and throttle.limited(DOWNLOAD):
+                chunk = THROTTLE_QUANTUM
+            n = f.readinto(view[:min(chunk, count - total_sent)])
+            if not n:
+                break
+            client_socket.sendall(view[:n])
+            total_sent += n
+            if throttle is not None:
+                throttle.sent(n)
+        return total_sent
+
+    def record_download(self, method, nbytes, elapsed, filename, address):
+        self.record_transfer('download', nbytes, elapsed, name=filename, user=self.active_users.get(address),
+                             address=address, method=method)
+        with self.stats_lock:
+            stats = self.download_stats.setdefault(method, {'transfers': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['transfers'] += 1
+            stats['bytes'] += nbytes
+            stats['seconds'] += elapsed
+        throughput = nbytes / elapsed / (1024 * 1024) if elapsed > 0 else 0.0
+        logging.info(f'File {filename} sent to {address} via {method}: '
+                     f'{nbytes} bytes in {elapsed:.3f}s ({throughput:.1f} MB/s)')
+
+    def get_download_stats(self):
+        with self.stats_lock:
+            return {method: dict(stats) for method, stats in self.download_stats.items()}
+
     def start(self):
         try:
+            self.wakeup_reader, self.wakeup_writer = socket.socketpair()
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.reuse_port:
+                # Các worker cùng bind một cổng, kernel chia kết nối mới cho các socket nghe
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            self.server_socket.settimeout(1.0)
-            
-            logging.info(f'Server running on {self.host}:{self.port}')
-            logging.info(f'Local IP address: {self.get_local_ip()}')
-            logging.info(f'Public IP address: {self.get_public_ip()}')
-            print(f"Server đang chạy trên {self.host}:{self.port}")
-            local_ip = self.get_local_ip()
-            public_ip = self.get_public_ip()
-            print(f"Địa chỉ IP local: {local_ip}")
-            print(f"Địa chỉ IP public: {public_ip}")
+            self.server_socket.listen(self.listen_backlog)
+            self.server_socket.setblocking(False)
+            self.start_metrics_endpoint()
+            self.mark_ready(self.server_socket.getsockname()[1])
+            self.start_background_startup()
 
-            while not self.shutdown_event.is_set():
-                try:
-                    client_socket, addr = self.server_socket.accept()
-                    print(f"Đã kết nối từ {addr}")
-                    logging.info(f"New connection accepted from {addr}")
-                    client_handler = threading.Thread(
-                        target=self.handle_client, 
-                        args=(client_socket, addr),
-                        daemon=True
-                    )
-                    client_handler.start()
-                    self.client_threads.append(client_handler)
-                except socket.timeout:
-                    continue
-                except OSError:
-                    break
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.server_socket, selectors.EVENT_READ)
+                selector.register(self.wakeup_reader, selectors.EVENT_READ)
+                while not self.shutdown_event.is_set():
+                    selector.select()
+                    self.accept_connections()
 
         except KeyboardInterrupt:
             logging.info("Keyboard interrupt received")
-            print("Server shutdown initiated by keyboard interrupt")
         except Exception as e:
             logging.error(f"Unexpected error: {str(e)}")
         finally:
-            # Ensure shutdown is called and logs are flushed
             self.shutdown()
-            for handler in logging.getLogger().handlers:
-                handler.flush()
+
+    def accept_connections(self):
+        # Nhận hết các kết nối đang chờ trong backlog của socket nghe
+        while not self.shutdown_event.is_set():
+            try:
+                client_socket, addr = self.server_socket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if not self.shutdown_event.is_set():
+                    # Thường là hết file descriptor; chờ một chút thay vì quay vòng liên tục
+                    logging.error(f'Error accepting connection: {e}')
+                    self.shutdown_event.wait(0.1)
+                return
+            client_socket.setblocking(True)
+            logging.info(f"New connection accepted from {addr}")
+            self.admit(client_socket, addr)
+
+    def admit(self, client_socket, address):
+        # Tối đa max_connections kết nối được phục vụ cùng lúc và accept_queue kết nối chờ
+        # worker rảnh; quá số đó thì trả SERVER_BUSY rồi đóng ngay
+        with self.admission:
+            accepted = self.admitted < self.max_connections + self.accept_queue
+            spawn = False
+            if accepted:
+                self.admitted += 1
+                if self.idle_workers:
+                    self.idle_workers -= 1  # Giữ chỗ worker rảnh cho kết nối này
+                elif self.workers < self.max_connections:
+                    self.workers += 1
+                    spawn = True
+        if not accepted:
+            self.reject_busy(client_socket, address)
+            return
+        self.pending_connections.put((client_socket, address))
+        if spawn:
+            threading.Thread(target=self.connection_worker, name=f'ft-conn-{self.workers}', daemon=True).start()
+
+    def connection_worker(self):
+        while True:
+            item = self.pending_connections.get()
+            if item is None:
+                return
+            client_socket, address = item
+            try:
+                self.handle_client(client_socket, address)
+            finally:
+                with self.admission:
+                    self.admitted -= 1
+                    self.idle_workers += 1
+                    self.admission.notify_all()
+
+    def reject_busy(self, client_socket, address):
+        # Bắt tay dùng dòng văn bản nên client ở phiên bản nào cũng đọc được phản hồi này
+        # ở vị trí của VERSION_OK
+        logging.warning(f'Connection limit reached, rejecting {address}')
+        self.metrics.inc('connections_rejected_total')
+        try:
+            Channel(client_socket).send_message("SERVER_BUSY", "Server đang bận, vui lòng thử lại sau")
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    def wake(self):
+        if self.wakeup_writer is not None:
+            try:
+                self.wakeup_writer.send(b'\0')
+            except OSError:
+                pass
 
     def shutdown(self):
         try:
             logging.info('Starting server shutdown sequence...')
-            print('Server is closing...\n')
+            self.clear_ready()
             self.shutdown_event.set()
+            self.wake()
 
             # Notify all clients
             for addr, username in list(self.active_users.items()):
                 try:
-                    client_socket = next(
-                        thread._args[0] for thread in self.client_threads
-                        if thread._args[1] == addr
-                    )
-                    self.send_message(client_socket, "SERVER_SHUTDOWN")
+                    channel = self.client_channels[addr]
+                    # Client không đọc nữa thì không để việc thông báo chặn quá trình tắt
+                    channel.sock.settimeout(SHUTDOWN_GRACE)
+                    self.send_message(channel, "SERVER_SHUTDOWN")
                     logging.info(f'Notified client {username} at {addr} about shutdown')
                 except Exception as e:
                     logging.error(f'Failed to notify client {addr}: {str(e)}')
-                    print(f'Không thể thông báo cho client {addr} về việc tắt server: {e}')
                     
             # Close server socket
             if self.server_socket:
@@ -111,283 +527,1390 @@ class FileTransferServer:
                 except Exception as e:
                     logging.error(f'Error closing server socket: {str(e)}')
             
+            self.stop_metrics_endpoint()
+
             # Clean up active users
             for addr in list(self.active_users.keys()):
                 if addr in self.active_users:
                     logging.info(f'Removing active user at {addr}')
                     del self.active_users[addr]
             
-            # Join client threads
-            for thread in self.client_threads:
-                try:
-                    thread.join(timeout=2.0)
-                    logging.info(f'Client thread joined: {thread.name}')
-                except Exception as e:
-                    logging.error(f'Error joining thread {thread.name}: {str(e)}')
-            
+            # Chờ các worker kết thúc; kết nối nào còn kẹt (ví dụ đang gửi cho client không đọc)
+            # thì bị shutdown socket để lệnh gửi/nhận đang chặn trả về ngay
+            with self.admission:
+                if not self.admission.wait_for(lambda: self.admitted == 0, SHUTDOWN_GRACE):
+                    logging.warning(f'{self.admitted} connections still open, closing them')
+                    for channel in list(self.client_channels.values()):
+                        try:
+                            channel.sock.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+                    self.admission.wait_for(lambda: self.admitted == 0, SHUTDOWN_GRACE)
+            for _ in range(self.workers):
+                self.pending_connections.put(None)
+
             logging.info('Server shutdown completed')
-            print('Server đã tắt')
-            
-            # Ensure all logs are written
-            for handler in logging.getLogger().handlers:
-                handler.flush()
-                handler.close()
-                
+
         except Exception as e:
             logging.critical(f'Unexpected error during shutdown: {str(e)}')
             raise
 
-    def version_check(self, client_socket):
-        version_msg = self.receive_message(client_socket)
-        if version_msg.startswith("VERSION"):
-            client_version = version_msg.split()[1]
-            if client_version == "1.0":
-                self.send_message(client_socket, "VERSION_OK")
-                return True
+    def version_check(self, channel):
+        # Bắt tay luôn dùng dòng văn bản; sau VERSION_OK hai bên chuyển sang phiên bản đã chọn
+        version_msg = self.receive_message(channel)
+        if len(version_msg) == 2 and version_msg[0] == "VERSION" and version_msg[1] in SUPPORTED_VERSIONS:
+            if version_msg[1] == PROTOCOL_V1:
+                self.send_message(channel, "VERSION_OK")
             else:
-                self.send_message(client_socket, "VERSION_ERROR")
-                client_socket.close()
-                return False
-        else:
-            self.send_message(client_socket, "VERSION_ERROR")
-            client_socket.close()
-            return False
+                # Client 2.0 nhận kèm danh sách tính năng mở rộng mà server hỗ trợ
+                self.send_message(channel, "VERSION_OK", *self.capabilities)
+            channel.version = version_msg[1]
+            return True
+        self.send_message(channel, "VERSION_ERROR")
+        channel.close()
+        return False
         
+    def mark_ready(self, port):
+        # Tín hiệu sẵn sàng cho trình điều phối: dòng log có thời gian khởi động (tính từ lúc
+        # tạo server) và, nếu được yêu cầu, tệp tin ready ghi nguyên tử
+        elapsed_ms = (time.perf_counter() - self.startup_began) * 1000
+        logging.info(f'Server ready on {self.host}:{port}, accepting connections after {elapsed_ms:.1f} ms')
+        if self.ready_file:
+            temp_path = f'{self.ready_file}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump({'pid': os.getpid(), 'host': self.host, 'port': port,
+                           'startup_ms': round(elapsed_ms, 1), 'metrics_port': self.metrics_port,
+                           'worker': self.worker_id}, f)
+            os.replace(temp_path, self.ready_file)
+
+    def clear_ready(self):
+        if self.ready_file:
+            try:
+                os.remove(self.ready_file)
+            except FileNotFoundError:
+                pass
+
+    def start_background_startup(self):
+        # Các việc không cần xong trước khi nhận kết nối chạy trên luồng nền
+        threading.Thread(target=self.background_startup, name='startup-tasks', daemon=True).start()
+        if self.limit_store is not None:
+            threading.Thread(target=self.limit_sync_loop, name='limit-sync', daemon=True).start()
+
+    def limit_sync_loop(self):
+        while True:
+            try:
+                self.sync_limits()
+            except Exception as e:
+                logging.warning(f'Could not sync bandwidth limits: {e}')
+            if self.shutdown_event.wait(LIMIT_SYNC_INTERVAL):
+                return
+
+    def sync_limits(self):
+        # Worker dưới supervisor: đọc giới hạn chung và giới hạn của các người dùng đang kết nối từ
+        # cơ sở dữ liệu, mỗi giới hạn chia đều cho các worker đang phục vụ (người dùng đó). Tổng
+        # băng thông của cả nhóm vì vậy không vượt giới hạn, sai lệch tối đa LIMIT_SYNC_INTERVAL giây
+        active = set(self.active_users.values())
+        counts = self.limit_counts = self.limit_store.publish(os.getpid(), active)
+        self.bandwidth.set_rate(self.share_rate(self.limit_store.get_global(), counts.get('', 1)))
+        caps = self.user_manager.get_bandwidth_limits(active) if active else {}
+        for username in active:
+            self.bandwidth.set_user_rate(username, self.share_rate(caps.get(username, 0), counts.get(username, 1)))
+
+    def share_rate(self, rate, workers):
+        # 0 là không giới hạn nên phần chia không được làm tròn xuống 0
+        return max(1, rate // max(1, workers)) if rate else 0
+
+    def background_startup(self):
+        try:
+            logging.info(f'Local IP address: {self.get_local_ip()}')
+        except OSError as e:
+            logging.warning(f'Could not determine local IP: {e}')
+        if self.discover_public_ip:
+            try:
+                logging.info(f'Public IP address: {self.get_public_ip()}')
+            except Exception as e:
+                logging.warning(f'Could not determine public IP: {e}')
+        # Blob mồ côi chỉ tốn chỗ; quét cả kho có thể lâu nên không chặn việc khởi động
+        orphans = self.blob_store.purge_orphans()
+        if orphans:
+            logging.info(f'Removed {orphans} unreferenced blobs')
+
     def get_local_ip(self):
         hostname = socket.gethostname()
         local_ip = socket.gethostbyname(hostname)
         return local_ip
 
     def get_public_ip(self):
-        response = requests.get('https://api.ipify.org?format=json')
+        import requests  # Chỉ nạp khi cần tra IP public; máy không có mạng vẫn khởi động được
+        response = requests.get(PUBLIC_IP_URL, timeout=PUBLIC_IP_TIMEOUT)
         public_ip = response.json()['ip']
         return public_ip
 
     def handle_client(self, client_socket, address):
+        channel = Channel(client_socket, wakeup=self.wakeup_reader)
+        self.client_channels[address] = channel
+        self.metrics.inc('connections_total')
         try:
             logging.info(f'New connection from {address}')
-            client_socket.settimeout(1.0)
-            if not self.version_check(client_socket):
+            with self.tracer.span('handshake', address=format_address(address)) as span:
+                accepted = self.version_check(channel)
+                span.set(version=channel.version, accepted=accepted)
+            if not accepted:
                 logging.warning(f'Version check failed for {address}')
                 return
 
             login_attempts = 3
             while self.active_users.get(address) is None and not self.shutdown_event.is_set():
-                command_first = self.receive_message(client_socket)
+                command_first = self.receive_message(channel)
                 if self.shutdown_event.is_set():
-                    self.send_message(client_socket, "SERVER_SHUTDOWN")
+                    self.send_message(channel, "SERVER_SHUTDOWN")
                     break
                 if not command_first:
                     break
-                if command_first.startswith("LOGIN"):
-                    logging.info(f'Login attempt from {address}')
-                    while login_attempts > 0:
-                        parts = command_first.split('|')
-                        if len(parts) != 3:
-                            self.send_message(client_socket, "ERROR|Định dạng đăng nhập không hợp lệ")
-                            break
-                        username, password = parts[1], parts[2]
-                        if username == '' or password == '':
-                            self.send_message(client_socket, "ERROR|Tên đăng nhập hoặc mật khẩu không được để trống")
-                            break
-                        if self.user_manager.verify_user(username, password):
-                            self.send_message(client_socket, "SUCCESS|Đăng nhập thành công")
-                            self.active_users[address] = username
-                            logging.info(f'Successfully login as {username} from {address}')
-                            break
-                        else:
-                            self.send_message(client_socket, "ERROR|Tên đăng nhập hoặc mật khẩu không đúng")
-                            logging.warning(f'Login (attempt {4 - login_attempts}) failed for {username} from {address}')
-                            login_attempts -= 1
-                            break
-                elif command_first.startswith("SIGNUP"):
-                    while True:
-                        parts = command_first.split('|')
-                        if len(parts) != 3:
-                            self.send_message(client_socket, "ERROR|Định dạng đăng ký không hợp lệ")
-                            break
-                        username, password = parts[1], parts[2]
-                        if self.user_manager.user_exists(username):
-                            self.send_message(client_socket, "ERROR|Người dùng đã tồn tại")
-                            break
-                        else:
-                            if self.user_manager.add_user(username, password):
-                                self.send_message(client_socket, "SUCCESS|Đăng ký thành công")
-                                logging.info(f'New user {username} registered from {address}')
+                with self.command_scope(command_first[0], address):
+                    if command_first[0] == "LOGIN":
+                        logging.info(f'Login attempt from {address}')
+                        while login_attempts > 0:
+                            if len(command_first) != 3:
+                                self.send_message(channel, "ERROR", "Định dạng đăng nhập không hợp lệ")
+                                break
+                            username, password = command_first[1], command_first[2]
+                            if username == '' or password == '':
+                                self.send_message(channel, "ERROR", "Tên đăng nhập hoặc mật khẩu không được để trống")
+                                break
+                            try:
+                                verified = self.user_manager.verify_user(username, password)
+                            except HashingBusy:
+                                logging.warning(f'Password hashing queue full, login from {address} rejected')
+                                self.send_message(channel, "ERROR", "Server đang bận, vui lòng thử lại sau")
+                                break
+                            if verified:
+                                channel.throttle = self.open_throttle(username)
+                                self.send_message(channel, "SUCCESS", "Đăng nhập thành công")
+                                self.active_users[address] = username
+                                logging.info(f'Successfully login as {username} from {address}')
                                 break
                             else:
-                                logging.warning(f'Failed to register new user {username} from {address}')
-                                self.send_message(client_socket, "ERROR|Đăng ký thất bại")
+                                self.send_message(channel, "ERROR", "Tên đăng nhập hoặc mật khẩu không đúng")
+                                logging.warning(f'Login (attempt {4 - login_attempts}) failed for {username} from {address}')
+                                login_attempts -= 1
                                 break
-                else:
-                    self.send_message(client_socket, "ERROR|Unknown command")
+                    elif command_first[0] == "SIGNUP":
+                        while True:
+                            if len(command_first) != 3:
+                                self.send_message(channel, "ERROR", "Định dạng đăng ký không hợp lệ")
+                                break
+                            username, password = command_first[1], command_first[2]
+                            if self.user_manager.user_exists(username):
+                                self.send_message(channel, "ERROR", "Người dùng đã tồn tại")
+                                break
+                            else:
+                                try:
+                                    added = self.user_manager.add_user(username, password)
+                                except HashingBusy:
+                                    logging.warning(f'Password hashing queue full, signup from {address} rejected')
+                                    self.send_message(channel, "ERROR", "Server đang bận, vui lòng thử lại sau")
+                                    break
+                                if added:
+                                    self.send_message(channel, "SUCCESS", "Đăng ký thành công")
+                                    logging.info(f'New user {username} registered from {address}')
+                                    break
+                                else:
+                                    logging.warning(f'Failed to register new user {username} from {address}')
+                                    self.send_message(channel, "ERROR", "Đăng ký thất bại")
+                                    break
+                    else:
+                        self.send_message(channel, "ERROR", "Unknown command")
 
             if self.shutdown_event.is_set():
-                self.send_message(client_socket, "SERVER_SHUTDOWN")
+                self.send_message(channel, "SERVER_SHUTDOWN")
                 return
 
             while not self.shutdown_event.is_set():
-                command = self.receive_message(client_socket)
+                command = self.receive_message(channel)
                 if self.shutdown_event.is_set():
-                    self.send_message(client_socket, "SERVER_SHUTDOWN")
+                    self.send_message(channel, "SERVER_SHUTDOWN")
                     break
                 if not command:
                     break
 
-                if command.startswith("UPLOAD"):
-                    username = self.active_users[address]
-                    storage_dir = self.user_manager.get_user_storage(username)
-                    filename = command.split(' ', 1)[1]
-
-                    original_filename = filename
-                    file_base, file_ext = os.path.splitext(filename)
-                    counter = 1
-                    while os.path.exists(os.path.join(storage_dir, filename)):
-                        filename = f'{file_base} ({counter}){file_ext}'
-                        counter += 1
-
-                    if filename != original_filename:
-                        # inform client that file name has been changed
-                        self.send_message(client_socket, f"NEW_FILENAME|{filename}")
-                    else:
-                        self.send_message(client_socket, "FILENAME_OK")
-                        
-                    # self.send_message(client_socket, "FILENAME_OK")
-                    
-                    filesize_str = self.receive_message(client_socket)
-                    filesize = 0
-                    try:
-                        filesize = int(filesize_str)
-                    except ValueError:
-                        self.send_message(client_socket, "ERROR|Kích thước tệp tin không hợp lệ")
-                        continue
-
-                    self.send_message(client_socket, "READY")
-                    
-                    checksum_msg = self.receive_message(client_socket)
-                    checksum = ""
-                    if checksum_msg.startswith("CHECKSUM:"):
-                        checksum = checksum_msg.split(':', 1)[1]
-                        self.send_message(client_socket, "CHECKSUM_OK")
-                    
-                    filepath = os.path.join(storage_dir, filename)
-                    bytes_received = 0
-                    with open(filepath, 'wb') as f:
-                        while bytes_received < filesize and not self.shutdown_event.is_set():
-                            try:
-                                data = client_socket.recv(4096)
-                            except socket.timeout:
-                                continue
-                            if not data:
-                                break
-                            f.write(data)
-                            bytes_received += len(data)
-
-                    if self.shutdown_event.is_set():
-                        self.send_message(client_socket, "SERVER_SHUTDOWN")
-                        break
-
-                    if bytes_received == filesize:
-                        calculated_checksum = self.generate_file_checksum(filepath)
-                        print(f"Checksum: {calculated_checksum}")
-                        
-                        if checksum != calculated_checksum:
-                            self.send_message(client_socket, "ERROR|Checksum không khớp")
-                            os.remove(filepath)
-                        else:
-                            self.send_message(client_socket, "SUCCESS")
-                            print(f"Tải lên tệp tin: {filename} thành công từ {address}")
-                    else:
-                        self.send_message(client_socket, "ERROR|Tải lên không hoàn thành")
-
-                elif command.startswith("DOWNLOAD"):
-                    username = self.active_users[address]
-                    storage_dir = self.user_manager.get_user_storage(username)
-                    parts = command.split(' ', 1)
-                    if len(parts) < 2:
-                        self.send_message(client_socket, "ERROR|Định dạng lệnh không hợp lệ")
-                        continue
-                    filename = parts[1]
-                    filepath = os.path.join(storage_dir, filename)
-                    if not os.path.exists(filepath):
-                        self.send_message(client_socket, "FILE_NOT_FOUND")
-                    else:
-                        logging.info(f'File download request from {address}: {filename}')
-                        filesize = os.path.getsize(filepath)
-                        self.send_message(client_socket, str(filesize))
-                        response = self.receive_message(client_socket)
-                        if response == "READY":
-                            checksum = self.generate_file_checksum(filepath)
-                            self.send_message(client_socket, f"CHECKSUM:{checksum}")
-                            response = self.receive_message(client_socket)
-                            if response == "CHECKSUM_OK":
-                                with open(filepath, 'rb') as f:
-                                    while True:
-                                        data = f.read(4096)
-                                        if not data:
-                                            break
-                                        client_socket.sendall(data)
-                                print(f"Gửi tệp tin: {filename} đến {address} thành công")
-                                self.send_message(client_socket, "SUCCESS")
-                                logging.info(f'File {filename} sent to {address}')
-                            else:
-                                self.send_message(client_socket, "ERROR|Client không nhận được checksum")
-                        else:
-                            self.send_message(client_socket, "ERROR|Không sẵn sàng nhận tệp tin")
-
-                elif command.startswith("LIST"):
-                    username = self.active_users[address]
-                    storage_dir = self.user_manager.get_user_storage(username)
-                    files = os.listdir(storage_dir)
-                    if not files:
-                        self.send_message(client_socket, "ERROR|Không có tệp tin")
+                with self.command_scope(command[0], address):
+                    if command[0] == "UPLOAD":
+                        if not self.handle_upload(channel, address, command):
+                            break
+                    elif command[0] == "UPLOAD_FILE":
+                        if not self.handle_upload_file(channel, address, command):
+                            break
+                    elif command[0] == "UPLOAD_BATCH":
+                        if not self.handle_upload_batch(channel, address, command):
+                            break
+                    elif command[0] == "UPLOAD_DIR":
+                        if not self.handle_upload_dir(channel, address, command):
+                            break
+                    elif command[0] == "DOWNLOAD":
+                        self.handle_download(channel, address, command)
+                    elif command[0] == "DOWNLOAD_DIR":
+                        if not self.handle_download_dir(channel, address, command):
+                            break
+                    elif command[0] == "LIST":
+                        self.handle_list(channel, address)
+                    elif command[0] == "LIST_PAGE":
+                        self.handle_list_page(channel, address, command)
+                    elif command[0] == "UPLOAD_PARALLEL":
+                        self.handle_upload_parallel(channel, address, command)
+                    elif command[0] == "UPLOAD_RANGE":
+                        self.handle_upload_range(channel, address, command)
+                    elif command[0] == "UPLOAD_COMMIT":
+                        self.handle_upload_commit(channel, address, command)
+                    elif command[0] == "UPLOAD_RESUME":
+                        self.handle_upload_resume(channel, address, command)
+                    elif command[0] == "UPLOAD_STATUS":
+                        self.handle_upload_status(channel, address, command)
+                    elif command[0] == "UPLOAD_APPEND":
+                        if not self.handle_upload_append(channel, address, command):
+                            break
+                    elif command[0] == "UPLOAD_ABORT":
+                        self.handle_upload_abort(channel, address, command)
+                    elif command[0] == "UPLOAD_DELTA":
+                        if not self.handle_upload_delta(channel, address, command):
+                            break
+                    elif command[0] == "DOWNLOAD_INFO":
+                        self.handle_download_info(channel, address, command)
+                    elif command[0] == "DOWNLOAD_RANGE":
+                        self.handle_download_range(channel, address, command)
+                    elif command[0] == "STATS":
+                        self.handle_stats(channel, address)
+                    elif command[0] == "TRACE":
+                        self.handle_trace(channel, address, command)
+                    elif command[0] == "PROFILE":
+                        self.handle_profile(channel, address, command)
+                    elif command[0] == "LIMIT":
+                        self.handle_limit(channel, address, command)
                     else:
-                        file_info = []
-                        for file in files:
-                            filepath = os.path.join(storage_dir, file)
-                            size = os.path.getsize(filepath)
-                            file_info.append(f"{file}|{size}")
-                        file_list = "\n".join(file_info)
-                        self.send_message(client_socket, file_list)
-                else:
-                    self.send_message(client_socket, "ERROR|Unknown command")
+                        self.send_message(channel, "ERROR", "Unknown command")
 
             if self.shutdown_event.is_set():
-                self.send_message(client_socket, "SERVER_SHUTDOWN")
+                self.send_message(channel, "SERVER_SHUTDOWN")
 
         except Exception as e:
-            print(f"Lỗi khi xử lý client {address}: {e}")
             logging.error(f'Error handling client {address}: {e}')
         finally:
             if address in self.active_users:
                 logging.info(f'User {self.active_users[address]} disconnected from {address}')
                 del self.active_users[address]
-            client_socket.close()
-            print(f"Đã ngắt kết nối với {address}")
+            self.retire_channel(address, channel)
+            self.discard_transfers(address)
+            channel.close()
+            logging.info(f'Connection from {address} closed')
+
+    @contextmanager
+    def command_scope(self, command, address):
+        # Mỗi lệnh là một span gốc; luồng xử lý được lấy mẫu nếu kết nối đang được profile
+        label = command if command in METRIC_COMMANDS else 'UNKNOWN'
+        username = self.active_users.get(address)
+        start_time = time.perf_counter()
+        try:
+            with self.tracer.span(label, address=format_address(address), user=username), \
+                    self.profiler.command(address, username):
+                yield
+        finally:
+            self.observe_command(command, start_time)
+
+    def observe_command(self, command, start_time):
+        label = command if command in METRIC_COMMANDS else 'UNKNOWN'
+        self.metrics.observe('command_duration_seconds', time.perf_counter() - start_time, command=label)
+
+    def is_admin(self, address):
+        return self.active_users.get(address) in self.admins
+
+    def handle_stats(self, channel, address):
+        # STATS: snapshot các số đo dưới dạng JSON, chỉ dành cho người dùng quản trị
+        if not self.is_admin(address):
+            self.send_message(channel, "ERROR", "Không có quyền xem thống kê")
+            return
+        self.send_message(channel, "STATS", json.dumps(self.metrics.snapshot()))
+
+    def handle_trace(self, channel, address, command):
+        self.send_message(channel, *self.trace_command(address, command))
+
+    def handle_profile(self, channel, address, command):
+        self.send_message(channel, *self.profile_command(address, command))
+
+    def trace_command(self, address, command):
+        # TRACE ON|OFF: bật/tắt ghi span cho mọi lệnh khi server đang chạy. Trả về phản hồi
+        if not self.is_admin(address):
+            return "ERROR", "Không có quyền thay đổi tracing"
+        if len(command) != 2 or command[1].upper() not in ('ON', 'OFF'):
+            return "ERROR", "Định dạng lệnh không hợp lệ"
+        self.tracer.enabled = command[1].upper() == 'ON'
+        logging.info(f'Tracing {"enabled" if self.tracer.enabled else "disabled"} by {self.active_users[address]}')
+        return "SUCCESS", "Đã bật tracing" if self.tracer.enabled else "Đã tắt tracing"
+
+    def profile_command(self, address, command):
+        # PROFILE CPU|MEMORY <số giây> [người dùng hoặc ip:port]: profile trong một khoảng thời gian,
+        # CPU có thể giới hạn ở một kết nối. PROFILE STOP kết thúc sớm. Phản hồi chứa tệp tin kết quả
+        if not self.is_admin(address):
+            return "ERROR", "Không có quyền profile server"
+        if len(command) == 2 and command[1].upper() == 'STOP':
+            path = self.profiler.stop()
+            if path is None:
+                return "ERROR", "Không có phiên profile nào đang chạy"
+            return "PROFILING", path
+        try:
+            kind, seconds = command[1].lower(), float(command[2])
+        except (IndexError, ValueError):
+            return "ERROR", "Định dạng lệnh không hợp lệ"
+        target = command[3] if len(command) > 3 and command[3] else None
+        if kind not in PROFILE_KINDS or not 0 < seconds <= MAX_PROFILE_SECONDS or (target and kind != 'cpu'):
+            return "ERROR", "Định dạng lệnh không hợp lệ"
+        try:
+            return "PROFILING", self.profiler.start(kind, seconds, target)
+        except ValueError as e:
+            return "ERROR", str(e)
+
+    def open_throttle(self, username):
+        rate = self.user_manager.get_bandwidth_limit(username)
+        if self.limit_store is not None:
+            rate = self.share_rate(rate, self.limit_counts.get(username, 1))
+        return self.bandwidth.throttle(username, rate)
+
+    def handle_limit(self, channel, address, command):
+        self.send_message(channel, *self.limit_command(address, command))
+
+    def limit_command(self, address, command):
+        # LIMIT: xem giới hạn hiện tại (JSON). LIMIT GLOBAL <byte/giây> đổi giới hạn chung của server,
+        # LIMIT USER <người dùng> <byte/giây> đổi và lưu giới hạn của một người dùng. Tốc độ nhận hậu tố
+        # K/M/G, 0 là bỏ giới hạn; áp dụng ngay cho các transfer đang chạy. Trả về phản hồi
+        if not self.is_admin(address):
+            return "ERROR", "Không có quyền thay đổi giới hạn băng thông"
+        if len(command) == 1:
+            if self.limit_store is not None:
+                # Giá trị đã cấu hình cho cả nhóm worker, không phải phần của worker này
+                limits = {'global': self.limit_store.get_global(), 'users': self.user_manager.get_bandwidth_limits()}
+                return "LIMITS", json.dumps(limits)
+            return "LIMITS", json.dumps(self.bandwidth.limits())
+        scope = command[1].upper()
+        try:
+            if scope == 'GLOBAL' and len(command) == 3:
+                rate = parse_rate(command[2])
+            elif scope == 'USER' and len(command) == 4 and command[2]:
+                rate = parse_rate(command[3])
+            else:
+                return "ERROR", "Định dạng lệnh không hợp lệ"
+        except ValueError:
+            return "ERROR", "Tốc độ không hợp lệ"
+        if scope == 'GLOBAL':
+            if self.limit_store is not None:
+                self.limit_store.set_global(rate)
+            else:
+                self.bandwidth.set_rate(rate)
+            target = 'server'
+        else:
+            target = command[2]
+            if not self.user_manager.set_bandwidth_limit(target, rate):
+                return "ERROR", "Người dùng không tồn tại"
+            if self.limit_store is None:
+                self.bandwidth.set_user_rate(target, rate)
+        if self.limit_store is not None:
+            # Worker này áp dụng ngay, các worker khác ở lần đồng bộ kế tiếp
+            self.sync_limits()
+        logging.info(f'Bandwidth limit for {target} set to {rate or "unlimited"} B/s by {self.active_users[address]}')
+        return "SUCCESS", f"Đã đặt giới hạn {rate} byte/giây" if rate else "Đã bỏ giới hạn băng thông"
+
+    def handle_upload(self, channel, address, command):
+        # Trả về False nếu server đang tắt giữa chừng
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        if len(command) < 2:
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return True
+        filename = self.upload_name(command[1])
+        if filename is None:
+            self.send_message(channel, "ERROR", "Tên tệp tin không hợp lệ")
+            return True
+
+        original_filename = command[1]
+        filename = self.claim_upload_name(username, storage_dir, filename)
+        filepath = os.path.join(storage_dir, filename)
+
+        if filename != original_filename:
+            # inform client that file name has been changed
+            self.send_message(channel, "NEW_FILENAME", filename)
+        else:
+            self.send_message(channel, "FILENAME_OK")
+
+        filesize_msg = self.receive_message(channel)
+        filesize = 0
+        try:
+            filesize = int(filesize_msg[1])
+        except (IndexError, ValueError):
+            os.remove(filepath)
+            self.send_message(channel, "ERROR", "Kích thước tệp tin không hợp lệ")
+            return True
+
+        self.send_message(channel, "READY")
+
+        checksum_msg = self.receive_message(channel)
+        checksum = ""
+        if checksum_msg and checksum_msg[0] == "CHECKSUM":
+            checksum = checksum_msg[1]
+            self.send_message(channel, "CHECKSUM_OK")
+
+        sha256_hash = hashlib.sha256()
+        start_time = time.perf_counter()
+        with open(filepath, 'wb') as f:
+            bytes_received = self.receive_payload(channel, f, filesize, sha256_hash)
+
+        if self.shutdown_event.is_set():
+            self.send_message(channel, "SERVER_SHUTDOWN")
+            return False
+
+        if bytes_received == filesize:
+            calculated_checksum = sha256_hash.hexdigest()
+            logging.debug('Upload checksum of %s from %s: %s', filename, address, calculated_checksum)
+
+            if checksum != calculated_checksum:
+                self.send_message(channel, "ERROR", "Checksum không khớp")
+                os.remove(filepath)
+            else:
+                self.record_transfer('upload', filesize, time.perf_counter() - start_time,
+                                     name=filename, user=username, address=address)
+                self.store_uploaded_file(username, filepath, calculated_checksum)
+                self.send_message(channel, "SUCCESS")
+                logging.info(f'File {filename} uploaded by {address}')
+        else:
+            self.send_message(channel, "ERROR", "Tải lên không hoàn thành")
+        return True
+
+    def parse_upload_header(self, fields):
+        # [lệnh, tên, kích thước, checksum] -> (tên, kích thước, checksum), None nếu sai định dạng
+        try:
+            filename, filesize, checksum = fields[1], int(fields[2]), fields[3]
+        except (IndexError, ValueError):
+            return None
+        if filesize < 0 or not filename:
+            return None
+        return filename, filesize, checksum
+
+    def upload_name(self, filename):
+        # Tên tệp tin client gửi lên: đúng một thành phần đường dẫn, không thoát khỏi thư mục của
+        # người dùng. Trả về tên đã chuẩn hóa hoặc None
+        filename = normalize_member(filename)
+        return filename if filename is not None and '/' not in filename else None
+
+    def receive_upload(self, channel, username, filename, filesize, checksum, address=None):
+        # Nhận dữ liệu tệp tin gửi ngay sau header, không chờ phản hồi nào từ server.
+        # Trả về ("SUCCESS", tên đã lưu) hoặc ("ERROR", lý do); None nếu mất kết nối/server tắt
+        storage_dir = self.user_manager.get_user_storage(username)
+        name = self.upload_name(filename)
+        if name is None:
+            # Dữ liệu đã được gửi kèm header, đọc bỏ để kết nối (và lô tải lên) dùng tiếp được
+            if self.receive_payload(channel, None, filesize, hashlib.sha256()) < filesize:
+                return None
+            return "ERROR", "Tên tệp tin không hợp lệ"
+        filename = name
+        with self.transfers_lock:
+            filename = self.claim_upload_name(username, storage_dir, filename)
+            filepath = os.path.join(storage_dir, filename)
+            f = open(filepath, 'wb')
+        sha256_hash = hashlib.sha256()
+        start_time = time.perf_counter()
+        with f:
+            bytes_received = self.receive_payload(channel, f, filesize, sha256_hash)
+
+        if bytes_received < filesize:
+            os.remove(filepath)
+            return None
+        if sha256_hash.hexdigest() != checksum:
+            os.remove(filepath)
+            return "ERROR", "Checksum không khớp"
+        self.record_transfer('upload', filesize, time.perf_counter() - start_time,
+                             name=filename, user=username, address=address)
+        self.store_uploaded_file(username, filepath, checksum)
+        return "SUCCESS", filename
+
+    def receive_payload(self, channel, f, size, sha256_hash):
+        # Nhận size byte dữ liệu tệp tin, ghi vào f (None thì chỉ đọc bỏ) và băm cùng lúc.
+        # Trả về số byte đã nhận. Span "transfer" tách thời gian chờ socket, ghi đĩa và băm
+        buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+        bytes_received = 0
+        with self.tracer.span('transfer', size=size) as span:
+            phases = PhaseTimer()
+            while bytes_received < size and not self.shutdown_event.is_set():
+                n = channel.receive_data_into(buffer[:min(RECEIVE_BUFFER_SIZE, size - bytes_received)])
+                phases.lap('socket')
+                if not n:
+                    break
+                if f is not None:
+                    f.write(buffer[:n])
+                    phases.lap('write')
+                sha256_hash.update(buffer[:n])
+                phases.lap('hash')
+                bytes_received += n
+            span.set(received=bytes_received, **phases.attributes())
+        if f is not None:
+            # Server không fsync; span này đo thời gian đẩy buffer của tệp tin xuống kernel
+            with self.tracer.span('flush'):
+                f.flush()
+        return bytes_received
+
+    def handle_upload_file(self, channel, address, command):
+        # UPLOAD_FILE <tên> <kích thước> <checksum> rồi dữ liệu ngay sau đó: một vòng hỏi đáp.
+        # Trả về False nếu phải đóng kết nối (không thể bỏ qua dữ liệu khi header sai)
+        username = self.active_users[address]
+        header = self.parse_upload_header(command)
+        if header is None:
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return False
+        result = self.receive_upload(channel, username, *header, address=address)
+        if result is None:
+            if self.shutdown_event.is_set():
+                self.send_message(channel, "SERVER_SHUTDOWN")
+            return False
+        self.send_message(channel, *result)
+        if result[0] == "SUCCESS":
+            logging.info(f'File {result[1]} uploaded by {address}')
+        return True
+
+    def handle_upload_batch(self, channel, address, command):
+        # UPLOAD_BATCH <số tệp tin>, sau đó mỗi tệp tin là FILE <tên> <kích thước> <checksum> + dữ liệu.
+        # Server trả một RESULT <thứ tự> <SUCCESS|ERROR> <tên|lý do> cho mỗi tệp tin, gửi chung
+        # sau khi nhận hết để client không phải vừa gửi vừa đọc
+        username = self.active_users[address]
+        try:
+            count = int(command[1])
+        except (IndexError, ValueError):
+            count = -1
+        if not 0 <= count <= MAX_BATCH_FILES:
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return False
+
+        results = []
+        for index in range(count):
+            fields = self.receive_message(channel)
+            header = self.parse_upload_header(fields) if fields and fields[0] == "FILE" else None
+            if header is None:
+                if fields:
+                    self.send_message(channel, "ERROR", "Định dạng lô tải lên không hợp lệ")
+                return False
+            result = self.receive_upload(channel, username, *header, address=address)
+            if result is None:
+                if self.shutdown_event.is_set():
+                    self.send_message(channel, "SERVER_SHUTDOWN")
+                return False
+            results.append(("RESULT", index) + result)
+
+        succeeded = sum(1 for result in results if result[2] == "SUCCESS")
+        logging.info(f'Batch upload from {address}: {succeeded}/{count} files stored')
+        try:
+            channel.send_messages(results)
+        except Exception as e:
+            logging.warning(f'Error sending message: {e}')
+        return True
+
+    def handle_upload_dir(self, channel, address, command):
+        # UPLOAD_DIR <tên thư mục>: server trả READY <tên đã dùng> rồi client gửi liền các thành viên
+        # (xem archive.py) tới END. Sau END server trả FAILED <đường dẫn> <lý do> cho từng tệp tin
+        # lỗi rồi SUCCESS <tên thư mục> <số tệp tin đã lưu>. Trả về False nếu phải đóng kết nối
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        dirname = normalize_member(command[1]) if len(command) > 1 else None
+        if dirname is None or '/' in dirname:
+            self.send_message(channel, "ERROR", "Tên thư mục không hợp lệ")
+            return True
+        with self.transfers_lock:
+            dirname = self.claim_upload_name(username, storage_dir, dirname, directory=True)
+            target = os.path.join(storage_dir, dirname)
+        self.send_message(channel, "READY", dirname)
+
+        failures = []
+        stored = 0
+        while True:
+            fields = self.receive_message(channel)
+            if fields == ["END"]:
+                break
+            if len(fields) == 2 and fields[0] == "DIR":
+                path = member_path(target, fields[1])
+                try:
+                    if path is None:
+                        raise OSError('invalid member path')
+                    os.makedirs(path, exist_ok=True)
+                except OSError:
+                    failures.append(("FAILED", fields[1], "Không tạo được thư mục"))
+                continue
+            try:
+                if fields[0] != "MEMBER":
+                    raise ValueError(fields[0])
+                relpath, size = fields[1], int(fields[2])
+                if size < 0:
+                    raise ValueError(size)
+            except (IndexError, ValueError):
+                if self.shutdown_event.is_set():
+                    self.send_message(channel, "SERVER_SHUTDOWN")
+                elif fields:
+                    self.send_message(channel, "ERROR", "Định dạng luồng thư mục không hợp lệ")
+                logging.warning(f'Directory upload of {dirname} from {address} aborted after {stored} files')
+                return False
+            result = self.receive_member(channel, username, target, relpath, size)
+            if result is None:
+                if self.shutdown_event.is_set():
+                    self.send_message(channel, "SERVER_SHUTDOWN")
+                logging.warning(f'Directory upload of {dirname} from {address} aborted after {stored} files')
+                return False
+            if result[0] == "SUCCESS":
+                stored += 1
+            else:
+                failures.append(("FAILED", relpath, result[1]))
 
-    def send_message(self, client_socket, message):
-        message = f"{message}\n"
+        logging.info(f'Directory upload of {dirname} from {address}: {stored} files stored, {len(failures)} failed')
         try:
-            client_socket.sendall(message.encode())
+            channel.send_messages(failures + [("SUCCESS", dirname, stored)])
         except Exception as e:
-            print(f"Error sending message: {e}")
+            logging.warning(f'Error sending message: {e}')
+        return True
+
+    def receive_member(self, channel, username, target, relpath, size):
+        # Nhận một thành viên của luồng thư mục. Dữ liệu luôn được đọc hết để luồng không lệch,
+        # kể cả khi không ghi được tệp tin. Trả về ("SUCCESS",) hoặc ("ERROR", lý do); None nếu
+        # mất kết nối, server tắt hoặc luồng sai định dạng
+        path = member_path(target, relpath)
+        f = error = None
+        if path is None:
+            error = "Đường dẫn không hợp lệ"
+        else:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if os.path.lexists(path):
+                    os.remove(path)  # Không ghi đè qua hard link vào kho blob
+                f = open(path, 'wb')
+            except OSError:
+                error = "Không ghi được tệp tin"
+
+        sha256_hash = hashlib.sha256()
+        try:
+            bytes_received = self.receive_payload(channel, f, size, sha256_hash)
+        finally:
+            if f is not None:
+                f.close()
+
+        end = self.receive_message(channel) if bytes_received == size else []
+        if len(end) != 2 or end[0] != "MEMBER_END":
+            if f is not None:
+                os.remove(path)
+            return None
+        if error is None and sha256_hash.hexdigest() != end[1]:
+            os.remove(path)
+            error = "Checksum không khớp"
+        if error is not None:
+            return "ERROR", error
+        self.store_uploaded_file(username, path, end[1])
+        return ("SUCCESS",)
+
+    def handle_download(self, channel, address, command):
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        if len(command) < 2:
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        filename = command[1]
+        filepath = member_path(storage_dir, filename)
+        if filepath is None or not os.path.isfile(filepath):
+            self.send_message(channel, "FILE_NOT_FOUND")
+            return
 
-    def receive_message(self, client_socket):
-        data = ''
+        # DOWNLOAD <tên> [offset [độ dài]]: offset âm tính từ cuối tệp tin
+        filesize = os.path.getsize(filepath)
         try:
-            while not data.endswith('\n') and not self.shutdown_event.is_set():
+            offset = int(command[2]) if len(command) > 2 else 0
+            length = int(command[3]) if len(command) > 3 else None
+        except ValueError:
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        if offset < 0:
+            offset = max(0, filesize + offset)
+        if offset > filesize or (length is not None and length < 0):
+            self.send_message(channel, "ERROR", "Offset nằm ngoài tệp tin")
+            return
+        if length is None or offset + length > filesize:
+            length = filesize - offset
+
+        logging.info(f'File download request from {address}: {filename} [{offset}:{offset + length}]')
+        self.send_message(channel, "SIZE", length)
+        response = self.receive_message(channel)
+        if not response or response[0] != "READY":
+            self.send_message(channel, "ERROR", "Không sẵn sàng nhận tệp tin")
+            return
+
+        # Client có thể gửi kèm READY các kiểu nén nó giải được; server lấy mẫu đầu tệp tin
+        # để quyết định có nén hay không và báo lại trong message CHECKSUM
+        codec = None
+        if len(response) > 1:
+            with open(filepath, 'rb') as f:
+                f.seek(offset)
+                codec = choose_codec(filename, f.read(min(SAMPLE_SIZE, length)), response[1:])
+
+        checksum = self.get_file_checksum(filepath)
+        self.send_message(channel, "CHECKSUM", checksum, *([codec] if codec else []))
+        response = self.receive_message(channel)
+        if response != ["CHECKSUM_OK"]:
+            self.send_message(channel, "ERROR", "Client không nhận được checksum")
+            return
+
+        start_time = time.perf_counter()
+        with self.tracer.span('transfer', size=length, offset=offset) as span, open(filepath, 'rb') as f:
+            f.seek(offset)
+            if codec:
+                sent, wire_bytes = self.send_compressed_payload(channel, f, length, codec)
+                method = codec
+                logging.info(f'Compressed download of {filename} to {address}: {describe_ratio(codec, sent, wire_bytes)}')
+            else:
+                method, sent = self.send_payload(channel, f, length)
+            span.set(method=method, sent=sent)
+        self.record_download(method, sent, time.perf_counter() - start_time, filename, address)
+        self.send_message(channel, "SUCCESS")
+
+    def handle_download_dir(self, channel, address, command):
+        # DOWNLOAD_DIR <thư mục>: gửi ARCHIVE <số tệp tin> <tổng số byte> rồi các thành viên
+        # (xem archive.py) tới END, client không phải trả lời giữa chừng. Trả về False nếu
+        # phải đóng kết nối khi luồng đã gửi dở
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        dirpath = member_path(storage_dir, command[1]) if len(command) > 1 else None
+        if dirpath is None or not os.path.isdir(dirpath):
+            self.send_message(channel, "FILE_NOT_FOUND")
+            return True
+
+        entries = list(walk_tree(dirpath))
+        files = [entry for entry in entries if entry[0] == 'FILE']
+        total = sum(entry[3] for entry in files)
+        logging.info(f'Directory download request from {address}: {command[1]} ({len(files)} files, {total} bytes)')
+        start_time = time.perf_counter()
+        sent = 0
+        try:
+            self.send_message(channel, "ARCHIVE", len(files), total)
+            for entry in entries:
+                if self.shutdown_event.is_set():
+                    return False
+                if entry[0] == 'DIR':
+                    channel.send_message("DIR", entry[1])
+                    continue
+                _, relpath, path, _ = entry
                 try:
-                    packet = client_socket.recv(4096).decode()
-                except socket.timeout:
+                    f = open(path, 'rb')
+                except OSError:
+                    logging.warning(f'Skipping {path} in directory download: file disappeared')
                     continue
-                if not packet:
-                    break
-                data += packet
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    channel.send_message("MEMBER", relpath, size)
+                    checksum = self.send_member(channel, f, path, size)
+                    if checksum is None:
+                        return False
+                channel.send_message("MEMBER_END", checksum)
+                sent += size
+            channel.send_message("END")
+        except OSError as e:
+            logging.error(f'Directory download of {command[1]} to {address} failed: {e}')
+            return False
+        self.record_download('archive', sent, time.perf_counter() - start_time, command[1], address)
+        return True
+
+    def send_member(self, channel, f, path, size):
+        # Gửi đúng size byte của một thành viên. Nếu đã có checksum trong index thì gửi bằng
+        # sendfile, nếu chưa thì băm trong lúc gửi. Tệp tin bị cắt ngắn giữa chừng được bù byte 0
+        # để luồng không lệch; checksum sẽ không khớp và client chỉ bỏ thành viên này.
+        # Trả về checksum, None nếu server đang tắt
+        checksum = self.checksum_index.lookup(path)
+        sha256_hash = None if checksum else hashlib.sha256()
+        buffer = memoryview(bytearray(FALLBACK_BUFFER_SIZE))
+        total_sent = 0
+        complete = True
+        while total_sent < size:
+            if self.shutdown_event.is_set():
+                return None
+            frame_size = min(DATA_FRAME_SIZE, size - total_sent)
+            channel.send_data_header(frame_size)
+            if sha256_hash is None:
+                _, n = self.send_file(channel.sock, f, frame_size, channel.throttle)
+            else:
+                n = f.readinto(buffer[:frame_size])
+                channel.sock.sendall(buffer[:n])
+                sha256_hash.update(buffer[:n])
+                if channel.throttle is not None:
+                    channel.throttle.sent(n)
+            if n < frame_size:
+                channel.sock.sendall(bytes(frame_size - n))
+                complete = False
+            channel.bytes_sent += frame_size
+            total_sent += frame_size
+        if sha256_hash is not None:
+            checksum = sha256_hash.hexdigest()
+            if complete:
+                self.checksum_index.store(path, checksum)
+        return checksum
+
+    def handle_list(self, channel, address):
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        file_info = self.list_user_files(username, storage_dir)
+        if not file_info:
+            self.send_message(channel, "ERROR", "Không có tệp tin")
+        else:
+            fields = [field for name, size in file_info for field in (name, size)]
+            self.send_message(channel, "FILES", *fields)
+
+    def handle_list_page(self, channel, address, command):
+        # LIST_PAGE <số dòng> <cursor> <mẫu glob> <name|size|mtime> <asc|desc>: gửi từng dòng ENTRY
+        # rồi END <cursor trang sau>, cursor rỗng nghĩa là đã hết
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        try:
+            limit = max(1, min(int(command[1]), MAX_LIST_PAGE))
+            cursor, pattern, sort, order = command[2], command[3], command[4], command[5]
+            after = json.loads(cursor) if cursor else None
+            if sort not in SORT_COLUMNS or order not in ('asc', 'desc'):
+                raise ValueError(sort)
+            if after is not None and (not isinstance(after, list) or len(after) != 2):
+                raise ValueError(cursor)
+        except (IndexError, ValueError):
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+
+        self.ensure_file_index(username, storage_dir)
+        rows = self.file_index.page(username, sort, order == 'desc', pattern, after, limit)
+        next_cursor = ''
+        if len(rows) == limit:
+            name, size, mtime_ns = rows[-1]
+            next_cursor = json.dumps([{'name': name, 'size': size, 'mtime': mtime_ns}[sort], name])
+        messages = [("ENTRY", name, size, mtime_ns) for name, size, mtime_ns in rows]
+        messages.append(("END", next_cursor))
+        try:
+            channel.send_messages(messages)
         except Exception as e:
-            print(f"Error receiving message: {e}")
-            return ''
-        return data.strip()
+            logging.warning(f'Error sending message: {e}')
+
+    def handle_upload_parallel(self, channel, address, command):
+        # UPLOAD_PARALLEL <tên> <kích thước> <checksum>: tạo tệp tạm rỗng đúng kích thước để các
+        # kết nối UPLOAD_RANGE ghi song song vào đúng offset (hoặc SUCCESS nếu đã có nội dung).
+        # Tên trong thư mục người dùng chỉ được chọn khi UPLOAD_COMMIT
+        username = self.active_users[address]
+        try:
+            filename, filesize, checksum = command[1], int(command[2]), command[3]
+        except (IndexError, ValueError):
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        if filesize < 0:
+            self.send_message(channel, "ERROR", "Kích thước tệp tin không hợp lệ")
+            return
+        filename = self.upload_name(filename)
+        if filename is None:
+            self.send_message(channel, "ERROR", "Tên tệp tin không hợp lệ")
+            return
+        if self.reply_instant_upload(channel, address, username, filename, filesize, checksum):
+            return
+
+        transfer_id = uuid.uuid4().hex
+        filepath = os.path.join(self.partial_uploads.root, f'{transfer_id}.parallel')
+        with open(filepath, 'wb') as f:
+            f.truncate(filesize)
+        self.parallel_uploads.create(transfer_id, self.transfer_owner(address), username, filename, filepath,
+                                     filesize, checksum)
+        logging.info(f'Parallel upload {transfer_id} of {filename} ({filesize} bytes) started by {address}')
+        self.send_message(channel, "TRANSFER", transfer_id, filename)
+
+    def reply_instant_upload(self, channel, address, username, filename, filesize, checksum):
+        filename = self.link_existing_content(username, filename, filesize, checksum)
+        if filename is None:
+            return False
+        logging.info(f'Instant upload of {filename} by {address}: content {checksum} already stored')
+        self.send_message(channel, "SUCCESS", filename)
+        return True
+
+    def transfer_owner(self, address):
+        return f'{os.getpid()}:{format_address(address)}'
+
+    def get_transfer(self, address, transfer_id):
+        transfer = self.parallel_uploads.get(transfer_id)
+        if transfer is None or transfer['username'] != self.active_users.get(address):
+            return None
+        return transfer
+
+    def handle_upload_range(self, channel, address, command):
+        # UPLOAD_RANGE <transfer id> <offset> <độ dài>, sau READY là dữ liệu của đoạn
+        try:
+            transfer_id, offset, length = command[1], int(command[2]), int(command[3])
+        except (IndexError, ValueError):
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        transfer = self.get_transfer(address, transfer_id)
+        if transfer is None:
+            self.send_message(channel, "ERROR", "Không tìm thấy phiên tải lên")
+            return
+        if offset < 0 or length < 0 or offset + length > transfer['size']:
+            self.send_message(channel, "ERROR", "Đoạn dữ liệu nằm ngoài tệp tin")
+            return
+
+        # Phiên được đánh dấu đang có đoạn ghi trước khi ghi byte nào, nên UPLOAD_COMMIT không thể
+        # kiểm tra và lưu tệp tin trong lúc đoạn này còn ghi
+        if not self.parallel_uploads.begin_range(transfer_id):
+            self.send_message(channel, "ERROR", "Không tìm thấy phiên tải lên")
+            return
+        bytes_received = 0
+        try:
+            fd = os.open(transfer['filepath'], os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        except OSError:
+            self.parallel_uploads.end_range(transfer_id, 0)
+            self.send_message(channel, "ERROR", "Không tìm thấy phiên tải lên")
+            return
+        try:
+            self.send_message(channel, "READY")
+            buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+            with self.tracer.span('transfer', size=length, offset=offset):
+                while bytes_received < length and not self.shutdown_event.is_set():
+                    n = channel.receive_data_into(buffer[:min(RECEIVE_BUFFER_SIZE, length - bytes_received)])
+                    if not n:
+                        break
+                    write_at(fd, buffer[:n], offset + bytes_received)
+                    bytes_received += n
+        finally:
+            os.close(fd)
+            self.parallel_uploads.end_range(transfer_id, bytes_received)
+
+        if bytes_received == length:
+            self.send_message(channel, "SUCCESS")
+        else:
+            self.send_message(channel, "ERROR", "Tải lên không hoàn thành")
+
+    def handle_upload_commit(self, channel, address, command):
+        # Kiểm tra checksum của cả tệp tin một lần sau khi mọi đoạn đã được ghi, rồi mới chuyển
+        # tệp tạm vào thư mục của người dùng
+        transfer = self.get_transfer(address, command[1]) if len(command) > 1 else None
+        if transfer is None:
+            self.send_message(channel, "ERROR", "Không tìm thấy phiên tải lên")
+            return
+        if transfer['active']:
+            self.send_message(channel, "ERROR", "Vẫn còn đoạn dữ liệu đang được tải lên")
+            return
+        transfer = self.parallel_uploads.pop(command[1])
+        if transfer is None:
+            self.send_message(channel, "ERROR", "Vẫn còn đoạn dữ liệu đang được tải lên")
+            return
+
+        if transfer['received'] < transfer['size']:
+            os.remove(transfer['filepath'])
+            self.send_message(channel, "ERROR", "Tải lên không hoàn thành")
+            return
+
+        calculated_checksum = self.generate_file_checksum(transfer['filepath'])
+        if calculated_checksum != transfer['checksum']:
+            os.remove(transfer['filepath'])
+            self.send_message(channel, "ERROR", "Checksum không khớp")
+            return
+
+        username = transfer['username']
+        storage_dir = self.user_manager.get_user_storage(username)
+        with self.transfers_lock:
+            filename = self.claim_upload_name(username, storage_dir, transfer['filename'])
+            filepath = os.path.join(storage_dir, filename)
+            os.replace(transfer['filepath'], filepath)
+        self.store_uploaded_file(username, filepath, calculated_checksum)
+        self.send_message(channel, "SUCCESS", filename)
+        logging.info(f'Parallel upload {command[1]} of {filename} completed by {address}')
+
+    def discard_transfers(self, address):
+        # Xóa các phiên tải lên song song chưa hoàn tất của kết nối điều khiển đã đóng và trả lại
+        # các phiên tải lên dở dang kết nối đó đang giữ
+        owner = self.transfer_owner(address)
+        self.discard_parallel_uploads(self.parallel_uploads.pop_owned(owner))
+        self.partial_uploads.release_owned(owner)
+
+    def discard_parallel_uploads(self, transfers):
+        for transfer in transfers:
+            logging.warning(f'Discarding unfinished upload of {transfer["filename"]} from {transfer["owner"]}')
+            try:
+                os.remove(transfer['filepath'])
+            except OSError:
+                pass
+
+    def handle_upload_resume(self, channel, address, command):
+        # UPLOAD_RESUME <tên> <kích thước> <checksum>: tạo hoặc tìm lại phiên tải lên dở dang.
+        # Nếu server đã có nội dung này thì trả SUCCESS ngay
+        username = self.active_users[address]
+        try:
+            filename, filesize, checksum = command[1], int(command[2]), command[3]
+        except (IndexError, ValueError):
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        if filesize < 0:
+            self.send_message(channel, "ERROR", "Kích thước tệp tin không hợp lệ")
+            return
+        filename = self.upload_name(filename)
+        if filename is None:
+            self.send_message(channel, "ERROR", "Tên tệp tin không hợp lệ")
+            return
+        if self.reply_instant_upload(channel, address, username, filename, filesize, checksum):
+            return
+        transfer_id, offset = self.partial_uploads.open_or_create(username, filename, filesize, checksum)
+        if not self.partial_uploads.acquire(transfer_id, self.transfer_owner(address)):
+            self.send_message(channel, "ERROR", "Phiên tải lên đang được kết nối khác sử dụng")
+            return
+        if offset:
+            logging.info(f'Upload {transfer_id} of {filename} resumed by {address} at byte {offset}')
+        self.send_message(channel, "OFFSET", transfer_id, offset)
+
+    def get_partial_upload(self, address, transfer_id):
+        record = self.partial_uploads.get(transfer_id)
+        if record is None or record['username'] != self.active_users.get(address):
+            return None
+        return record
+
+    def handle_upload_status(self, channel, address, command):
+        # UPLOAD_STATUS <transfer id>: hỏi server đã nhận được bao nhiêu byte
+        record = self.get_partial_upload(address, command[1]) if len(command) > 1 else None
+        if record is None:
+            self.send_message(channel, "ERROR", "Không tìm thấy phiên tải lên")
+            return
+        self.send_message(channel, "OFFSET", command[1], self.partial_uploads.offset(command[1]))
+
+    def handle_upload_append(self, channel, address, command):
+        # UPLOAD_APPEND <transfer id> <offset> [kiểu nén]: nhận phần còn lại của tệp tin từ offset.
+        # Trả về False nếu server đang tắt giữa chừng
+        try:
+            transfer_id, offset = command[1], int(command[2])
+        except (IndexError, ValueError):
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return True
+        codec = command[3] if len(command) > 3 else None
+        if codec is not None and codec not in available_codecs():
+            self.send_message(channel, "ERROR", "Không hỗ trợ kiểu nén này")
+            return True
+        record = self.get_partial_upload(address, transfer_id)
+        if record is None:
+            self.send_message(channel, "ERROR", "Không tìm thấy phiên tải lên")
+            return True
+        if self.upload_name(record['filename']) != record['filename']:
+            # Phiên tạo trước khi UPLOAD_RESUME kiểm tra tên tệp tin
+            self.partial_uploads.remove(transfer_id)
+            self.send_message(channel, "ERROR", "Tên tệp tin không hợp lệ")
+            return True
+        owner = self.transfer_owner(address)
+        if not self.partial_uploads.acquire(transfer_id, owner):
+            self.send_message(channel, "ERROR", "Phiên tải lên đang được kết nối khác sử dụng")
+            return True
+        part_path = self.partial_uploads.part_path(transfer_id)
+        if offset < 0 or offset > self.partial_uploads.offset(transfer_id) or offset > record['size']:
+            self.send_message(channel, "ERROR", "Offset không hợp lệ")
+            return True
+
+        self.send_message(channel, "READY")
+        sha256_hash = hashlib.sha256()
+        buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+        bytes_received = offset
+        wire_bytes = 0
+        start_time = time.perf_counter()
+        renewed = time.monotonic()
+        lease_lost = False
+        with open(part_path, 'r+b') as f:
+            # Bỏ phần thừa sau offset rồi băm lại phần đã có để tiếp tục tính checksum
+            f.truncate(offset)
+            with self.tracer.span('rehash', size=offset):
+                while f.tell() < offset:
+                    n = f.readinto(buffer[:min(RECEIVE_BUFFER_SIZE, offset - f.tell())])
+                    if not n:
+                        break
+                    sha256_hash.update(buffer[:n])
+            with self.tracer.span('transfer', size=record['size'] - offset, codec=codec) as span:
+                phases = PhaseTimer()
+                while bytes_received < record['size'] and not self.shutdown_event.is_set():
+                    if codec:
+                        frame = channel.receive_data_frame()
+                        phases.lap('socket')
+                        if frame is None:
+                            break
+                        data = decompress(codec, frame, min(DATA_FRAME_SIZE, record['size'] - bytes_received))
+                        wire_bytes += len(frame)
+                        phases.lap('decompress')
+                    else:
+                        n = channel.receive_data_into(buffer[:min(RECEIVE_BUFFER_SIZE, record['size'] - bytes_received)])
+                        phases.lap('socket')
+                        if not n:
+                            break
+                        data = buffer[:n]
+                    if time.monotonic() - renewed > LEASE_RENEW:
+                        # Kết nối bị treo lâu hơn lease thì phiên có thể đã thuộc kết nối khác
+                        if not self.partial_uploads.acquire(transfer_id, owner):
+                            lease_lost = True
+                            break
+                        renewed = time.monotonic()
+                    f.write(data)
+                    phases.lap('write')
+                    sha256_hash.update(data)
+                    phases.lap('hash')
+                    bytes_received += len(data)
+                span.set(received=bytes_received - offset, **phases.attributes())
+        self.partial_uploads.touch(transfer_id)
+
+        if lease_lost:
+            logging.warning(f'Upload {transfer_id} taken over by another connection, dropping {address}')
+            self.send_message(channel, "ERROR", "Phiên tải lên đang được kết nối khác sử dụng")
+            return False
+        if self.shutdown_event.is_set():
+            self.send_message(channel, "SERVER_SHUTDOWN")
+            return False
+        if bytes_received < record['size']:
+            self.partial_uploads.release(transfer_id, owner)
+            logging.info(f'Upload {transfer_id} interrupted at byte {bytes_received}, keeping partial file')
+            self.send_message(channel, "ERROR", "Tải lên không hoàn thành")
+            return True
+
+        if sha256_hash.hexdigest() != record['checksum']:
+            self.partial_uploads.remove(transfer_id)
+            self.send_message(channel, "ERROR", "Checksum không khớp")
+            return True
+
+        storage_dir = self.user_manager.get_user_storage(record['username'])
+        with self.transfers_lock:
+            filename = self.claim_upload_name(record['username'], storage_dir, record['filename'])
+            filepath = os.path.join(storage_dir, filename)
+            os.replace(part_path, filepath)
+        self.partial_uploads.remove(transfer_id, keep_file=True)
+        self.record_transfer('upload', record['size'] - offset, time.perf_counter() - start_time,
+                             name=filename, user=record['username'], address=address, method=codec or 'raw')
+        self.store_uploaded_file(record['username'], filepath, record['checksum'])
+        if codec:
+            logging.info(f'Compressed upload of {filename} from {address}: '
+                         f'{describe_ratio(codec, record["size"] - offset, wire_bytes)}')
+        self.send_message(channel, "SUCCESS", filename)
+        logging.info(f'File {filename} uploaded by {address}')
+        return True
+
+    def handle_upload_abort(self, channel, address, command):
+        record = self.get_partial_upload(address, command[1]) if len(command) > 1 else None
+        if record is None:
+            self.send_message(channel, "ERROR", "Không tìm thấy phiên tải lên")
+            return
+        if not self.partial_uploads.acquire(command[1], self.transfer_owner(address)):
+            self.send_message(channel, "ERROR", "Phiên tải lên đang được kết nối khác sử dụng")
+            return
+        self.partial_uploads.remove(command[1])
+        self.send_message(channel, "SUCCESS")
+
+    def handle_upload_delta(self, channel, address, command):
+        # UPLOAD_DELTA <tên> <kích thước> <checksum>: cập nhật tệp tin đã có, client chỉ gửi
+        # các vùng thay đổi. Trả về False nếu phải đóng kết nối
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        try:
+            filename, filesize, checksum = command[1], int(command[2]), command[3]
+        except (IndexError, ValueError):
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return True
+        filepath = member_path(storage_dir, filename)
+        if filepath is None or not os.path.isfile(filepath):
+            self.send_message(channel, "NO_BASE")
+            return True
+        if self.get_file_checksum(filepath) == checksum:
+            self.send_message(channel, "SUCCESS", filename)
+            return True
+
+        temp_path = os.path.join(self.partial_uploads.root, f'{uuid.uuid4().hex}.delta')
+        try:
+            # Giữ bản cũ mở suốt quá trình để các lệnh COPY luôn đọc đúng phiên bản đã ký
+            with open(filepath, 'rb') as base:
+                base_size = os.fstat(base.fileno()).st_size
+                block_size = block_size_for(base_size)
+                signature = make_signature(base, block_size)
+                self.send_message(channel, "SIGNATURE", block_size, base_size)
+                for start in range(0, len(signature), DATA_FRAME_SIZE):
+                    channel.send_data(signature[start:start + DATA_FRAME_SIZE])
+                result = self.apply_delta(channel, base, block_size, base_size, temp_path)
+
+            if self.shutdown_event.is_set():
+                self.send_message(channel, "SERVER_SHUTDOWN")
+                return False
+            if result is None:
+                self.send_message(channel, "ERROR", "Dữ liệu đồng bộ không hợp lệ")
+                return False
+            calculated_checksum, bytes_written, literal_bytes = result
+            if bytes_written != filesize or calculated_checksum != checksum:
+                self.send_message(channel, "ERROR", "Checksum không khớp")
+                return True
+
+            with self.transfers_lock:
+                os.replace(temp_path, filepath)
+            self.store_uploaded_file(username, filepath, checksum)
+            logging.info(f'Delta upload of {filename} by {address}: {literal_bytes} of {filesize} bytes transferred')
+            self.send_message(channel, "SUCCESS", filename)
+            logging.info(f'File {filename} synchronized by {address}')
+            return True
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def apply_delta(self, channel, base, block_size, base_size, temp_path):
+        # Dựng lại tệp tin từ các lệnh COPY <khối đầu> <số khối> / LITERAL <độ dài> cho tới END.
+        # Trả về (checksum, số byte đã ghi, số byte nhận qua mạng), None nếu dữ liệu sai hoặc mất kết nối
+        sha256_hash = hashlib.sha256()
+        buffer = memoryview(bytearray(RECEIVE_BUFFER_SIZE))
+        block_count = -(-base_size // block_size)
+        bytes_written = literal_bytes = 0
+        with open(temp_path, 'wb') as f:
+            while not self.shutdown_event.is_set():
+                op = self.receive_message(channel)
+                if op == ["END"]:
+                    return sha256_hash.hexdigest(), bytes_written, literal_bytes
+                try:
+                    if op[0] == "COPY":
+                        first, count = int(op[1]), int(op[2])
+                        if first < 0 or count < 0 or first + count > block_count:
+                            return None
+                        source, remaining = base, count * block_size
+                        base.seek(first * block_size)
+                    elif op[0] == "LITERAL":
+                        source, remaining = channel, int(op[1])
+                        literal_bytes += remaining
+                    else:
+                        return None
+                except (IndexError, ValueError):
+                    return None
+                while remaining > 0:
+                    view = buffer[:min(RECEIVE_BUFFER_SIZE, remaining)]
+                    n = base.readinto(view) if source is base else channel.receive_data_into(view)
+                    if not n:
+                        if source is base:
+                            break  # Khối cuối của bản cũ ngắn hơn block_size
+                        return None
+                    f.write(buffer[:n])
+                    sha256_hash.update(buffer[:n])
+                    bytes_written += n
+                    remaining -= n
+        return None
+
+    def handle_download_info(self, channel, address, command):
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        if len(command) < 2:
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        filepath = member_path(storage_dir, command[1])
+        if filepath is None or not os.path.isfile(filepath):
+            self.send_message(channel, "FILE_NOT_FOUND")
+            return
+        self.send_message(channel, "FILE_INFO", os.path.getsize(filepath), self.get_file_checksum(filepath))
+
+    def handle_download_range(self, channel, address, command):
+        # DOWNLOAD_RANGE <tên> <offset> <độ dài>: gửi một đoạn của tệp tin, không kiểm tra checksum
+        username = self.active_users[address]
+        storage_dir = self.user_manager.get_user_storage(username)
+        try:
+            filename, offset, length = command[1], int(command[2]), int(command[3])
+        except (IndexError, ValueError):
+            self.send_message(channel, "ERROR", "Định dạng lệnh không hợp lệ")
+            return
+        filepath = member_path(storage_dir, filename)
+        if filepath is None or not os.path.isfile(filepath):
+            self.send_message(channel, "FILE_NOT_FOUND")
+            return
+        filesize = os.path.getsize(filepath)
+        if offset < 0 or length < 0 or offset + length > filesize:
+            self.send_message(channel, "ERROR", "Đoạn dữ liệu nằm ngoài tệp tin")
+            return
+
+        self.send_message(channel, "SIZE", length)
+        start_time = time.perf_counter()
+        with self.tracer.span('transfer', size=length, offset=offset) as span, open(filepath, 'rb') as f:
+            f.seek(offset)
+            method, sent = self.send_payload(channel, f, length)
+            span.set(method=method, sent=sent)
+        self.record_download(method, sent, time.perf_counter() - start_time, f'{filename}[{offset}:{offset + length}]', address)
+        self.send_message(channel, "SUCCESS")
+
+    def send_message(self, channel, *fields):
+        try:
+            channel.send_message(*fields)
+        except Exception as e:
+            logging.warning(f'Error sending message: {e}')
+
+    def receive_message(self, channel):
+        try:
+            return channel.receive_message()
+        except Exception as e:
+            logging.warning(f'Error receiving message: {e}')
+            return []
+
+def main():
+    parser = argparse.ArgumentParser(description='File transfer server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8386)
+    parser.add_argument('--engine', choices=['threading', 'asyncio'], default='threading',
+                        help='threading: one thread per client, asyncio: single event loop')
+    parser.add_argument('--no-sendfile', action='store_true',
+                        help='always send downloads through the user-space buffer loop')
+    parser.add_argument('--admin', action='append', default=[], metavar='USERNAME',
+                        help='user allowed to run the STATS, TRACE, PROFILE and LIMIT commands (repeatable)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--trace', action='store_true',
+                        help='write per-command spans to logs/trace.jsonl (admins can toggle with TRACE ON|OFF)')
+    parser.add_argument('--max-connections', type=int, default=None,
+                        help=f'connections served at once (threading: size of the worker thread pool, '
+                             f'default {MAX_CONNECTIONS}; asyncio: unlimited by default)')
+    parser.add_argument('--accept-queue', type=int, default=ACCEPT_QUEUE,
+                        help='accepted connections allowed to wait for a free worker before new ones get '
+                             'SERVER_BUSY (threading engine)')
+    parser.add_argument('--listen-backlog', type=int, default=LISTEN_BACKLOG,
+                        help='backlog passed to listen() for connections not yet accepted')
+    parser.add_argument('--bandwidth-limit', type=parse_rate, default=0, metavar='RATE',
+                        help='server-wide limit per direction in bytes/s, K/M/G suffixes allowed (0 = unlimited); '
+                             'per-user limits live in the users table, admins can change both with LIMIT')
+    parser.add_argument('--ready-file', metavar='PATH',
+                        help='write {pid, host, port, startup_ms, metrics_port, worker} as JSON here once '
+                             'accepting connections (with --workers: pid, host, port, metrics_port and workers)')
+    parser.add_argument('--no-public-ip', action='store_true',
+                        help='skip looking up the public IP address (isolated hosts)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--debug-rate', type=float, default=DEBUG_RATE,
+                        help='max DEBUG records per second from one call site (0 = unlimited)')
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help='run N server processes sharing the port with SO_REUSEPORT under a supervisor that '
+                             'restarts crashed workers and serves their combined metrics (0 = single process)')
+    parser.add_argument('--worker-id', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers < 0:
+        parser.error('--workers must be >= 0')
+    if args.workers and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers needs SO_REUSEPORT, which this platform does not provide')
+
+    log_dir = LOG_DIR if args.worker_id is None else os.path.join(LOG_DIR, f'worker-{args.worker_id}')
+    configure_logging(log_dir, level=getattr(logging, args.log_level), debug_rate=args.debug_rate)
+    if args.workers and args.worker_id is None:
+        from supervisor import Supervisor
+        supervisor = Supervisor(args.workers, args.host, args.port, sys.argv[1:], metrics_port=args.metrics_port,
+                                ready_file=args.ready_file, bandwidth_limit=args.bandwidth_limit)
+        try:
+            supervisor.run()
+        except Exception as e:
+            logging.error(f'Supervisor failed: {e}')
+        finally:
+            shutdown_logging()
+        return
+
+    options = dict(use_sendfile=not args.no_sendfile, admins=args.admin, metrics_port=args.metrics_port,
+                   trace=args.trace, discover_public_ip=not args.no_public_ip, ready_file=args.ready_file,
+                   bandwidth_limit=args.bandwidth_limit, accept_queue=args.accept_queue,
+                   listen_backlog=args.listen_backlog, reuse_port=args.worker_id is not None,
+                   worker_id=args.worker_id)
+    if args.max_connections is not None:
+        options['max_connections'] = args.max_connections
+    if args.engine == 'asyncio':
+        from async_server import AsyncFileTransferServer
+        server = AsyncFileTransferServer(args.host, args.port, **options)
+    else:
+        server = FileTransferServer(args.host, args.port, **options)
+    try:
+        server.start()
+    finally:
+        shutdown_logging()
 
 if __name__ == "__main__":
-    server = FileTransferServer()
-    server.start()
\ No newline at end of file
+    main()
@@ -0,0 +1,324 @@
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from checksum_index import ChecksumIndex
+from file_index import FileIndex
+from limit_store import LimitStore
+from metrics import Metrics, merge_samples, start_http_server
+from partial_uploads import PartialUploadStore, ParallelUploadStore
+from users import UserManager
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+STOP_TIMEOUT = 10.0  # Thời gian chờ worker tự tắt sau SIGINT trước khi SIGKILL
+MIN_UPTIME = 5.0  # Worker thoát sớm hơn thế bị coi là lỗi khởi động, khởi động lại có chờ
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+SCRAPE_TIMEOUT = 2.0
+
+class WorkerProcess:
+    def __init__(self, index, ready_file):
+        self.index = index
+        self.ready_file = ready_file
+        self.process = None
+        self.started = 0.0
+        self.info = None  # Nội dung ready file của worker (pid, metrics_port...) khi đã sẵn sàng
+        self.restarts = 0
+        self.failures = 0  # Số lần liên tiếp thoát sớm, dùng để giãn thời gian khởi động lại
+        self.restart_at = None
+        self.last_export = None  # Số đo đọc được lần gần nhất, giữ lại khi worker chết
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+class Supervisor:
+    # Chạy nhiều tiến trình server cùng nghe một cổng (SO_REUSEPORT, kernel chia kết nối mới cho
+    # các worker) để dùng hết các nhân CPU. Supervisor không nhận kết nối: nó giữ chỗ cổng bằng một
+    # socket đã bind (không listen), khởi động lại worker bị chết, chuyển SIGINT/SIGTERM tới mọi
+    # worker khi tắt và phục vụ số đo đã gộp của các worker trên --metrics-port
+    def __init__(self, workers, host, port, worker_args, metrics_port=None, ready_file=None, bandwidth_limit=0):
+        self.host = host
+        self.port = port
+        self.worker_args = list(worker_args)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.ready_file = ready_file
+        self.bandwidth_limit = bandwidth_limit
+        self.state_dir = tempfile.mkdtemp(prefix='filetransfer-workers-')
+        self.workers = [WorkerProcess(i, os.path.join(self.state_dir, f'worker-{i}.json')) for i in range(workers)]
+        self.workers_lock = threading.Lock()
+        self.retired = {}  # Bộ đếm và histogram của các worker đã chết
+        self.ready = False
+        self.port_socket = None
+        self.partial_uploads = None
+        self.parallel_uploads = None
+        self.limit_store = None
+        self.metrics = Metrics()
+        self.metrics.gauge('workers_alive', 'Worker processes currently running',
+                           lambda: sum(worker.alive() for worker in self.workers))
+        self.metrics.gauge('worker_restarts_total', 'Worker processes restarted after exiting unexpectedly',
+                           lambda: sum(worker.restarts for worker in self.workers), kind='counter')
+
+    def run(self):
+        # Tín hiệu chỉ ghi số hiệu vào wakeup socket; vòng lặp chính đọc và xử lý
+        wakeup_reader, wakeup_writer = socket.socketpair()
+        wakeup_reader.setblocking(False)
+        wakeup_writer.setblocking(False)
+        signal.set_wakeup_fd(wakeup_writer.fileno())
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+            signal.signal(sig, lambda signum, frame: None)
+        try:
+            self.prepare()
+            for worker in self.workers:
+                self.spawn(worker)
+            with selectors.DefaultSelector() as selector:
+                selector.register(wakeup_reader, selectors.EVENT_READ)
+                while True:
+                    if selector.select(self.next_timeout()) and self.read_signals(wakeup_reader):
+                        logging.info('Stop signal received, stopping workers')
+                        break
+                    self.check_workers()
+                self.stop(selector, wakeup_reader)
+        finally:
+            signal.set_wakeup_fd(-1)
+            wakeup_reader.close()
+            wakeup_writer.close()
+            self.cleanup()
+
+    def prepare(self):
+        # Tạo và nâng cấp các bảng một lần trước khi các worker cùng mở cơ sở dữ liệu; phiên tải lên
+        # song song còn sót lại là của lần chạy trước
+        user_manager = UserManager()
+        ChecksumIndex(user_manager.db_file)
+        FileIndex(user_manager.db_file)
+        self.partial_uploads = PartialUploadStore(user_manager.db_file)
+        self.partial_uploads.release_process()
+        self.parallel_uploads = ParallelUploadStore(user_manager.db_file)
+        self.discard_parallel_uploads(self.parallel_uploads.pop_process())
+        # Giới hạn chung đổi bằng LIMIT GLOBAL chỉ có hiệu lực tới khi khởi động lại, như server đơn
+        self.limit_store = LimitStore(user_manager.db_file)
+        self.limit_store.remove_process()
+        self.limit_store.set_global(self.bandwidth_limit)
+
+        self.port_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.port_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.port_socket.bind((self.host, self.port))
+        self.port = self.port_socket.getsockname()[1]
+        if self.metrics_port is not None:
+            self.metrics_server = start_http_server(self, '127.0.0.1', self.metrics_port)
+            self.metrics_port = self.metrics_server.server_address[1]
+            logging.info(f'Aggregated metrics endpoint on http://127.0.0.1:{self.metrics_port}/metrics')
+        logging.info(f'Starting {len(self.workers)} workers on {self.host}:{self.port}')
+
+    def worker_command(self, worker):
+        # Các tham số của supervisor được truyền lại cho worker; argparse lấy giá trị cuối nên
+        # các tham số thêm vào sau ghi đè cổng, ready file, endpoint số đo và giới hạn băng thông
+        command = [sys.executable, SERVER_SCRIPT, *self.worker_args,
+                   '--worker-id', str(worker.index), '--port', str(self.port),
+                   '--ready-file', worker.ready_file, '--metrics-port', '0']
+        if self.bandwidth_limit:
+            # Phần bằng nhau của giới hạn chung cho tới lần đầu worker đồng bộ giới hạn (LimitStore)
+            command += ['--bandwidth-limit', str(max(1, self.bandwidth_limit // len(self.workers)))]
+        return command
+
+    def spawn(self, worker):
+        try:
+            os.remove(worker.ready_file)
+        except FileNotFoundError:
+            pass
+        worker.info = None
+        worker.restart_at = None
+        # Phiên riêng: Ctrl+C trên terminal chỉ tới supervisor, supervisor quyết định thứ tự tắt
+        worker.process = subprocess.Popen(self.worker_command(worker), start_new_session=True)
+        worker.started = time.monotonic()
+        logging.info(f'Started worker {worker.index} (pid {worker.pid})')
+
+    def read_signals(self, wakeup_reader):
+        # True nếu có SIGINT hoặc SIGTERM
+        try:
+            signums = wakeup_reader.recv(256)
+        except BlockingIOError:
+            return False
+        return signal.SIGINT in signums or signal.SIGTERM in signums
+
+    def next_timeout(self):
+        if any(worker.info is None and worker.restart_at is None for worker in self.workers):
+            return 0.05  # Đang chờ ready file của worker mới khởi động
+        pending = [worker.restart_at for worker in self.workers if worker.restart_at is not None]
+        return max(0.0, min(pending) - time.monotonic()) if pending else None
+
+    def check_workers(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    self.spawn(worker)
+                    worker.restarts += 1
+                continue
+            code = worker.process.poll()
+            if code is not None:
+                self.worker_exited(worker, code, now)
+            elif worker.info is None:
+                worker.info = self.read_ready_file(worker.ready_file)
+        if not self.ready and all(worker.info for worker in self.workers):
+            self.ready = True
+            self.mark_ready()
+
+    def worker_exited(self, worker, code, now):
+        reason = f'signal {-code}' if code < 0 else f'exit code {code}'
+        uptime = now - worker.started
+        if uptime < MIN_UPTIME:
+            worker.failures += 1
+            delay = min(MAX_RESTART_DELAY, RESTART_DELAY * 2 ** (worker.failures - 1))
+        else:
+            worker.failures = 0
+            delay = 0.0
+        logging.error(f'Worker {worker.index} (pid {worker.pid}) exited with {reason} after {uptime:.1f}s, '
+                      f'restarting in {delay:.1f}s')
+        self.retire(worker)
+        worker.restart_at = now + delay
+
+    def retire(self, worker):
+        # Giữ bộ đếm của worker đã chết (tới lần đọc gần nhất) để tổng không bị giảm; dọn các phiên
+        # tải lên song song và trả lại các phiên tải lên dở dang worker đó đang giữ
+        with self.workers_lock:
+            export, worker.last_export = worker.last_export, None
+            if export is not None:
+                samples = self.metrics.load(export)
+                merge_samples(self.retired, {key: value for key, value in samples.items()
+                                             if self.metrics.descriptions[key[0]][0] != 'gauge'})
+        self.discard_parallel_uploads(self.parallel_uploads.pop_process(worker.pid))
+        self.partial_uploads.release_process(worker.pid)
+        self.limit_store.remove_process(worker.pid)
+
+    def discard_parallel_uploads(self, transfers):
+        for transfer in transfers:
+            logging.warning(f'Discarding unfinished upload of {transfer["filename"]} from {transfer["owner"]}')
+            try:
+                os.remove(transfer['filepath'])
+            except OSError:
+                pass
+
+    def read_ready_file(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def mark_ready(self):
+        pids = ', '.join(str(worker.pid) for worker in self.workers)
+        logging.info(f'Supervisor ready on {self.host}:{self.port} with {len(self.workers)} workers (pids {pids})')
+        if self.ready_file:
+            temp_path = f'{self.ready_file}.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump({'pid': os.getpid(), 'host': self.host, 'port': self.port,
+                           'metrics_port': self.metrics_port,
+                           'workers': [worker.info for worker in self.workers]}, f)
+            os.replace(temp_path, self.ready_file)
+
+    def stop(self, selector, wakeup_reader):
+        # Chuyển SIGINT cho các worker (mỗi worker tự thông báo cho client và tắt), quá
+        # STOP_TIMEOUT giây hoặc nhận thêm tín hiệu dừng thì SIGKILL
+        if self.ready_file:
+            try:
+                os.remove(self.ready_file)
+            except FileNotFoundError:
+                pass
+        for worker in self.workers:
+            if worker.alive():
+                worker.process.send_signal(signal.SIGINT)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while any(worker.alive() for worker in self.workers):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (selector.select(min(remaining, 0.5)) and self.read_signals(wakeup_reader)):
+                for worker in self.workers:
+                    if worker.alive():
+                        logging.warning(f'Killing worker {worker.index} (pid {worker.pid})')
+                        worker.process.kill()
+                        worker.process.wait()
+                break
+        for worker in self.workers:
+            if worker.process is not None:
+                self.discard_parallel_uploads(self.parallel_uploads.pop_process(worker.pid))
+                self.partial_uploads.release_process(worker.pid)
+                self.limit_store.remove_process(worker.pid)
+        logging.info('All workers stopped')
+
+    def cleanup(self):
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.port_socket is not None:
+            self.port_socket.close()
+        for worker in self.workers:
+            try:
+                os.remove(worker.ready_file)
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(self.state_dir)
+        except OSError:
+            pass
+
+    # Các phương thức dưới đây được endpoint HTTP gọi (cùng giao diện với Metrics)
+
+    def scrape(self, worker):
+        # /metrics.json của một worker; None nếu worker chưa sẵn sàng hoặc không trả lời
+        info = worker.info
+        if not info or not info.get('metrics_port') or not worker.alive():
+            return None
+        try:
+            url = f'http://127.0.0.1:{info["metrics_port"]}/metrics.json'
+            with urllib.request.urlopen(url, timeout=SCRAPE_TIMEOUT) as response:
+                export = json.load(response)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Could not read metrics of worker {worker.index}: {e}')
+            return None
+        with self.workers_lock:
+            if worker.info is info:
+                worker.last_export = export
+        return export
+
+    def collect_workers(self):
+        # (tổng đã gộp, {số thứ tự worker: số đo của worker đó})
+        per_worker = {}
+        for worker in self.workers:
+            export = self.scrape(worker)
+            if export is not None:
+                per_worker[worker.index] = self.metrics.load(export)
+        with self.workers_lock:
+            merged = dict(self.retired)
+        for samples in per_worker.values():
+            merge_samples(merged, samples)
+        merged.update(self.metrics.collect())
+        return merged, per_worker
+
+    def render_prometheus(self):
+        return self.metrics.render_prometheus(self.collect_workers()[0])
+
+    def export(self):
+        merged, _ = self.collect_workers()
+        return {'descriptions': self.metrics.descriptions,
+                'samples': [[name, labels, value] for (name, labels), value in merged.items()]}
+
+    def snapshot(self):
+        merged, per_worker = self.collect_workers()
+        workers = {}
+        for worker in self.workers:
+            workers[worker.index] = {'pid': worker.pid, 'alive': worker.alive(), 'restarts': worker.restarts}
+            if worker.index in per_worker:
+                workers[worker.index]['stats'] = self.metrics.snapshot(per_worker[worker.index])
+        return {'total': self.metrics.snapshot(merged), 'workers': workers}
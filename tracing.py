@@ -0,0 +1,218 @@
+import contextvars
+import datetime
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+# Bản ghi span ghi ra logger riêng, mỗi dòng một đối tượng JSON
+trace_logger = logging.getLogger('filetransfer.trace')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_span_ids = itertools.count(1)
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'wall_start', 'start')
+
+    def __init__(self, name, parent, attributes):
+        self.span_id = next(_span_ids)
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = attributes
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record(self):
+        record = {
+            'trace': self.trace_id, 'span': self.span_id, 'parent': self.parent_id, 'name': self.name,
+            'start': round(self.wall_start, 6), 'duration_ms': round((time.perf_counter() - self.start) * 1000, 3),
+        }
+        record.update(self.attributes)
+        return record
+
+class _NullSpan:
+    # Dùng khi tắt tracing: span.set() không làm gì
+    def set(self, **attributes):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+class PhaseTimer:
+    # Cộng dồn thời gian từng giai đoạn trong vòng lặp truyền dữ liệu: gọi lap(tên) khi kết thúc
+    # mỗi giai đoạn, thời gian tính từ lần lap trước
+    def __init__(self):
+        self.totals = {}
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.totals[name] = self.totals.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def attributes(self):
+        return {f'{name}_ms': round(seconds * 1000, 3) for name, seconds in self.totals.items()}
+
+def format_address(address):
+    return f'{address[0]}:{address[1]}'
+
+def emit_record(record):
+    trace_logger.info(json.dumps(record, default=str, ensure_ascii=False))
+
+class Tracer:
+    # Span lồng nhau theo contextvars nên dùng được cho cả luồng lẫn coroutine. Span cha là
+    # lệnh giao thức, span con là từng giai đoạn (bắt tay, nhận dữ liệu, ghi đĩa, băm, tra cứu
+    # metadata). Bật/tắt được khi server đang chạy qua thuộc tính enabled
+    def __init__(self, enabled=False, sink=emit_record):
+        self.enabled = enabled
+        self.sink = sink
+
+    @contextmanager
+    def span(self, name, **attributes):
+        if not self.enabled:
+            yield NULL_SPAN
+            return
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes['error'] = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            try:
+                self.sink(span.record())
+            except Exception:
+                pass
+
+class ProfileSession:
+    def __init__(self, kind, seconds, target, path):
+        self.kind = kind
+        self.seconds = seconds
+        self.target = target
+        self.path = path
+        self.stacks = Counter()
+        self.samples = 0
+        self.snapshot = None
+        self.started_tracemalloc = False
+        self.done = threading.Event()
+
+class Profiler:
+    # Profile theo yêu cầu trong một khoảng thời gian, không cần khởi động lại server.
+    #   cpu: luồng nền lấy mẫu stack (sys._current_frames) của các luồng đang xử lý lệnh của
+    #        kết nối được chọn, ghi ra dạng "collapsed stacks" dùng được cho flamegraph
+    #   memory: tracemalloc, so sánh snapshot đầu và cuối khoảng thời gian
+    # Chỉ một phiên profile tại một thời điểm
+    def __init__(self, output_dir, interval=0.005):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.session = None
+        self.lock = threading.Lock()
+        self.active_threads = Counter()  # ident luồng -> số lệnh đang được lấy mẫu trên luồng đó
+
+    def start(self, kind, seconds, target=None):
+        # Trả về đường dẫn tệp tin kết quả; ValueError nếu đang có phiên khác
+        with self.lock:
+            if self.session is not None:
+                raise ValueError(f'Đang profile {self.session.kind}, kết quả sẽ ghi vào {self.session.path}')
+            os.makedirs(self.output_dir, exist_ok=True)
+            timestamp = datetime.datetime.now().strftime('%d%m%Y_%H%M%S')
+            extension = 'folded' if kind == 'cpu' else 'txt'
+            path = os.path.join(self.output_dir, f'{kind}_{timestamp}.{extension}')
+            session = self.session = ProfileSession(kind, seconds, target, path)
+        if kind == 'memory':
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                session.started_tracemalloc = True
+            session.snapshot = tracemalloc.take_snapshot()
+        threading.Thread(target=self._run, args=(session,), name=f'profiler-{kind}', daemon=True).start()
+        logging.info(f'{kind} profiling started for {seconds}s'
+                     f'{f" on {target}" if target else ""}, output {path}')
+        return path
+
+    def stop(self):
+        # Kết thúc sớm phiên đang chạy; trả về đường dẫn kết quả hoặc None
+        session = self.session
+        if session is None:
+            return None
+        session.done.set()
+        return session.path
+
+    def matches(self, target, address, username):
+        return target is None or target == username or target == format_address(address)
+
+    @contextmanager
+    def command(self, address, username):
+        # Đánh dấu luồng hiện tại là đối tượng lấy mẫu trong lúc xử lý lệnh của kết nối được chọn
+        session = self.session
+        if session is None or session.kind != 'cpu' or not self.matches(session.target, address, username):
+            yield
+            return
+        ident = threading.get_ident()
+        with self.lock:
+            self.active_threads[ident] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active_threads[ident] -= 1
+                if self.active_threads[ident] <= 0:
+                    del self.active_threads[ident]
+
+    def _run(self, session):
+        deadline = time.monotonic() + session.seconds
+        try:
+            if session.kind == 'cpu':
+                while not session.done.wait(self.interval) and time.monotonic() < deadline:
+                    self._sample(session)
+            else:
+                session.done.wait(max(0.0, deadline - time.monotonic()))
+            self._write(session)
+            logging.info(f'{session.kind} profile written to {session.path}')
+        except Exception as e:
+            logging.error(f'Profiling failed: {e}')
+        finally:
+            if session.started_tracemalloc:
+                tracemalloc.stop()
+            with self.lock:
+                self.session = None
+
+    def _sample(self, session):
+        with self.lock:
+            idents = list(self.active_threads)
+        if not idents:
+            return
+        frames = sys._current_frames()
+        for ident in idents:
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                session.stacks[';'.join(reversed(stack))] += 1
+                session.samples += 1
+
+    def _write(self, session):
+        with open(session.path, 'w', encoding='utf-8') as f:
+            if session.kind == 'cpu':
+                for stack, count in session.stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+                return
+            snapshot = tracemalloc.take_snapshot()
+            differences = snapshot.compare_to(session.snapshot, 'lineno')
+            current, peak = tracemalloc.get_traced_memory()
+            f.write(f'traced memory: current={current} peak={peak}\n')
+            for stat in differences[:50]:
+                f.write(f'{stat}\n')
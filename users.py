@@ -1,35 +1,47 @@
 import sqlite3
-import hashlib
 import os
+import threading
+from collections import OrderedDict
+from database import get_database
+from password_hashing import PasswordHasher
+
+STORAGE_CACHE_SIZE = 10000
 
 class UserManager:
-    def __init__(self, db_file='users.db'):
+    def __init__(self, db_file='users.db', hasher=None):
         self.db_file = db_file
+        self.database = get_database(db_file)
+        self.hasher = hasher or PasswordHasher()
+        # Cache username -> storage_dir để các lệnh UPLOAD/DOWNLOAD/LIST không phải truy vấn SQLite
+        self.storage_cache = OrderedDict()
+        self.cache_lock = threading.Lock()
         self._initialize_database()
 
     def _initialize_database(self):
-        with sqlite3.connect(self.db_file) as conn:
+        with self.database.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     username TEXT UNIQUE NOT NULL,
                     password TEXT NOT NULL,
-                    storage_dir TEXT NOT NULL
+                    storage_dir TEXT NOT NULL,
+                    bandwidth_limit INTEGER NOT NULL DEFAULT 0
                 )
             """)
+            # Cơ sở dữ liệu tạo trước khi có giới hạn băng thông (byte/giây, 0 là không giới hạn)
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(users)")]
+            if 'bandwidth_limit' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN bandwidth_limit INTEGER NOT NULL DEFAULT 0")
             conn.commit()
 
-    def _hash_password(self, password):
-        return hashlib.sha256(password.encode()).hexdigest()
-
     def add_user(self, username, password):
         # Tự động tạo đường dẫn lưu trữ dựa trên tên người dùng
         storage_dir = os.path.join('user_storage', username)
-        hashed_password = self._hash_password(password)
+        hashed_password = self.hasher.hash(password)
 
         try:
-            with sqlite3.connect(self.db_file) as conn:
+            with self.database.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT INTO users (username, password, storage_dir)
@@ -37,21 +49,37 @@ class UserManager:
                 """, (username, hashed_password, storage_dir))
                 conn.commit()
             os.makedirs(storage_dir, exist_ok=True)
+            self._cache_storage(username, storage_dir)
+            self.hasher.forget(username)
             return True
         except sqlite3.IntegrityError:
             return False  # Người dùng đã tồn tại
 
     def verify_user(self, username, password):
-        hashed_password = self._hash_password(password)
-        with sqlite3.connect(self.db_file) as conn:
+        # Có thể ném HashingBusy khi hàng đợi băm mật khẩu đã đầy
+        with self.database.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT * FROM users WHERE username = ? AND password = ?
-            """, (username, hashed_password))
-            return cursor.fetchone() is not None
+                SELECT password FROM users WHERE username = ?
+            """, (username,))
+            result = cursor.fetchone()
+        if result is None or not self.hasher.verify(username, password, result[0]):
+            return False
+        if self.hasher.needs_rehash(result[0]):
+            # Chuyển mật khẩu SHA-256 cũ sang scrypt ngay khi đăng nhập thành công
+            with self.database.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE users SET password = ? WHERE username = ? AND password = ?
+                """, (self.hasher.hash(password), username, result[0]))
+                conn.commit()
+        return True
 
     def user_exists(self, username):
-        with sqlite3.connect(self.db_file) as conn:
+        with self.cache_lock:
+            if username in self.storage_cache:
+                return True
+        with self.database.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT * FROM users WHERE username = ?
@@ -59,10 +87,66 @@ class UserManager:
             return cursor.fetchone() is not None
 
     def get_user_storage(self, username):
-        with sqlite3.connect(self.db_file) as conn:
+        with self.cache_lock:
+            storage_dir = self.storage_cache.get(username)
+            if storage_dir is not None:
+                self.storage_cache.move_to_end(username)
+                return storage_dir
+        with self.database.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT storage_dir FROM users WHERE username = ?
             """, (username,))
             result = cursor.fetchone()
-            return result[0] if result else None
+        if result is None:
+            return None
+        self._cache_storage(username, result[0])
+        return result[0]
+
+    def get_bandwidth_limit(self, username):
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT bandwidth_limit FROM users WHERE username = ?
+            """, (username,))
+            result = cursor.fetchone()
+        return result[0] if result else 0
+
+    def get_bandwidth_limits(self, usernames=None):
+        # {username: giới hạn} của các người dùng có giới hạn (chỉ trong usernames nếu có)
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            if usernames is None:
+                cursor.execute("""
+                    SELECT username, bandwidth_limit FROM users WHERE bandwidth_limit > 0
+                """)
+            else:
+                usernames = list(usernames)
+                cursor.execute(f"""
+                    SELECT username, bandwidth_limit FROM users
+                    WHERE bandwidth_limit > 0 AND username IN ({', '.join('?' * len(usernames))})
+                """, usernames)
+            return dict(cursor.fetchall())
+
+    def set_bandwidth_limit(self, username, rate):
+        # Trả về False nếu người dùng không tồn tại
+        with self.database.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE users SET bandwidth_limit = ? WHERE username = ?
+            """, (rate, username))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def _cache_storage(self, username, storage_dir):
+        with self.cache_lock:
+            self.storage_cache[username] = storage_dir
+            self.storage_cache.move_to_end(username)
+            while len(self.storage_cache) > STORAGE_CACHE_SIZE:
+                self.storage_cache.popitem(last=False)
+
+    def invalidate(self, username):
+        # Gọi khi thông tin người dùng bị sửa trực tiếp trong cơ sở dữ liệu
+        with self.cache_lock:
+            self.storage_cache.pop(username, None)
+        self.hasher.forget(username)